@@ -795,13 +795,13 @@ class RewardQueue:
         self.Q = np.zeros(length)
         self.len = length
         self.gamma = gamma
+        # discount of the new reward for every entry of the queue
+        self.discounts = gamma ** np.arange(length - 1, -1, -1)
 
     def push(self, reward) -> None:
         self.Q = np.roll(self.Q, -1)
         self.Q[-1] = 0
-
-        for i, r in enumerate(range(self.len - 1, -1, -1)):
-            self.Q[i] += self.gamma ** r * reward
+        self.Q += self.discounts * reward
 
     def get(self) -> int:
         return self.Q[0]
@@ -0,0 +1,201 @@
+"""
+Actor / learner split for the TD3Agent. The mp.n_procs experiment processes
+act: they step their Env with a local copy of the policy and write their
+transitions into a replay buffer in shared memory. A separate learner
+process trains TD3 on that buffer without waiting for the simulators and
+publishes the actor weights through shared memory, from where the actors
+pull them every td3.sync_every steps. Enabled with td3.actor_learner, the
+processes are started by mp_runner.Runner.
+
+Everything is lock free. Every actor writes to its own segment of the buffer
+and weights are published with a version counter that is odd while a copy
+is in progress.
+"""
+import copy
+import queue
+import time
+import torch
+import torch.multiprocessing  # noqa: F401, registers shared memory pickling of tensors
+from agent import make_td3
+
+
+class SharedReplayBuffer:
+    """
+    Replay buffer in shared memory. It is split into one segment per actor,
+    each of which is a ring buffer with a single writer.
+    """
+
+    def __init__(self, state_dim, action_dim, n_segments, max_size=int(1e6)):
+        self.segment_size = max_size // n_segments
+        max_size = self.segment_size * n_segments
+
+        self.state = torch.zeros(max_size, state_dim).share_memory_()
+        self.action = torch.zeros(max_size, action_dim).share_memory_()
+        self.next_state = torch.zeros(max_size, state_dim).share_memory_()
+        self.reward = torch.zeros(max_size, 1).share_memory_()
+        self.not_done = torch.zeros(max_size, 1).share_memory_()
+
+        # write position and number of filled rows of every segment
+        self.ptr = torch.zeros(n_segments, dtype=torch.int64).share_memory_()
+        self.sizes = torch.zeros(n_segments, dtype=torch.int64).share_memory_()
+
+        self.device = torch.device("cpu")
+
+    @property
+    def size(self):
+        return int(self.sizes.sum())
+
+    def segment(self, idx):
+        return BufferSegment(self, idx)
+
+    def sample(self, batch_size, n_batches=None):
+        """
+        Samples uniformly from the filled rows of all segments, see
+        ReplayBuffer.sample.
+        """
+        shape = (batch_size,) if n_batches is None else (n_batches, batch_size)
+        sizes = self.sizes.clone()
+        ends = sizes.cumsum(0)
+        u = torch.randint(0, int(ends[-1]), shape)
+        seg = torch.searchsorted(ends, u, right=True)
+        ind = seg * self.segment_size + u - (ends - sizes)[seg]
+
+        return (
+            self.state[ind],
+            self.action[ind],
+            self.next_state[ind],
+            self.reward[ind],
+            self.not_done[ind],
+        )
+
+
+class BufferSegment:
+    """
+    The part of a SharedReplayBuffer that one actor writes to, with the add
+    method of ReplayBuffer.
+    """
+
+    def __init__(self, buffer, idx):
+        self.buffer = buffer
+        self.idx = idx
+        self.offset = idx * buffer.segment_size
+
+    def add(self, state, action, next_state, reward, done):
+        buffer = self.buffer
+        ptr = int(buffer.ptr[self.idx])
+        row = self.offset + ptr
+
+        buffer.state[row] = torch.as_tensor(state)
+        buffer.action[row] = torch.as_tensor(action)
+        buffer.next_state[row] = torch.as_tensor(next_state)
+        buffer.reward[row] = float(reward)
+        buffer.not_done[row] = 1.0 - done
+
+        # only publish the row once it is written
+        buffer.ptr[self.idx] = (ptr + 1) % buffer.segment_size
+        size = int(buffer.sizes[self.idx]) + 1
+        buffer.sizes[self.idx] = min(size, buffer.segment_size)
+
+
+class SharedPolicy:
+    """
+    Actor weights in shared memory. The learner publishes, the actors pull.
+    """
+
+    def __init__(self, actor, finished):
+        self.actor = copy.deepcopy(actor).share_memory()
+        self.version = torch.zeros(1, dtype=torch.int64).share_memory_()
+        # set by every actor when its experiment is done, and by the runner
+        # when the actor process exits, also if it crashed
+        self.finished = finished
+
+    @torch.no_grad()
+    def publish(self, actor):
+        self.version += 1
+        for shared, param in zip(self.actor.parameters(), actor.parameters()):
+            shared.copy_(param)
+        self.version += 1
+
+    @torch.no_grad()
+    def pull(self, actor):
+        while True:
+            version = int(self.version)
+            if version % 2:
+                time.sleep(1e-4)
+                continue
+            for param, shared in zip(actor.parameters(), self.actor.parameters()):
+                param.copy_(shared)
+            # retry if the learner published while we were copying
+            if int(self.version) == version:
+                return version
+
+    def all_finished(self):
+        return bool(self.finished.all())
+
+
+class ActorLearnerState:
+    """
+    Everything the actors share with the learner, sent to them over a queue.
+    """
+
+    def __init__(self, buffer, policy):
+        self.buffer = buffer
+        self.policy = policy
+
+
+def _get(q, finished, timeout=1.0):
+    """
+    Waits for the next item of q, None once all actors have finished.
+    """
+    while True:
+        try:
+            return q.get(timeout=timeout)
+        except queue.Empty:
+            if bool(finished.all()):
+                return None
+
+
+def run_learner(cnf, dims_queue, state_queue, finished):
+    """
+    Entry point of the learner process. Waits for the state dimension of the
+    agent from the first actor, hands the shared state to all actors and
+    trains until every actor has finished. finished is a shared bool tensor
+    with one flag per actor.
+    """
+    n_actors = cnf.mp.n_procs
+    state_dim = _get(dims_queue, finished)
+    if state_dim is None:
+        print("learner: all actors exited before connecting")
+        return
+    td3 = make_td3(cnf, state_dim, cnf.env.action_dim)
+
+    buffer = SharedReplayBuffer(state_dim, cnf.env.action_dim, n_actors)
+    policy = SharedPolicy(td3.actor, finished)
+    state = ActorLearnerState(buffer, policy)
+    for _ in range(n_actors):
+        state_queue.put(state)
+
+    n_updates = 0
+    start = time.time()
+    while not policy.all_finished():
+        if buffer.size < max(cnf.td3.burn_in, cnf.main.bsize):
+            time.sleep(0.1)
+            continue
+        td3.train(buffer, cnf.main.bsize, cnf.td3.publish_every)
+        policy.publish(td3.actor)
+        n_updates += cnf.td3.publish_every
+
+    print(
+        f"learner: {n_updates} updates on {buffer.size} transitions "
+        f"in {time.time() - start:.0f}s"
+    )
+
+
+def connect_actor(agent, rank, dims_queue, state_queue, timeout=600):
+    """
+    Connects the TD3Agent of an actor process to the learner. Raises
+    queue.Empty if the learner does not answer within timeout seconds.
+    """
+    if rank == 0:
+        dims_queue.put(agent.state_dim)
+    agent.connect(state_queue.get(timeout=timeout), rank)
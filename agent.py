@@ -3,64 +3,151 @@ This file unifies functionality for the PPO agent using the intrinsic curiosity
 It's supposed to be used to quantitatively analyze the agent's touching behavior
 towards it's environment like the table, itself and a pendulum which is in the scene.
 """
+import copy
 import torch
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from utils import ReplayBuffer
 
-from algo.ppo_cont import PPO, Memory
+from algo.ppo_cont import PPO, RolloutBuffer
 from algo.td3 import TD3
 from algo.models import ICModule
+from algo.inference import InferenceModule
+
+
+def make_td3(cnf, state_dim, action_dim):
+    return TD3(
+        state_dim,
+        action_dim,
+        cnf.td3.max_action,
+        precision=cnf.td3.precision,
+        n_critics=cnf.td3.n_critics,
+        target_reduction=cnf.td3.target_reduction,
+        redq_subset=cnf.td3.redq_subset,
+    )
 
 
 class Agent:
-    def __init__(self, action_dim, state_dim, cnf, device, is_goal_based=False):
+    def __init__(
+        self,
+        action_dim,
+        state_dim,
+        cnf,
+        device,
+        is_goal_based=False,
+        n_envs=1,
+        image_shape=None,
+    ):
         # PPO related stuff
         self.action_dim = action_dim
         self.state_dim = state_dim
+        # the ICM observes images (Env.get_vision_state) with the conv encoder
+        self.obs_shape = state_dim
+        if cnf.icm.encoder == "conv":
+            if image_shape is None:
+                raise ValueError("icm.encoder=conv needs a 'vision' env.state")
+            self.obs_shape = image_shape
         self.device = device
         self.cnf = cnf
         self.is_goal_based = is_goal_based
+        # number of envs stepped together, see get_actions
+        self.n_envs = n_envs
 
         self.init_ppo()
         self.init_icm()
 
+        if self.cnf.main.jit_inference:
+            self.compile_inference()
+
     def init_ppo(self):
         state_dim = self.state_dim if not self.is_goal_based else 2 * self.state_dim
         self.ppo = PPO(self.action_dim, state_dim, self.device, **self.cnf.ppo)
-        self.ppo_mem = Memory()
+        self.ppo_mem = self._make_buffer(state_dim)
+
+        # policy that acts, a separate copy when training overlaps with acting
+        self.behaviour_policy = self.ppo.policy
+        self.trainer = None
+        if self.cnf.main.overlap_training:
+            self.behaviour_policy = copy.deepcopy(self.ppo.policy)
+            self.spare_mem = self._make_buffer(state_dim)
+            self.trainer = ThreadPoolExecutor(max_workers=1)
+            self.pending = None
+
+    def _make_buffer(self, state_dim):
+        return RolloutBuffer(
+            state_dim,
+            self.action_dim,
+            obs_dim=self.obs_shape,
+            capacity=self.cnf.main.train_each,
+            n_envs=self.n_envs,
+            device=self.device,
+            obs_dtype=torch.uint8 if self.cnf.icm.encoder == "conv" else torch.float32,
+        )
 
     def init_icm(self):
         self.icm = ICModule(
-            self.action_dim, self.state_dim, self.device, **self.cnf.icm
+            self.action_dim,
+            self.obs_shape,
+            self.device,
+            n_envs=self.n_envs,
+            **self.cnf.icm,
         ).to(self.device)
         self.icm.to(self.device)
-        self.icm_buffer = []
+
+    def compile_inference(self) -> None:
+        """
+        Swaps TorchScript compiled copies of the actor and the inverse model
+        into the acting path. Training continues on the eager modules.
+        """
+        self.behaviour_policy.compile_inference()
+        self.icm.compile_inference()
 
     def append_icm_transition(self, this_state, next_state, action) -> None:
         """
         This is for batched training of the ICM. ICM transitions are needed
         for computing the intrinsic reward which is the error when predicting
-        s_t+1 from (s_t, a).
+        s_t+1 from (s_t, a). States are images with the conv encoder, see
+        BaseExperiment.icm_observation.
         """
-        self.icm_buffer.append([this_state, next_state, action])
+        self.ppo_mem.append("observations", torch.as_tensor(this_state))
+        self.ppo_mem.append("next_observations", torch.as_tensor(next_state))
+        self.ppo_mem.append("transition_actions", torch.as_tensor(action))
+
+    def icm_batch(self, memory=None):
+        """
+        Returns the ICM transitions of the rollout, flattened to [T * n_envs, ...].
+        """
+        memory = self.ppo_mem if memory is None else memory
+        return (
+            memory.observations.flatten(0, 1),
+            memory.next_observations.flatten(0, 1),
+            memory.transition_actions.flatten(0, 1),
+        )
 
     def reset_buffers(self) -> None:
-        self.icm_buffer = []
         self.ppo_mem.clear_memory()
 
     def set_alpha(self, val) -> None:
         self.ppo.policy.alpha = val
-        self.ppo.policy_old.alpha = val
+        self.behaviour_policy.alpha = val
 
     def train_ppo(self) -> None:
         self.ppo.update(self.ppo_mem)
         self.ppo_mem.clear_memory()
 
     def set_is_done(self, is_done) -> None:
-        self.ppo_mem.is_terminals.append(is_done)
+        """
+        is_done is a flag, or one per env [n_envs] with several envs.
+        """
+        self.ppo_mem.append(
+            "is_terminals", torch.as_tensor(is_done, dtype=torch.float32)
+        )
 
     def set_reward(self, reward) -> None:
-        self.ppo_mem.rewards.append(reward)
+        """
+        reward is a scalar, or one per env [n_envs] with several envs.
+        """
+        self.ppo_mem.append("rewards", torch.as_tensor(reward, dtype=torch.float32))
 
     def get_action(self, state, goal=None, inverse_action=None) -> torch.Tensor:
         if goal is not None:
@@ -69,9 +156,23 @@ class Agent:
         if self.is_goal_based:
             state = np.concatenate([state, goal])
 
-        action, *_ = self.ppo.policy_old.act(state, self.ppo_mem, inverse_action)
+        action, *_ = self.behaviour_policy.act(state, self.ppo_mem, inverse_action)
         return action
 
+    def get_actions(self, states, goals=None, inverse_actions=None) -> torch.Tensor:
+        """
+        Batched get_action for n_envs envs, takes states [N, state_dim] (and
+        goals [N, state_dim]) and returns actions [N, action_dim].
+        """
+        if goals is not None:
+            inverse_actions = self.icm.get_action(states, goals)
+
+        if self.is_goal_based:
+            states = np.concatenate([states, goals], axis=-1)
+
+        actions, *_ = self.behaviour_policy.act(states, self.ppo_mem, inverse_actions)
+        return actions
+
     def get_inverse_action(self, state, goal) -> torch.Tensor:
         return self.icm.get_action(state, goal).squeeze()
 
@@ -84,13 +185,11 @@ class Agent:
         intrinsic reward"""
         results = {"ploss": 0, "vloss": 0, "imloss": torch.tensor([0])}
 
-        state_batch, next_state_batch, action_batch = zip(*self.icm_buffer)
-        im_loss_batch = self.icm.train_inverse(
-            state_batch, next_state_batch, action_batch,
-        )
+        fw_loss_batch, im_loss_batch = self.icm.train_joint(*self.icm_batch())
         results["imloss"] = im_loss_batch
+        results["fwloss"] = fw_loss_batch
 
-        self.ppo_mem.rewards = im_loss_batch
+        self.ppo_mem.set("intrinsic_rewards", im_loss_batch)
 
         ploss, vloss = self.ppo.update(self.ppo_mem)
         results["ploss"] = ploss
@@ -98,7 +197,6 @@ class Agent:
 
         # reset buffers
         self.ppo_mem.clear_memory()
-        self.icm_buffer = []
 
         return results
 
@@ -108,40 +206,88 @@ class Agent:
         train_ppo=True,
         freeze_fw_model=False,
         random_reward=False,
-        length=0,
     ) -> dict:
         """
         Trains the ICM of the agent. This method clears the buffer which was filled by
         this.append_icm_transition.
         """
-        results = {"ploss": 0, "vloss": 0, "imloss": torch.tensor([0])}
+        return self._train(
+            self.ppo_mem, train_fw, train_ppo, freeze_fw_model, random_reward
+        )
+
+    def train_async(self, **kwargs) -> dict:
+        """
+        Overlapped version of train for main.overlap_training. Waits for the
+        update of the previous rollout, acts with its result from now on and
+        starts training on the current rollout in a background thread, while
+        the next rollout is collected into the second buffer. The acting
+        policy thereby lags the trained one by at most one update. PPO's
+        ratios are taken against the log probabilities recorded at acting
+        time, so they stay correct. Returns the results of the previous
+        update.
+        """
+        results = self.wait()
+
+        memory, self.ppo_mem = self.ppo_mem, self.spare_mem
+        self.spare_mem = memory
+        self.pending = self.trainer.submit(self._train, memory, **kwargs)
+        return results
+
+    def wait(self) -> dict:
+        """
+        Waits for a running background update and copies its weights into
+        the acting policy.
+        """
+        # no rewards yet before the first update finished
+        results = {"ploss": 0, "vloss": 0, "imloss": torch.zeros(0)}
+        if self.pending is not None:
+            results = self.pending.result()
+            self.pending = None
+            with torch.no_grad():
+                for param, trained in zip(
+                    self.behaviour_policy.parameters(), self.ppo.policy.parameters()
+                ):
+                    param.copy_(trained)
+            self.behaviour_policy.refresh_inference()
+        return results
+
+    def _train(
+        self,
+        memory,
+        train_fw=True,
+        train_ppo=True,
+        freeze_fw_model=False,
+        random_reward=False,
+    ) -> dict:
+        results = {"ploss": 0, "vloss": 0, "imloss": torch.zeros(0)}
 
         if train_fw:
-            state_batch, next_state_batch, action_batch = zip(*self.icm_buffer)
             im_loss_batch = self.icm.train_forward(
-                state_batch, next_state_batch, action_batch, freeze=freeze_fw_model
+                *self.icm_batch(memory), freeze=freeze_fw_model
             )
             results["imloss"] = im_loss_batch
+            memory.set("intrinsic_rewards", im_loss_batch)
 
         # train actor
         if train_ppo:
-            try:
-                random_rew = im_loss_batch.normal_(mean=22, std=76)
-            except:
-                random_rew = torch.randn(length)
-                random_rew.normal_(mean=22, std=76)
-            self.ppo_mem.rewards = im_loss_batch if not random_reward else random_rew
-            ploss, vloss = self.ppo.update(self.ppo_mem)
+            if random_reward:
+                memory.set(
+                    "intrinsic_rewards",
+                    torch.empty(len(memory) * self.n_envs).normal_(22, 76),
+                )
+            ploss, vloss = self.ppo.update(memory)
             results["ploss"] = ploss
             results["vloss"] = vloss
 
         # reset buffers
-        self.ppo_mem.clear_memory()
-        self.icm_buffer = []
+        memory.clear_memory()
 
         return results
 
     def save_state(self, path="") -> None:
+        # let a background update finish first
+        if self.trainer is not None and self.pending is not None:
+            self.pending.result()
         # save icm
         self.icm.save_state(path)
         # save ppo
@@ -173,25 +319,94 @@ class TD3Agent(Agent):
 
         self.init_td3()
 
-        self.inverse_model = inverse_model
+        self.inverse_model = None
+        if inverse_model is not None:
+            self.set_inverse_model(inverse_model)
+
+        if self.cnf.main.jit_inference:
+            self.policy.compile_inference()
+
+    def compile_inference(self) -> None:
+        self.policy.compile_inference()
+        if self.inverse_model is not None:
+            self.inverse_model = self._compile_inverse_model(self.inverse_model)
+
+    @staticmethod
+    def _device_of(model):
+        if isinstance(model, InferenceModule):
+            model = model.module
+        return next(model.parameters()).device
+
+    def _compile_inverse_model(self, model):
+        if isinstance(model, InferenceModule):
+            model = model.module
+        device = self._device_of(model)
+        example = torch.zeros(1, model.linear.in_features // 2, device=device)
+        return InferenceModule(model, (example, example))
 
     def set_inverse_model(self, model):
+        """
+        Sets the (pretrained) inverse model used for mixing actions. With
+        jit_inference it is frozen into a compiled graph, so it has to be set
+        again whenever its weights change.
+        """
+        if self.cnf.main.jit_inference:
+            model = self._compile_inverse_model(model)
         self.inverse_model = model
 
     def get_inverse_action(self, state, goal) -> torch.Tensor:
-        state = torch.tensor(state).float().to(torch.device("cuda"))
-        goal = torch.tensor(goal).float().to(torch.device("cuda"))
+        device = self._device_of(self.inverse_model)
+        state = torch.as_tensor(state, dtype=torch.float32, device=device)
+        goal = torch.as_tensor(goal, dtype=torch.float32, device=device)
         return self.inverse_model(state, goal)
 
     def init_td3(self):
-        self.policy = TD3(self.state_dim, self.action_dim, self.cnf.td3.max_action,)
+        self.policy = make_td3(self.cnf, self.state_dim, self.action_dim)
         self.buffer = ReplayBuffer(self.state_dim, self.action_dim)
+        self.train_step = 0
+        # updates owed by train, see there
+        self.pending_updates = 0.0
+        # shared state of the actor / learner split, see connect
+        self.shared = None
+
+    def connect(self, shared, rank):
+        """
+        Turns the agent into an actor of actor_learner. Transitions go to
+        its segment of the shared replay buffer and train only pulls the
+        weights that the learner published.
+        """
+        self.shared = shared
+        self.buffer = shared.buffer.segment(rank)
+        self.rank = rank
+        self.shared.policy.pull(self.policy.actor)
+
+    def disconnect(self):
+        self.shared.policy.finished[self.rank] = True
+        self.shared = None
 
     def add_transition(self, state, action, nstate, reward, done):
         self.buffer.add(state, action, nstate, reward, done)
 
     def train(self):
-        self.policy.train(self.buffer, self.cnf.main.bsize)
+        """
+        Called once per env step. Every td3.train_every steps it runs
+        td3.utd_ratio * td3.train_every updates, so that the number of
+        updates per collected transition is utd_ratio. Fractions of an update
+        are carried over to the next call. Connected to a
+        learner, it pulls the latest weights every td3.sync_every steps.
+        """
+        self.train_step += 1
+        if self.shared is not None:
+            if self.train_step % self.cnf.td3.sync_every == 0:
+                self.shared.policy.pull(self.policy.actor)
+            return
+        if self.train_step % self.cnf.td3.train_every:
+            return
+        self.pending_updates += self.cnf.td3.utd_ratio * self.cnf.td3.train_every
+        n_updates = int(self.pending_updates)
+        self.pending_updates -= n_updates
+        if n_updates:
+            self.policy.train(self.buffer, self.cnf.main.bsize, n_updates)
 
     def get_action(self, state, goal=None, inverse_action=None):
         if goal is not None:
@@ -208,10 +423,37 @@ class TD3Agent(Agent):
         action = action.clip(-self.cnf.td3.max_action, self.cnf.td3.max_action)
 
         if inverse_action is not None:
-            action = (
-                1 - self.cnf.td3.alpha
-            ) * action + self.cnf.td3.alpha * inverse_action.detach().cpu().numpy()
-
-            if (np.absolute(action) > 1).any():
-                action = action / np.absolute(action).max()
+            action = self._mix_actions(action, inverse_action)
         return action.squeeze()
+
+    def get_actions(self, states, goals=None, inverse_actions=None):
+        """
+        Batched get_action, takes states [N, state_dim] (and goals
+        [N, state_dim]) and returns actions [N, action_dim].
+        """
+        states = np.asarray(states)
+        if goals is not None:
+            inverse_actions = self.get_inverse_action(states, goals)
+
+        if self.is_goal_based:
+            states = np.concatenate([states, goals], axis=-1)
+
+        actions = self.policy.select_actions(states)
+        actions += np.random.normal(
+            0, self.cnf.td3.max_action * self.cnf.td3.expl_noise, size=actions.shape,
+        )
+
+        actions = actions.clip(-self.cnf.td3.max_action, self.cnf.td3.max_action)
+
+        if inverse_actions is not None:
+            actions = self._mix_actions(actions, inverse_actions)
+        return actions
+
+    def _mix_actions(self, action, inverse_action):
+        """
+        Blends with the inverse model actions and rescales every action whose
+        largest component leaves [-1, 1] back onto the box.
+        """
+        alpha = self.cnf.td3.alpha
+        action = (1 - alpha) * action + alpha * inverse_action.detach().cpu().numpy()
+        return action / np.maximum(np.absolute(action).max(-1, keepdims=True), 1)
@@ -4,6 +4,7 @@ import gym
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from algo.returns import discounted_returns
 
 
 class A2CAgent:
@@ -69,12 +70,8 @@ class A2CAgent:
         entropies = torch.stack(self.entropies)
         # compute returns
         #rewards = [sum(self.rewards[i:]) for i in range(len(self.rewards))]
-        R = 0
-        returns = []
-        for reward in self.rewards[::-1]:
-            R = 0.99 * R + reward
-            returns.insert(0, R)
-        returns = torch.tensor(returns).float().to(self.device)
+        rewards = torch.tensor(self.rewards).float().to(self.device)
+        returns = discounted_returns(rewards, torch.zeros_like(rewards), 0.99)
 
         # normalizing
         #returns = self._normalize(returns)
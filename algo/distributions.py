@@ -0,0 +1,87 @@
+"""
+Diagonal Gaussian action distribution for continuous policies. Samples,
+log probabilities and entropies are computed in closed form on batched
+inputs, without building a covariance matrix and factorizing it like
+torch.distributions.MultivariateNormal does.
+"""
+import math
+import torch
+import torch.nn as nn
+
+LOG_2PI = math.log(2 * math.pi)
+
+
+class DiagGaussian:
+    """
+    Gaussian with mean *loc* [..., action_dim] and independent dimensions of
+    log standard deviation *log_std*, broadcastable to loc.
+    """
+
+    def __init__(self, loc, log_std):
+        self.loc = loc
+        self.log_std = log_std.expand_as(loc)
+
+    @property
+    def stddev(self):
+        return self.log_std.exp()
+
+    def sample(self):
+        with torch.no_grad():
+            return self.rsample()
+
+    def rsample(self):
+        return self.loc + self.stddev * torch.randn_like(self.loc)
+
+    def log_prob(self, value):
+        z = (value - self.loc) * torch.exp(-self.log_std)
+        return -0.5 * (z * z + LOG_2PI).sum(-1) - self.log_std.sum(-1)
+
+    def entropy(self):
+        return (0.5 + 0.5 * LOG_2PI + self.log_std).sum(-1)
+
+
+class DiagGaussianHead(nn.Module):
+    """
+    Turns action means into a DiagGaussian with a state independent standard
+    deviation, initialized to *action_std*. With learn_std the log standard
+    deviation is a parameter, otherwise it is a fixed, non persistent buffer.
+    """
+
+    def __init__(self, action_dim, action_std, learn_std=False):
+        super().__init__()
+        log_std = torch.full((action_dim,), math.log(action_std))
+        self.learn_std = learn_std
+        if learn_std:
+            self.log_std = nn.Parameter(log_std)
+        else:
+            self.register_buffer("log_std", log_std, persistent=False)
+
+    def forward(self, loc):
+        return DiagGaussian(loc, self.log_std.to(loc.dtype))
+
+
+if __name__ == "__main__":
+    # compare against MultivariateNormal and time both for 7-D actions
+    import time
+    from torch.distributions import MultivariateNormal
+
+    loc = torch.randn(4096, 7)
+    action_var = torch.full((7,), 0.7 ** 2)
+    head = DiagGaussianHead(7, 0.7)
+    actions = torch.randn(4096, 7)
+
+    def mvn():
+        return MultivariateNormal(loc, torch.diag_embed(action_var.expand_as(loc)))
+
+    diff = mvn().log_prob(actions) - head(loc).log_prob(actions)
+    print("log_prob max diff", diff.abs().max().item())
+    diff = mvn().entropy() - head(loc).entropy()
+    print("entropy max diff", diff.abs().max().item())
+
+    for name, make in (("MultivariateNormal", mvn), ("DiagGaussian", lambda: head(loc))):
+        start = time.perf_counter()
+        for _ in range(100):
+            d = make()
+            d.log_prob(d.sample())
+            d.entropy()
+        print(name, (time.perf_counter() - start) / 100 * 1e3, "ms")
@@ -0,0 +1,60 @@
+"""
+TorchScript compiled copies of the small networks on the acting path.
+"""
+import copy
+import torch
+
+
+def set_training(module, mode):
+    """
+    Sets the training flag of all submodules. Several of our models override
+    train / eval with their own training routines, so we cannot call them.
+    """
+    for m in module.modules():
+        m.training = mode
+    return module
+
+
+class InferenceModule:
+    """
+    Wraps a module with a compiled copy that is used for acting while training
+    continues on the eager module.
+
+    With freeze=True the module is traced, frozen and optimized for inference
+    (constant folding, fused linear + activation where supported), so the
+    weights are baked into the graph and refresh() has to be called after the
+    eager module was updated. refresh() only marks the graph as stale, it is
+    rebuilt on the next call, so that several updates between two calls
+    (e.g. every ICM inverse step) cost a single rebuild. With freeze=False
+    the traced module shares its parameters with the eager module, always
+    acts with the current weights and is never rebuilt. In both cases the
+    graph is traced in eval mode, i.e. without dropout.
+    """
+
+    def __init__(self, module, example_inputs, freeze=True):
+        self.module = module
+        self.example_inputs = example_inputs
+        self.freeze = freeze
+        self.compiled = None
+
+    def refresh(self):
+        if self.freeze:
+            self.compiled = None
+
+    @torch.no_grad()
+    def _compile(self):
+        if self.freeze:
+            module = set_training(copy.deepcopy(self.module), False)
+            traced = torch.jit.trace(module, self.example_inputs)
+            return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        training = self.module.training
+        set_training(self.module, False)
+        traced = torch.jit.trace(self.module, self.example_inputs)
+        set_training(self.module, training)
+        return traced
+
+    def __call__(self, *inputs):
+        if self.compiled is None:
+            self.compiled = self._compile()
+        with torch.no_grad():
+            return self.compiled(*inputs)
@@ -1,66 +1,172 @@
 import torch
+import numpy as np
 import torch.nn as nn
-import torch.functional as F
+import torch.nn.functional as F
 import torch.optim as optim
+from algo.models import EnsembleLinear
 
 device = torch.device("cuda") if torch.cuda.is_available() else torch.device(
     "cpu")
 
+MODALITIES = ("prop", "tac", "audio")
+
+
+class GroupedLinear(EnsembleLinear):
+    """
+    One linear layer per modality, evaluated as a single batched matmul on
+    the packed input [n_groups, batch, max(in_dims)]. Groups with smaller
+    dimensions are zero padded, the padded weights are zero and stay zero
+    as they never receive a gradient.
+    """
+
+    def __init__(self, in_dims, out_dims):
+        self.in_dims = list(in_dims)
+        self.out_dims = list(out_dims)
+        super().__init__(len(self.in_dims), max(self.in_dims),
+                         max(self.out_dims))
+
+    def reset_parameters(self):
+        # nn.Linear init with the fan in of every group
+        nn.init.zeros_(self.weight)
+        nn.init.zeros_(self.bias)
+        for g, (n_in, n_out) in enumerate(zip(self.in_dims, self.out_dims)):
+            bound = 1 / np.sqrt(n_in)
+            nn.init.uniform_(self.weight[g, :n_in, :n_out], -bound, bound)
+            nn.init.uniform_(self.bias[g, :, :n_out], -bound, bound)
+
+
+class GroupedCoder(nn.Module):
+    """
+    The ModalityCoders of all modalities as two GroupedLinear layers.
+    """
+
+    def __init__(self, in_dims, out_dims):
+        super().__init__()
+        self.fc1 = GroupedLinear(in_dims, out_dims)
+        self.fc2 = GroupedLinear(out_dims, out_dims)
+
+    def forward(self, x):
+        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc2(x))
+        return x
+
+
+def pack(xs, width, action=None):
+    """
+    Packs a list of per modality tensors [..., dim_g] into one zero padded
+    tensor [n_groups, N, (action_dim +) width], where N are the flattened
+    leading dimensions. The action is put in front of every group, so that
+    the inputs of all groups start at the same column.
+    """
+    lead = xs[0].shape[:-1]
+    xs = [x.reshape(-1, x.shape[-1]).float() for x in xs]
+    extra = 0 if action is None else action.shape[-1]
+    packed = xs[0].new_zeros(len(xs), xs[0].shape[0], extra + width)
+    if action is not None:
+        packed[:, :, :extra] = action.reshape(-1, extra).float()
+    for g, x in enumerate(xs):
+        packed[g, :, extra:extra + x.shape[-1]] = x
+    return packed, lead
+
+
+def unpack(packed, dims, lead):
+    """
+    Inverse of pack, returns a tuple of tensors [*lead, dim_g].
+    """
+    return tuple(packed[g, :, :dim].reshape(*lead, dim)
+                 for g, dim in enumerate(dims))
+
+
+def _stack(x):
+    return torch.stack(x) if isinstance(x, (list, tuple)) else x
+
 
 class MultiModalModule(nn.Module):
+    """
+    Multi-modal forward model. All modality encoders and decoders run as
+    grouped matmuls. Modalities with dimension 0 or None are left out, and
+    modalities missing for single samples are masked out.
+
+    Inputs are given per modality either as [batch, dim] or as sequence
+    windows [batch, T, dim]. The LSTM runs over the modality encodings of
+    all steps of a window in one call, and the next state is decoded from
+    its outputs for the last step.
+    """
     def __init__(self, action_dim, prop_dim, tac_dim, audio_dim, latent_dim,
                  lstm_hidden_size, lstm_layers):
         super().__init__()
+        dims = dict(zip(MODALITIES, (prop_dim, tac_dim, audio_dim)))
+        self.modalities = [name for name in MODALITIES if dims[name]]
+        self.dims = [dims[name] for name in self.modalities]
         self.latent_dim = latent_dim
-        self.n_mods = 3
-        self.tac_encoder = ModalityCoder(tac_dim, latent_dim)
-        self.prop_encoder = ModalityCoder(prop_dim, latent_dim)
-        self.audio_encoder = ModalityCoder(audio_dim, latent_dim)
+        self.n_mods = len(self.modalities)
+        self.encoder = GroupedCoder(self.dims, [latent_dim] * self.n_mods)
         self.shared_encoding = nn.Linear(latent_dim + action_dim, latent_dim)
         self.lstm = RecurrentModalModule(latent_dim, lstm_hidden_size,
                                          lstm_layers)
-        self.tac_decoder = ModalityCoder(lstm_hidden_size * self.n_mods,
-                                         tac_dim)
-        self.prop_decoder = ModalityCoder(lstm_hidden_size * self.n_mods,
-                                          prop_dim)
-        self.audio_decoder = ModalityCoder(lstm_hidden_size * self.n_mods,
-                                           audio_dim)
+        self.decoder = GroupedCoder([lstm_hidden_size * self.n_mods] *
+                                    self.n_mods, self.dims)
 
         self.opt = optim.Adam(self.parameters())
 
-    def forward(self, this_state, action):
-        action = torch.stack(action).float()
-        prop = self.prop_encoder(this_state[0])
-        tac = self.tac_encoder(this_state[1])
-        audio = self.audio_encoder(this_state[2])
-
-        states = [prop, tac, audio]
-        with_action = map(lambda x: torch.cat([x, action], dim=1), states)
-        shared_encoding = torch.cat(
-            list(map(self.shared_encoding, with_action)))
-        lstm_out = self.lstm(
-            shared_encoding.view(-1, self.n_mods,
-                                 self.latent_dim)).flatten(start_dim=1)
-        prop_decoded = self.prop_decoder(lstm_out)
-        tac_decoded = self.tac_decoder(lstm_out)
-        audio_decoded = self.audio_decoder(lstm_out)
-        return prop_decoded, tac_decoded, audio_decoded
-
-    def compute(self, this_state, next_state, action):
+    def forward(self, this_state, action, mask=None):
+        """
+        this_state: one tensor per modality, mask: [batch, n_mods] with 0 for
+        missing modalities. Returns the predictions per modality.
+        """
+        action = _stack(action).float()
+        packed, lead = pack(this_state, max(self.dims))
+        encoded = self.encoder(packed)
+        if mask is not None:
+            mask = mask.float().reshape(-1, self.n_mods)
+            if len(lead) > 1:
+                mask = mask.repeat_interleave(lead[1], dim=0)
+            encoded = encoded * mask.t().unsqueeze(-1)
+        action = action.reshape(1, -1, action.shape[-1])
+        shared_encoding = self.shared_encoding(
+            torch.cat([encoded, action.expand(self.n_mods, -1, -1)], dim=-1))
+
+        # [n_mods, batch * T, latent] -> [batch, T * n_mods, latent]
+        batch = lead[0]
+        sequence = shared_encoding.transpose(0, 1).reshape(
+            batch, -1, self.latent_dim)
+        lstm_out = self.lstm(sequence)[:, -self.n_mods:].flatten(start_dim=1)
+        decoded = self.decoder(lstm_out)
+        return unpack(decoded, self.dims, (batch, ))
+
+    def compute(self, this_state, next_state, action, mask=None):
         """
         Pass input of the form state: [prop, tac, audio]
         """
-        this_state = list(map(torch.cat, this_state))
-        next_state = list(map(torch.cat, next_state))
-        predicted_states = self.forward(this_state, action)
-        loss = 0
-        for i, pred_s in enumerate(predicted_states):
-            loss += F.mse_loss(pred_s, next_state[i])
+        this_state = [_stack(x).to(device) for x in this_state]
+        next_state = [_stack(x).to(device) for x in next_state]
+        # targets are the modalities after the last step of a window
+        next_state = [x[:, -1] if x.dim() > 2 else x for x in next_state]
+        predicted_states = self.forward(this_state, _stack(action).to(device),
+                                        mask)
+        loss = _masked_mse(predicted_states, next_state, mask)
+        self.opt.zero_grad()
         loss.backward()
         self.opt.step()
         return loss
 
 
+def _masked_mse(predicted, target, mask=None):
+    """
+    Sum over modalities of the mse losses, only over samples where the
+    modality is present.
+    """
+    loss = 0
+    for i, (pred_s, next_s) in enumerate(zip(predicted, target)):
+        err = ((pred_s - next_s.float())**2).mean(-1)
+        if mask is None:
+            loss += err.mean()
+        else:
+            m = mask[:, i].float()
+            loss += (err * m).sum() / m.sum().clamp(min=1)
+    return loss
+
+
 class ModalityCoder(nn.Module):
     def __init__(self, input_dim, latent_dim):
         super().__init__()
@@ -90,57 +196,62 @@ class MMAE(nn.Module):
     def __init__(self, action_dim, prop_dim, tac_dim, audio_dim, latent_dim,
                  lstm_hidden_size, lstm_layers):
         super().__init__()
+        dims = dict(zip(MODALITIES, (prop_dim, tac_dim, audio_dim)))
+        self.modalities = [name for name in MODALITIES if dims[name]]
+        self.dims = [dims[name] for name in self.modalities]
         self.latent_dim = latent_dim
-        self.n_mods = 3
-        self.tac_encoder = ModalityCoder(tac_dim + action_dim, latent_dim)
-        self.prop_encoder = ModalityCoder(prop_dim + action_dim, latent_dim)
-        self.audio_encoder = ModalityCoder(audio_dim + action_dim, latent_dim)
+        self.n_mods = len(self.modalities)
+        self.encoder = GroupedCoder([d + action_dim for d in self.dims],
+                                    [latent_dim] * self.n_mods)
         self.shared_encoding = nn.Linear(latent_dim, latent_dim)
-        self.tac_decoder = ModalityCoder(latent_dim, tac_dim)
-        self.prop_decoder = ModalityCoder(latent_dim, prop_dim)
-        self.audio_decoder = ModalityCoder(latent_dim, audio_dim)
+        self.decoder = GroupedCoder([latent_dim] * self.n_mods, self.dims)
 
         self.opt = optim.Adam(self.parameters())
 
-    def forward(self, this_state, action):
-        action = torch.stack(action).float().to(device)
-        this_state = list(
-            map(lambda x: torch.cat([x, action], dim=1), this_state))
-        prop = self.prop_encoder(this_state[0])
-        tac = self.tac_encoder(this_state[1])
-        audio = self.audio_encoder(this_state[2])
-        states = [prop, tac, audio]
+    def forward(self, this_state, action, mask=None):
+        action = _stack(action).float().to(device)
+        packed, lead = pack(this_state, max(self.dims), action)
+        states = self.encoder(packed)
+        if mask is not None:
+            states = states * mask.float().t().unsqueeze(-1)
         # with_action = list(map(lambda x: torch.cat([x, action], dim=1),
         #                        states))
-        prop_decoded = self.prop_decoder(states[0])
-        tac_decoded = self.tac_decoder(states[1])
-        audio_decoded = self.audio_decoder(states[2])
-        return prop_decoded, tac_decoded, audio_decoded
+        return unpack(self.decoder(states), self.dims, lead)
 
-    def compute(self, trans):
+    def compute(self, trans, mask=None):
         """
         Pass input of the form state: [prop, tac, audio]
         """
-        this_state = [trans.prop, trans.tac, trans.audio]
-        next_state = [trans.prop_next, trans.tac_next, trans.audio_next]
-        this_state = list(
-            map(lambda x: x.to(device), map(torch.cat, this_state)))
-        next_state = list(
-            map(lambda x: x.to(device), map(torch.cat, next_state)))
-        predicted_states = self.forward(this_state, action)
-        loss = 0
-        for i, pred_s in enumerate(predicted_states):
-            loss += F.mse_loss(pred_s, next_state[i])
+        this_state = [getattr(trans, name) for name in self.modalities]
+        next_state = [
+            getattr(trans, name + "_next") for name in self.modalities
+        ]
+        this_state = [_stack(x).to(device) for x in this_state]
+        next_state = [_stack(x).to(device) for x in next_state]
+        predicted_states = self.forward(this_state, trans.action, mask)
+        loss = _masked_mse(predicted_states, next_state, mask)
+        self.opt.zero_grad()
         loss.backward()
         self.opt.step()
         return loss
 
 
 if __name__ == "__main__":
-    model = MultiModalModule(10, 10, 10, 4, 4, 1, 2)
-    bsize = 10
-    this_state = [torch.randn(bsize, 10) for i in range(3)]
-    next_state = [torch.randn(bsize, 10) for i in range(3)]
-    action = torch.randn(bsize, 2)
-    loss = model.compute(this_state, next_state, action)
-    print(loss)
+    # training steps on the dimensions of conf/mmm.yaml
+    import time
+    from omegaconf import OmegaConf
+    cnf = OmegaConf.load("conf/mmm.yaml")
+    action_dim = 7
+    model = MultiModalModule(action_dim, **cnf.MMModel).to(device)
+    bsize = 1000
+    dims = model.dims
+    this_state = [torch.randn(bsize, d) for d in dims]
+    next_state = [torch.randn(bsize, d) for d in dims]
+    action = torch.randn(bsize, action_dim)
+    mask = torch.rand(bsize, len(dims)) > 0.1
+    for name, kwargs in (("full", {}), ("masked", {"mask": mask})):
+        start = time.perf_counter()
+        for _ in range(100):
+            loss = model.compute(this_state, next_state, action, **kwargs)
+        print(name, loss.item(),
+              (time.perf_counter() - start) / 100 * 1e3, "ms / step")
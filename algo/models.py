@@ -8,26 +8,50 @@ import numpy as np
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
+from algo.normalizer import RewardNormalizer
+from algo.inference import InferenceModule
+from algo.precision import Precision
 
 
 class ConvModule(nn.Module):
     """
     Provides thes shared convolutional base for the inverse and forward model.
+    Takes batches of images as [B, C, H, W] or, with channels_last, as
+    [B, H, W, C] which is the layout of the simulator's vision sensors. uint8
+    images are scaled to [0, 1]. If embedding_size is given the conv features
+    are projected to it, which requires the (square) image resolution.
     """
 
-    def __init__(self):
+    def __init__(
+        self, in_channels=1, resolution=None, embedding_size=None, channels_last=False
+    ):
         super().__init__()
-        self.conv1 = nn.Conv2d(1, 32, 3, stride=2, padding=1)
+        self.channels_last = channels_last
+        self.conv1 = nn.Conv2d(in_channels, 32, 3, stride=2, padding=1)
         self.conv2 = nn.Conv2d(32, 32, 3, stride=2, padding=1)
         self.conv3 = nn.Conv2d(32, 32, 3, stride=2, padding=1)
         self.conv4 = nn.Conv2d(32, 32, 3, stride=2, padding=1)
+        self.head = None
+        if embedding_size is not None:
+            size = self._conv2d_size_out(resolution, 4)
+            self.head = nn.Linear(32 * size * size, embedding_size)
 
     def forward(self, x):
+        if x.dim() == 3:
+            x = x.unsqueeze(0)
+        if x.dtype == torch.uint8:
+            x = x.float() / 255
+        if self.channels_last:
+            # NHWC -> NCHW view, the memory stays in channels last format
+            x = x.permute(0, 3, 1, 2)
         x = F.elu(self.conv1(x))
         x = F.elu(self.conv2(x))
         x = F.elu(self.conv3(x))
         x = F.elu(self.conv4(x))
-        return x.flatten()
+        x = x.flatten(start_dim=1)
+        if self.head is not None:
+            x = self.head(x)
+        return x
 
     @staticmethod
     def _conv2d_size_out(size, n_convs, kernel_size=3, stride=2, padding=1):
@@ -74,6 +98,12 @@ class ForwardModule(nn.Module):
     def forward(self, x, a):
         with torch.no_grad():
             x = self.base(x)
+        return self.predict(x, a)
+
+    def predict(self, x, a):
+        """
+        Predicts the next state embedding from an already embedded state.
+        """
         x = torch.cat([x, a], dim=1)
         x = F.relu(self.l1(x))
         if self.n_layers > 1:
@@ -86,6 +116,70 @@ class ForwardModule(nn.Module):
         return x
 
 
+class EnsembleLinear(nn.Module):
+    """
+    A stack of independent linear layers evaluated with one batched matrix
+    multiply. Takes inputs of shape [n_members, batch, in_features] or
+    [batch, in_features], in which case the batch is shared by all members.
+    """
+
+    def __init__(self, n_members, in_features, out_features):
+        super().__init__()
+        self.n_members = n_members
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(torch.empty(n_members, in_features, out_features))
+        self.bias = nn.Parameter(torch.empty(n_members, 1, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same init as nn.Linear, drawn independently for every member
+        bound = 1 / np.sqrt(self.in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        if x.dim() == 2:
+            x = x.expand(self.n_members, *x.shape)
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+class EnsembleForwardModule(nn.Module):
+    """
+    Ensemble of forward models state x action -> next state. The members are
+    stored as stacked weights so that the whole ensemble costs one batched
+    matmul per layer. The variance of the members' predictions is used as
+    disagreement-based intrinsic reward, see ICModule._train_ensemble.
+    """
+
+    def __init__(
+        self, embedding_size, action_dim, base, n_members, n_layers=2, hidden=512
+    ):
+        super().__init__()
+        self.base = base
+        self.n_members = n_members
+        layers = [EnsembleLinear(n_members, embedding_size + action_dim, hidden)]
+        for _ in range(n_layers - 1):
+            layers.append(EnsembleLinear(n_members, hidden, hidden))
+        self.layers = nn.ModuleList(layers)
+        self.head = EnsembleLinear(n_members, hidden, embedding_size)
+
+    def forward(self, x, a):
+        with torch.no_grad():
+            x = self.base(x)
+        return self.predict(x, a)
+
+    def predict(self, x, a):
+        """
+        Predicts the next state embedding from an already embedded state.
+        Returns a tensor of shape [n_members, batch, embedding_size].
+        """
+        x = torch.cat([x, a], dim=-1)
+        for layer in self.layers:
+            x = F.relu(layer(x))
+        return self.head(x)
+
+
 class InverseModule(nn.Module):
     """
     Module for learning the inverse mapping of state x next state -> action.
@@ -125,10 +219,7 @@ class InverseModule(nn.Module):
         #    x = x.unsqueeze(0)
         # if y.dim() == 1:
         #    y = y.unsqueeze(0)
-        if x.dim() > 1:
-            x = torch.cat([x, y], dim=1)
-        else:
-            x = torch.cat([x, y], dim=0)
+        x = torch.cat([x, y], dim=-1)
         # x = self.linear_only(x)
         x = self.drop1(F.relu(self.linear(x)))
         # x = self.drop2(F.relu(self.linear2(x)))
@@ -173,38 +264,61 @@ class ICModule(nn.Module):
         n_layers,
         lr,
         standardize_loss,
+        ensemble_size=1,
+        beta=0.2,
+        normalization="scalar",
+        encoder="fc",
+        precision="fp32",
+        n_envs=1,
     ):
         super().__init__()
-        # self._conv_base = ConvModule()
         self.device = device
-        self.base = FCModule(state_dim, embedding_size)
+        self.precision = Precision(precision, torch.device(device).type)
+        self.encoder = encoder
+        if encoder == "conv":
+            # state_dim is the image shape (H, W, C) of Env.get_vision_state.
+            # The conv encoder is trained through the inverse model, which
+            # then works on embeddings instead of raw states.
+            if isinstance(state_dim, int):
+                raise TypeError(
+                    "the conv encoder needs the image shape (H, W, C) as state_dim"
+                )
+            height, _, channels = state_dim
+            self.base = ConvModule(
+                channels, height, embedding_size, channels_last=True
+            )
+        else:
+            self.base = FCModule(state_dim, embedding_size)
 
         # define forward and inverse modules
         self._inverse = InverseModule(
             embedding_size, action_dim, self.base, self.device
         )
 
-        self._forward = ForwardModule(embedding_size, action_dim, self.base, n_layers)
+        self.ensemble_size = ensemble_size
+        if ensemble_size > 1:
+            self._forward = EnsembleForwardModule(
+                embedding_size, action_dim, self.base, ensemble_size, n_layers
+            )
+        else:
+            self._forward = ForwardModule(
+                embedding_size, action_dim, self.base, n_layers
+            )
 
+        self._params = None
         self.opt = optim.Adam(self.parameters(), lr=lr)
-        self.running_return_std = None
         self.alpha = alpha
+        # weighting of forward vs. inverse loss in the joint update
+        self.beta = beta
 
-        # reward normalization
-        self.running_mean = 0
-        self.running_var = 0
+        # reward normalization, statistics are exponentially weighted by alpha
+        self.reward_normalizer = RewardNormalizer(
+            normalization, embedding_size, momentum=alpha, n_envs=n_envs
+        )
         self.standardize_loss = standardize_loss
 
-    def _update_running_stats(self, reward):
-        """
-        Updates the exponentially weighted averages of variance and mean of the reward.
-        This is used to z-score the reward from the ICM.
-        """
-        self.running_var = (1 - self.alpha) * self.running_var + self.alpha * (
-            self.running_mean - reward
-        ) ** 2
-
-        self.running_mean = (1 - self.alpha) * self.running_mean + self.alpha * reward
+        # compiled copy of the inverse model used for acting
+        self._inverse_infer = None
 
     def forward(self, x):
         raise NotImplementedError
@@ -216,17 +330,22 @@ class ICModule(nn.Module):
         self._inverse.load_state_dict(
             torch.load(state_dict, map_location=torch.device("cpu")),
         )
+        self._refresh_inference()
 
     def parameters(self):
         """
         Returns all parameters of the ICModule, removing unnecessary weights
-        from base network.
+        from the fc base network, which is not trained. A conv base is trained
+        by the inverse loss as in the ICM paper. The list is collected once
+        and cached.
         """
-        params = []
-        for name, param in self.named_parameters():
-            if "base" not in name:
-                params.append(param)
-        return params
+        if self._params is None:
+            self._params = [
+                param
+                for name, param in self.named_parameters()
+                if self.encoder == "conv" or "base" not in name
+            ]
+        return self._params
 
     def embed(self, state):
         """
@@ -245,59 +364,186 @@ class ICModule(nn.Module):
     def next_state(self, state, action):
         """
         Given state and action, predicts the next state in embedding space.
+        For an ensemble the mean prediction of all members is returned.
         """
+        if self.ensemble_size > 1:
+            return self._forward(state, action).mean(dim=0)
         return self._forward(state, action)
 
+    def compile_inference(self, freeze=True):
+        """
+        Computes inverse actions with a TorchScript compiled copy of the
+        inverse model from now on. It is refreshed after every inverse update.
+        """
+        example = torch.zeros(1, self._inverse.linear.in_features // 2)
+        example = example.to(self.device)
+        self._inverse_infer = InferenceModule(
+            self._inverse, (example, example), freeze=freeze
+        )
+
+    def _refresh_inference(self):
+        if self._inverse_infer is not None:
+            self._inverse_infer.refresh()
+
     def get_action(self, this_state, next_state):
-        this_state = torch.tensor(this_state).float()
-        next_state = torch.tensor(next_state).float()
+        this_state = self._to_tensor(this_state)
+        next_state = self._to_tensor(next_state)
+        if self.encoder == "conv":
+            with torch.no_grad():
+                this_state, next_state = self._inverse_inputs(this_state, next_state)
+        if self._inverse_infer is not None:
+            return self._inverse_infer(this_state, next_state)
         return self._inverse(this_state, next_state)
 
+    def _to_tensor(self, x):
+        """
+        Converts a batch given as tensor, sequence of tensors or sequence of
+        arrays into a single float tensor on the device of the module.
+        """
+        if not isinstance(x, torch.Tensor):
+            if len(x) and isinstance(x[0], torch.Tensor):
+                x = torch.stack(x)
+            else:
+                x = torch.from_numpy(np.array(x))
+        # images stay uint8 until they enter the conv encoder
+        if x.dtype == torch.uint8:
+            return x.to(self.device)
+        return x.float().to(self.device)
+
+    def _inverse_inputs(self, this_state, next_state):
+        """
+        The inverse model works on raw vector states and on the embeddings of
+        images, which are recorded for the gradient of the conv encoder.
+        """
+        if self.encoder == "conv":
+            return self.embed(this_state), self.embed(next_state)
+        return this_state, next_state
+
+    def _embed_pair(self, this_state, next_state):
+        """
+        Embeds state and next state. The base is not trained so no graph is
+        recorded for it.
+        """
+        with torch.no_grad():
+            return self.embed(this_state), self.embed(next_state)
+
+    def _forward_loss(self, state_embed, next_state_embed, action):
+        """
+        Returns the training loss of the forward model and the (per dimension)
+        intrinsic reward derived from it.
+        """
+        if self.ensemble_size > 1:
+            return self._train_ensemble(state_embed, next_state_embed, action)
+        with self.precision.autocast():
+            next_state_embed_pred = self._forward.predict(state_embed, action)
+        loss = F.mse_loss(
+            next_state_embed_pred.float(), next_state_embed, reduction="none"
+        )
+        return loss, loss
+
+    def _process_reward(self, reward):
+        reward = reward.detach()
+        self.reward_normalizer.update(reward)
+
+        if self.standardize_loss:
+            loss = self.reward_normalizer.normalize(reward)
+        else:
+            loss = reward.mean(dim=1)
+
+        # TODO: RESTORE THE ORIGINAL HERE AFTER REMOVING THE
+        # CONSTANT NORMALIZATION OF THE OBSERVATION
+        # return loss.mean(dim=1).detach() / 2.5
+        return loss
+
     def train_forward(self, this_state, next_state, action, freeze=False, eval=False):
-        action = torch.stack(action).float().to(self.device)
-        this_state = torch.tensor(this_state).float().to(self.device)
-        next_state = torch.tensor(next_state).float().to(self.device)
+        action = self._to_tensor(action)
+        this_state = self._to_tensor(this_state)
+        next_state = self._to_tensor(next_state)
 
         if not freeze:
             self.opt.zero_grad()
 
-        next_state_embed_pred = self.next_state(this_state, action)
-        next_state_embed_true = self.embed(next_state)
-
-        loss = F.mse_loss(
-            next_state_embed_pred, next_state_embed_true, reduction="none"
-        )
+        state_embed, next_state_embed = self._embed_pair(this_state, next_state)
+        loss, reward = self._forward_loss(state_embed, next_state_embed, action)
 
         if not freeze:
             if not eval:
                 loss.mean().backward()
                 self.opt.step()
 
-        self._update_running_stats(loss.mean().item())
-        loss = loss.mean(dim=1).detach()
+        return self._process_reward(reward)
 
-        if self.standardize_loss:
-            loss = (loss - self.running_mean) / (np.sqrt(self.running_var) + 0.001)
+    def train_joint(self, this_state, next_state, action, eval=False):
+        """
+        Trains forward and inverse model in a single update. States are
+        converted and embedded once, both losses are combined as in the ICM
+        paper, (1 - beta) * inverse_loss + beta * forward_loss, and one
+        optimizer step is taken. Returns the (processed) forward reward and
+        the inverse loss per transition.
+        """
+        action = self._to_tensor(action)
+        this_state = self._to_tensor(this_state)
+        next_state = self._to_tensor(next_state)
 
-        # TODO: RESTORE THE ORIGINAL HERE AFTER REMOVING THE
-        # CONSTANT NORMALIZATION OF THE OBSERVATION
-        # return loss.mean(dim=1).detach() / 2.5
-        return loss
+        self.opt.zero_grad()
+
+        iv_inputs = self._inverse_inputs(this_state, next_state)
+        if self.encoder == "conv":
+            # the forward loss does not train the encoder
+            state_embed, next_state_embed = (x.detach() for x in iv_inputs)
+        else:
+            state_embed, next_state_embed = self._embed_pair(this_state, next_state)
+        fw_loss, fw_reward = self._forward_loss(state_embed, next_state_embed, action)
+
+        with self.precision.autocast():
+            predicted_action = self._inverse(*iv_inputs)
+        iv_loss = F.mse_loss(predicted_action.float(), action, reduction="none")
+
+        if not eval:
+            loss = (1 - self.beta) * iv_loss.mean() + self.beta * fw_loss.mean()
+            loss.backward()
+            self.opt.step()
+            self._refresh_inference()
+
+        return self._process_reward(fw_reward), iv_loss.mean(dim=1).detach()
+
+    def _train_ensemble(self, state_embed, next_state_embed, action):
+        """
+        Computes the loss of every ensemble member on its own bootstrap
+        resample of the batch. Instead of gathering the resamples, all members
+        predict the original batch and every transition's loss is weighted by
+        how often it was drawn for the member, which gives the same mean loss.
+        The same predictions give the reward, the disagreement (variance) of
+        the members.
+        """
+        n, batch_size = self.ensemble_size, state_embed.shape[0]
+        idx = torch.randint(batch_size, (n, batch_size), device=state_embed.device)
+        counts = torch.zeros(n, batch_size, device=state_embed.device)
+        counts.scatter_add_(1, idx, torch.ones_like(counts))
+
+        with self.precision.autocast():
+            prediction = self._forward.predict(state_embed, action).float()
+        loss = counts[..., None] * F.mse_loss(
+            prediction, next_state_embed.expand_as(prediction), reduction="none"
+        )
+        reward = prediction.detach().var(dim=0)
+        return loss, reward
 
     def train_inverse(self, this_state, next_state, action, eval=False):
-        # TODO: REVERT THIS
-        # action = torch.stack(action).float().to(self.device)
-        ########################
-        this_state = torch.tensor(this_state).float().to(self.device)
-        next_state = torch.tensor(next_state).float().to(self.device)
+        action = self._to_tensor(action)
+        this_state = self._to_tensor(this_state)
+        next_state = self._to_tensor(next_state)
 
         self.opt.zero_grad()
 
-        predicted_action = self._inverse(this_state, next_state)
-        loss = F.mse_loss(predicted_action, action, reduction="none")
+        iv_inputs = self._inverse_inputs(this_state, next_state)
+        with self.precision.autocast():
+            predicted_action = self._inverse(*iv_inputs)
+        loss = F.mse_loss(predicted_action.float(), action, reduction="none")
         if not eval:
             loss.mean().backward()
             self.opt.step()
+            self._refresh_inference()
         return loss.mean(dim=1).detach()
 
     # def train_inverse(self, this_state, next_state, action, eval=False):
@@ -306,17 +552,6 @@ class ICModule(nn.Module):
     #     else:
     #         return self._inverse.train(this_state, next_state, action)
 
-    def _process_loss(self, loss):
-        self.loss_buffer.push(loss)
-        return_std = self.loss_buffer.get_std()
-        if self.running_return_std is not None:
-            self.running_return_std = (
-                self.alpha * return_std + (1 - self.alpha) * self.running_return_std
-            )
-        else:
-            self.running_return_std = return_std
-        return loss / self.running_return_std
-
     def save_state(self, path):
         print("icm saving sate to path", path)
         torch.save(self.state_dict(), os.path.join(path, "icm.pt"))
@@ -326,3 +561,5 @@ class ICModule(nn.Module):
         print("icm loading state from path", path)
         self.load_state_dict(torch.load(os.path.join(path, "icm.pt")))
         self.opt.load_state_dict(torch.load(os.path.join(path, "icm_opt.pt")))
+        self._refresh_inference()
+
@@ -0,0 +1,119 @@
+"""
+Running statistics used to normalize intrinsic rewards. The return based
+normalization follows https://arxiv.org/abs/1810.12894 (RND).
+"""
+import torch
+import torch.nn as nn
+from algo.returns import discounted_cumsum
+
+
+class RunningMeanStd(nn.Module):
+    """
+    Tracks mean and variance of a stream of tensors. The statistics are kept
+    as buffers so they never leave the device and end up in the state dict.
+    With momentum=None the moments are exact (parallel algorithm by Chan et
+    al.), otherwise they are exponentially weighted with the given momentum.
+    """
+
+    def __init__(self, shape=(), momentum=None, epsilon=1e-4):
+        super().__init__()
+        self.momentum = momentum
+        self.epsilon = epsilon
+        self.register_buffer("mean", torch.zeros(shape))
+        self.register_buffer("var", torch.ones(shape))
+        self.register_buffer("count", torch.tensor(epsilon))
+
+    @torch.no_grad()
+    def update(self, x):
+        """
+        Updates the moments from a tensor of shape [..., *shape]. All leading
+        dimensions are treated as samples.
+        """
+        x = x.detach().to(self.mean).reshape(-1, *self.mean.shape)
+        batch_count = x.shape[0]
+        batch_mean = x.mean(dim=0)
+        batch_var = x.var(dim=0, unbiased=False)
+        delta = batch_mean - self.mean
+
+        if self.momentum is not None:
+            m = self.momentum
+            self.mean.add_(m * delta)
+            self.var.copy_((1 - m) * (self.var + m * delta ** 2) + m * batch_var)
+        else:
+            total = self.count + batch_count
+            m2 = (
+                self.var * self.count
+                + batch_var * batch_count
+                + delta ** 2 * self.count * batch_count / total
+            )
+            self.mean.add_(delta * batch_count / total)
+            self.var.copy_(m2 / total)
+        self.count.add_(batch_count)
+
+    @property
+    def std(self):
+        return self.var.sqrt()
+
+    def normalize(self, x):
+        return (x - self.mean) / (self.std + 1e-3)
+
+
+class RewardNormalizer(nn.Module):
+    """
+    Normalizes the per-dimension prediction error of the ICM into a reward
+    per transition. Supported modes:
+        scalar: z-scores the reward with statistics over all transitions
+        dim:    z-scores every embedding dimension separately before averaging
+        return: divides the reward by the std of the running discounted
+                return, as done in RND
+    Rewards for the return mode are expected in time order, flattened from
+    [T, n_envs] like the rollouts of agent.Agent. Every env keeps its own
+    running return.
+    """
+
+    modes = ("scalar", "dim", "return")
+
+    def __init__(self, mode="scalar", dim=1, momentum=None, gamma=0.99, n_envs=1):
+        super().__init__()
+        if mode not in self.modes:
+            raise ValueError(f"unknown normalization mode {mode}")
+        self.mode = mode
+        self.gamma = gamma
+        self.stats = RunningMeanStd((dim,) if mode == "dim" else (), momentum)
+        # running discounted return per env carried over between batches
+        self.register_buffer("ret", torch.zeros(n_envs))
+
+    def _returns(self, reward):
+        reward = reward.reshape(-1, self.ret.shape[0])
+        # R_t = r_t + gamma * R_{t-1} runs forward in time, discounted_cumsum
+        # solves the same recurrence backward, so time is flipped around it
+        x = reward.clone()
+        x[0] += self.gamma * self.ret
+        discounts = torch.full_like(x, self.gamma)
+        returns = discounted_cumsum(x.flip(0), discounts).flip(0)
+        self.ret.copy_(returns[-1])
+        return returns
+
+    @torch.no_grad()
+    def update(self, reward):
+        """
+        Updates the statistics from a reward tensor of shape [batch, dim].
+        """
+        if self.mode == "dim":
+            self.stats.update(reward)
+        elif self.mode == "scalar":
+            self.stats.update(reward.mean(dim=1))
+        else:
+            self.stats.update(self._returns(reward.mean(dim=1)))
+
+    @torch.no_grad()
+    def normalize(self, reward):
+        """
+        Maps a reward tensor of shape [batch, dim] to normalized rewards of
+        shape [batch].
+        """
+        if self.mode == "dim":
+            return self.stats.normalize(reward).mean(dim=1)
+        if self.mode == "scalar":
+            return self.stats.normalize(reward.mean(dim=1))
+        return reward.mean(dim=1) / (self.stats.std + 1e-3)
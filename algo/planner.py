@@ -0,0 +1,129 @@
+"""
+Model predictive control on top of a learned forward model. Candidate
+action sequences are rolled out through the model as one batch per step of
+the horizon, scored against a goal and refined with CEM or MPPI.
+"""
+import time
+import torch
+
+
+def goal_reward(states, goal):
+    """
+    Batched version of the compute_reward metric of the icdl experiments,
+    -||state - goal||^2 / 100 for states [..., dim].
+    """
+    return -((states - goal) ** 2).sum(-1) / 100
+
+
+class MPCPlanner:
+    """
+    Plans with a dynamics model (states [N, S], actions [N, A]) -> next states,
+    e.g. inverse_model.FWModel or ICModule.next_state. With delta the model
+    predicts the change of the state. With embed, states and goal are mapped
+    into the space of the model first (e.g. ICModule.base).
+
+    Every call of plan samples n_samples action sequences of length horizon
+    around the current mean, scores them by the summed goal_reward of the
+    predicted states and refits mean and std, n_iters times. method "cem"
+    refits to the n_elites best sequences, "mppi" to all sequences weighted
+    by softmax(return / temperature). The first action of the mean is
+    executed and the remaining mean is shifted by one step to warm start the
+    next call. Call reset at the start of every episode.
+    """
+
+    def __init__(
+        self,
+        dynamics,
+        action_dim,
+        horizon=10,
+        n_samples=1000,
+        n_iters=5,
+        n_elites=100,
+        method="cem",
+        temperature=1.0,
+        init_std=0.5,
+        min_std=0.05,
+        momentum=0.1,
+        max_action=1,
+        delta=False,
+        embed=None,
+        device="cpu",
+    ):
+        if method not in ("cem", "mppi"):
+            raise ValueError(f"unknown planning method {method}")
+        self.dynamics = dynamics
+        self.action_dim = action_dim
+        self.horizon = horizon
+        self.n_samples = n_samples
+        self.n_iters = n_iters
+        self.n_elites = n_elites
+        self.method = method
+        self.temperature = temperature
+        self.init_std = init_std
+        self.min_std = min_std
+        self.momentum = momentum
+        self.max_action = max_action
+        self.delta = delta
+        self.embed = embed
+        self.device = torch.device(device)
+        self.plan_time = 0
+        self.reset()
+
+    def reset(self):
+        self.mean = torch.zeros(self.horizon, self.action_dim, device=self.device)
+
+    def _to_tensor(self, x):
+        return torch.as_tensor(x, dtype=torch.float32, device=self.device)
+
+    def rollout(self, state, goal, actions):
+        """
+        Returns the summed goal rewards [N] of action sequences [N, H, A]
+        from a single state.
+        """
+        states = state.expand(len(actions), -1)
+        returns = torch.zeros(len(actions), device=self.device)
+        for t in range(actions.shape[1]):
+            prediction = self.dynamics(states, actions[:, t]).float()
+            states = states + prediction if self.delta else prediction
+            returns += goal_reward(states, goal)
+        return returns
+
+    def _refit(self, actions, returns):
+        if self.method == "cem":
+            elites = actions[returns.topk(self.n_elites).indices]
+            return elites.mean(0), elites.std(0)
+        weights = torch.softmax((returns - returns.max()) / self.temperature, 0)
+        weights = weights[:, None, None]
+        mean = (weights * actions).sum(0)
+        std = (weights * (actions - mean) ** 2).sum(0).sqrt()
+        return mean, std
+
+    @torch.no_grad()
+    def plan(self, state, goal):
+        """
+        Returns the action to execute in state to approach goal, as numpy.
+        """
+        start = time.time()
+        state = self._to_tensor(state).reshape(1, -1)
+        goal = self._to_tensor(goal).reshape(1, -1)
+        if self.embed is not None:
+            state, goal = self.embed(state), self.embed(goal)
+
+        mean = self.mean
+        std = torch.full_like(mean, self.init_std)
+        shape = (self.n_samples, self.horizon, self.action_dim)
+        for _ in range(self.n_iters):
+            noise = torch.randn(shape, device=self.device)
+            actions = (mean + std * noise).clamp(-self.max_action, self.max_action)
+            # the current mean is always a candidate
+            actions[0] = mean
+            returns = self.rollout(state, goal, actions)
+            new_mean, new_std = self._refit(actions, returns)
+            mean = self.momentum * mean + (1 - self.momentum) * new_mean
+            std = self.momentum * std + (1 - self.momentum) * new_std
+            std = std.clamp(min=self.min_std)
+
+        # warm start: the rest of the plan, followed by a zero action
+        self.mean = torch.cat([mean[1:], torch.zeros_like(mean[:1])])
+        self.plan_time = time.time() - start
+        return mean[0].cpu().numpy()
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from torch.distributions import Categorical
 import gym
+from algo.returns import discounted_returns
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
@@ -88,19 +89,16 @@ class PPO:
 
     def update(self, memory):
         # Monte Carlo estimate of state rewards:
-        rewards = []
-        discounted_reward = 0
+        rewards = torch.tensor(memory.rewards, dtype=torch.float32).to(device)
+        is_terminals = torch.tensor(memory.is_terminals,
+                                    dtype=torch.float32).to(device)
         # bootstrap from value function
-        memory.rewards[-1] = self.policy_old.value_layer(memory.states[-1])
-        for reward, is_terminal in zip(reversed(memory.rewards),
-                                       reversed(memory.is_terminals)):
-            if is_terminal:
-                discounted_reward = 0
-            discounted_reward = reward + (self.gamma * discounted_reward)
-            rewards.insert(0, discounted_reward)
+        with torch.no_grad():
+            rewards[-1] = self.policy_old.value_layer(
+                memory.states[-1]).squeeze()
+        rewards = discounted_returns(rewards, is_terminals, self.gamma)
 
         # Normalizing the rewards:
-        rewards = torch.tensor(rewards).to(device)
         rewards = (rewards - rewards.mean()) / (rewards.std() + 1e-5)
 
         # convert list to tensor
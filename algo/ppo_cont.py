@@ -1,24 +1,145 @@
 import os
 import torch
 import torch.nn as nn
-from torch.distributions import MultivariateNormal
+from algo.distributions import DiagGaussianHead
+from algo.inference import InferenceModule
+from algo.precision import Precision
+from algo.returns import discounted_returns, gae
 
 
-class Memory:
-    def __init__(self):
-        self.actions = []
-        self.states = []
-        self.logprobs = []
-        self.rewards = []
-        self.is_terminals = []
+def mix_actions(action, inverse_action, alpha):
+    """
+    Blends policy actions with inverse model actions, (1 - alpha) * action +
+    alpha * inverse_action, and rescales every action whose largest component
+    leaves [-1, 1] back onto the box. Works on [action_dim] and [N, action_dim].
+    """
+    action = (1 - alpha) * action + alpha * inverse_action.detach()
+    return action / action.abs().amax(-1, keepdim=True).clamp(min=1)
+
+
+def _shape(dim):
+    return tuple(dim) if isinstance(dim, (tuple, list)) else (dim,)
+
+
+class RolloutBuffer:
+    """
+    Rollout storage for PPO. Every field is a preallocated tensor of shape
+    [capacity, n_envs, ...]. Fields are appended to independently, one step
+    at a time, by writing into the next free row in place; reading a field
+    returns a view of its filled rows. When a field runs out of rows the
+    capacity is doubled.
+
+    states are the inputs of the policy, observations / next_observations
+    and transition_actions are the raw env transitions for the ICM (for goal
+    based agents the states contain the goal as well). values and
+    intrinsic_rewards are set for the whole rollout at training time.
+    Observations can be stored as uint8 images with obs_dtype=torch.uint8.
+    """
+
+    # per step scalars that are read for the whole rollout, zeroed on clear
+    scalar_fields = ("values", "rewards", "intrinsic_rewards", "is_terminals")
+
+    def __init__(
+        self,
+        state_dim,
+        action_dim,
+        obs_dim=None,
+        capacity=500,
+        n_envs=1,
+        device="cpu",
+        obs_dtype=torch.float32,
+    ):
+        obs_dim = state_dim if obs_dim is None else obs_dim
+        self.shapes = dict(
+            states=_shape(state_dim),
+            actions=_shape(action_dim),
+            logprobs=(),
+            values=(),
+            rewards=(),
+            intrinsic_rewards=(),
+            is_terminals=(),
+            observations=_shape(obs_dim),
+            next_observations=_shape(obs_dim),
+            transition_actions=_shape(action_dim),
+        )
+        self.dtypes = dict.fromkeys(self.shapes, torch.float32)
+        self.dtypes["observations"] = obs_dtype
+        self.dtypes["next_observations"] = obs_dtype
+        self.capacity = capacity
+        self.n_envs = n_envs
+        self.device = device
+        self._data = {
+            name: torch.zeros(
+                capacity, n_envs, *shape, dtype=self.dtypes[name], device=device
+            )
+            for name, shape in self.shapes.items()
+        }
+        self._len = dict.fromkeys(self.shapes, 0)
+
+    def __getattr__(self, name):
+        if name in self.__dict__.get("shapes", {}):
+            return self.get(name)
+        raise AttributeError(name)
+
+    def __len__(self):
+        return self._len["states"]
+
+    def _grow(self, capacity):
+        for name, data in self._data.items():
+            grown = data.new_zeros(capacity, *data.shape[1:])
+            grown[: self.capacity] = data
+            self._data[name] = grown
+        self.capacity = capacity
+
+    def append(self, name, value):
+        """
+        Writes the next step of a field. value has shape [n_envs, ...] or,
+        for a single env, the shape of one entry.
+        """
+        idx = self._len[name]
+        if idx == self.capacity:
+            self._grow(2 * self.capacity)
+        value = torch.as_tensor(value).reshape(self.n_envs, *self.shapes[name])
+        self._data[name][idx].copy_(value)
+        self._len[name] = idx + 1
+
+    def set(self, name, value):
+        """
+        Sets a field for the whole rollout from a tensor of shape
+        [T, n_envs, ...] or [T * n_envs, ...].
+        """
+        value = torch.as_tensor(value).reshape(-1, self.n_envs, *self.shapes[name])
+        length = value.shape[0]
+        if length > self.capacity:
+            self._grow(max(length, 2 * self.capacity))
+        self._data[name][:length].copy_(value)
+        self._len[name] = length
+
+    def get(self, name):
+        """
+        Returns a view of the filled rows of a field, [T, n_envs, ...].
+        """
+        return self._data[name][: self._len[name]]
+
+    def padded(self, name):
+        """
+        Returns a scalar field for all len(self) steps, zero where unset.
+        """
+        return self._data[name][: len(self)]
+
+    def total_rewards(self):
+        """
+        The rewards PPO is trained on. Intrinsic rewards, when they were set
+        for the rollout, replace the extrinsic ones.
+        """
+        if self._len["intrinsic_rewards"]:
+            return self.padded("intrinsic_rewards")
+        return self.padded("rewards")
 
     def clear_memory(self):
-        del self.actions[:]
-        del self.states[:]
-        del self.logprobs[:]
-        # del self.rewards[:]
-        self.rewards = []
-        del self.is_terminals[:]
+        for name in self.scalar_fields:
+            self._data[name].zero_()
+        self._len = dict.fromkeys(self.shapes, 0)
 
 
 class ActorCritic(nn.Module):
@@ -31,11 +152,13 @@ class ActorCritic(nn.Module):
         action_std,
         device,
         alpha,
+        learn_std=False,
     ):
         super(ActorCritic, self).__init__()
         self.alpha = alpha
         self.device = device
         self.action_dim = action_dim
+        self.state_dim = state_dim
         self.max_action = max_action
         self.actor = nn.Sequential(
             nn.Linear(state_dim, n_latent_var),
@@ -53,9 +176,11 @@ class ActorCritic(nn.Module):
             nn.ReLU(),
             nn.Linear(n_latent_var, 1),
         )
-        self.action_var = torch.full((action_dim,), action_std * action_std).to(
-            self.device
-        )
+        self.action_head = DiagGaussianHead(action_dim, action_std, learn_std)
+        # compiled copy of the actor used for acting, see compile_inference
+        self.actor_infer = None
+        # precision of the forward passes during updates
+        self.precision = Precision()
 
     def action_layer_cont(self, x):
         x = self.action_layer(x)
@@ -68,43 +193,65 @@ class ActorCritic(nn.Module):
     def get_value(self, state):
         return self.critic(torch.tensor(state).float().to(self.device))
 
+    def compile_inference(self, freeze=True):
+        """
+        Acts with a TorchScript compiled copy of the actor from now on.
+        """
+        example = torch.zeros(1, self.state_dim, device=self.device)
+        self.actor_infer = InferenceModule(self.actor, example, freeze=freeze)
+
+    def refresh_inference(self):
+        if self.actor_infer is not None:
+            self.actor_infer.refresh()
+
     def act(self, state, memory, inverse_action=None):
-        state = torch.from_numpy(state).float().to(self.device)
-        action_mean = self.actor(state)
+        """
+        Samples actions for a single state [state_dim] or a batch of states
+        [N, state_dim], one per env of the rollout buffer, and records them
+        in *memory*. Returns the actions, the action means and the mean
+        entropy.
+        """
+        state = torch.as_tensor(state, dtype=torch.float32, device=self.device)
+        if self.actor_infer is not None:
+            action_mean = self.actor_infer(state)
+        else:
+            with torch.no_grad():
+                action_mean = self.actor(state)
         # print(action_mean)
-        cov_mat = torch.diag(self.action_var).to(self.device)
-
-        dist = MultivariateNormal(action_mean, cov_mat)
+        dist = self.action_head(action_mean)
         action = dist.sample()
 
         if inverse_action is not None:
-            action = (1 - self.alpha) * action + self.alpha * inverse_action.detach()
-            if (action.abs() > 1).any():
-                action = action / action.abs().max()
-        action_logprob = dist.log_prob(action)
-        entropy = dist.entropy()
+            action = mix_actions(action, inverse_action.to(action), self.alpha)
+        with torch.no_grad():
+            action_logprob = dist.log_prob(action)
+            entropy = dist.entropy()
 
-        memory.states.append(state)
-        memory.actions.append(action)
-        memory.logprobs.append(action_logprob)
+        memory.append("states", state)
+        memory.append("actions", action)
+        memory.append("logprobs", action_logprob)
 
         # action += torch.randn(self.action_dim) * 0.1
 
-        return (action.detach(), action_mean.detach().cpu().numpy(), entropy.item())
+        return (
+            action.detach(),
+            action_mean.detach().cpu().numpy(),
+            entropy.mean().item(),
+        )
 
     def evaluate(self, state, action):
-        action_mean = self.actor(state)
-
-        action_var = self.action_var.expand_as(action_mean)
-        cov_mat = torch.diag_embed(action_var).to(self.device)
+        with self.precision.autocast():
+            action_mean = self.actor(state)
+            state_value = self.critic(state)
+        action_mean = action_mean.float()
+        state_value = state_value.float()
 
-        dist = MultivariateNormal(action_mean, cov_mat)
+        dist = self.action_head(action_mean)
 
         action_logprobs = dist.log_prob(action)
         dist_entropy = dist.entropy()
-        state_value = self.critic(state)
 
-        return action_logprobs, torch.squeeze(state_value), dist_entropy
+        return action_logprobs, state_value.squeeze(-1), dist_entropy
 
 
 class PPO:
@@ -122,12 +269,27 @@ class PPO:
         eps_clip,
         max_action,
         action_std,
+        precision="fp32",
+        lam=1.0,
+        learn_std=False,
+        minibatch_size=None,
+        target_kl=None,
+        norm_advantages=False,
     ):
         self.lr = lr
         self.betas = betas
         self.gamma = gamma
+        # lambda of GAE, with 1 the advantages are returns - values
+        self.lam = lam
         self.eps_clip = eps_clip
         self.K_epochs = K_epochs
+        # smallest size of the shuffled minibatches of each epoch, None for
+        # full batch
+        self.minibatch_size = minibatch_size
+        # stop the epochs early once the approximate KL to the rollout policy
+        # exceeds 1.5 * target_kl, None to always run K_epochs
+        self.target_kl = target_kl
+        self.norm_advantages = norm_advantages
 
         self.device = device
 
@@ -139,90 +301,115 @@ class PPO:
             action_std,
             self.device,
             alpha,
+            learn_std,
         ).to(self.device)
+        self.policy.precision = Precision(precision, torch.device(device).type)
 
         self.optimizer = torch.optim.Adam(self.policy.parameters(), lr=lr, betas=betas)
 
-        self.policy_old = ActorCritic(
-            action_dim,
-            state_dim,
-            n_latent_var,
-            max_action,
-            action_std,
-            self.device,
-            alpha,
-        ).to(self.device)
-
-        self.policy_old.load_state_dict(self.policy.state_dict())
-
         self.MseLoss = nn.MSELoss()
 
+    @property
+    def policy_old(self):
+        """
+        The policy that collected the rollout. Acting and updating alternate
+        and the behaviour log probabilities are stored at acting time, so this
+        is the current policy and no second copy is kept.
+        """
+        return self.policy
+
     def get_value(self, state):
-        return self.policy_old.get_value(state).item()
+        with torch.no_grad():
+            return self.policy.get_value(state).item()
 
     def update(self, memory):
-        # Monte Carlo estimate of state rewards:
-        rewards = []
-        discounted_reward = self.policy.critic(memory.states[-1])
-
-        for reward, is_terminal in zip(
-            reversed(memory.rewards), reversed(memory.is_terminals)
-        ):
-            if is_terminal:
-                discounted_reward = 0
-            discounted_reward = reward + (self.gamma * discounted_reward)
-            rewards.insert(0, discounted_reward)
-
+        # views of the rollout, [T, n_envs, ...]
+        old_states = memory.states
+        old_actions = memory.actions
+        old_logprobs = memory.logprobs
+
+        with torch.no_grad():
+            values = self.policy.critic(old_states).squeeze(-1)
+        memory.set("values", values)
+
+        # Monte Carlo estimate of state rewards, bootstrapped from the critic:
+        rewards = memory.total_rewards()
+        is_terminals = memory.padded("is_terminals")
+        bootstrap = values[-1]
+
+        if self.lam < 1:
+            advantages, rewards = gae(
+                rewards, values, is_terminals, self.gamma, self.lam, bootstrap
+            )
+        else:
+            rewards = discounted_returns(
+                rewards, is_terminals, self.gamma, bootstrap
+            )
+            advantages = rewards - values
         # Normalizing the rewards:
-        rewards = torch.tensor(rewards).to(self.device).double()
         # rewards = (rewards - rewards.mean()) / (rewards.std() + 1e-5)
 
-        # convert list to tensor
-        old_states = torch.stack(memory.states).to(self.device).detach()
-        old_actions = torch.stack(memory.actions).to(self.device).detach()
-        old_logprobs = torch.stack(memory.logprobs).to(self.device).detach()
-
-        # Optimize policy for K epochs:
-        for _ in range(self.K_epochs):
-            # Evaluating old actions and values :
-            logprobs, state_values, dist_entropy = self.policy.evaluate(
-                old_states, old_actions
-            )
-
-            # Finding the ratio (pi_theta / pi_theta__old):
-            ratios = torch.exp(logprobs - old_logprobs.detach())
+        # flatten time and env dimension for the update
+        rewards = rewards.flatten()
+        advantages = advantages.flatten()
+        old_states = old_states.flatten(0, 1)
+        old_actions = old_actions.flatten(0, 1)
+        old_logprobs = old_logprobs.flatten()
 
-            # Finding Surrogate Loss:
-            advantages = rewards - state_values.detach()
-            # print(advantages.mean())
-            # for now don't normalize advantages
-            # advantages = (advantages - advantages.mean()) / (advantages.std()+
-            #                                                  1e-5)
+        if self.norm_advantages:
+            advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
 
-            surr1 = ratios * advantages
-            surr2 = (
-                torch.clamp(ratios, 1 - self.eps_clip, 1 + self.eps_clip) * advantages
-            )
-            value_loss = self.MseLoss(state_values.double(), rewards)
-            loss = -torch.min(surr1, surr2) + 0.5 * value_loss  # - 1.0 * dist_entropy
+        n_samples = len(rewards)
+        # the remainder is spread over the minibatches, so that none is smaller
+        # than minibatch_size
+        n_minibatches = max(n_samples // (self.minibatch_size or n_samples), 1)
 
-            # take gradient step
-            self.optimizer.zero_grad()
-            loss.mean().backward()
-            self.optimizer.step()
-
-        # Copy new weights into old policy:
-        self.policy_old.load_state_dict(self.policy.state_dict())
+        # Optimize policy for K epochs of shuffled minibatches:
+        for _ in range(self.K_epochs):
+            approx_kl = 0
+            perm = torch.randperm(n_samples, device=rewards.device)
+            for idx in perm.tensor_split(n_minibatches):
+                # Evaluating old actions and values :
+                logprobs, state_values, dist_entropy = self.policy.evaluate(
+                    old_states[idx], old_actions[idx]
+                )
+
+                # Finding the ratio (pi_theta / pi_theta__old):
+                log_ratios = logprobs - old_logprobs[idx]
+                ratios = torch.exp(log_ratios)
+
+                # Finding Surrogate Loss:
+                surr1 = ratios * advantages[idx]
+                surr2 = (
+                    torch.clamp(ratios, 1 - self.eps_clip, 1 + self.eps_clip)
+                    * advantages[idx]
+                )
+                value_loss = self.MseLoss(state_values, rewards[idx])
+                loss = -torch.min(surr1, surr2) + 0.5 * value_loss  # - 1.0 * dist_entropy
+
+                # take gradient step
+                self.optimizer.zero_grad()
+                loss.mean().backward()
+                self.optimizer.step()
+
+                with torch.no_grad():
+                    # http://joschu.net/blog/kl-approx.html
+                    approx_kl += ((ratios - 1) - log_ratios).sum().item() / n_samples
+
+            if self.target_kl is not None and approx_kl > 1.5 * self.target_kl:
+                break
+
+        # the compiled actor is a frozen snapshot, bring it up to date
+        self.policy.refresh_inference()
         return loss.mean(), value_loss
 
     def load_state(self, path):
         print("ppo loading model from path", path)
         self.policy.load_state_dict(torch.load(os.path.join(path, "policy.pt")))
         self.optimizer.load_state_dict(torch.load(os.path.join(path, "opt.pt")))
-        self.policy_old.load_state_dict(torch.load(os.path.join(path, "policy_old.pt")))
+        self.policy.refresh_inference()
 
     def save_state(self, path):
         print("ppo saving model to path", path)
         torch.save(self.policy.state_dict(), os.path.join(path, "policy.pt"))
-        torch.save(self.policy_old.state_dict(), os.path.join(path, "policy_old.pt"))
         torch.save(self.optimizer.state_dict(), os.path.join(path, "opt.pt"))
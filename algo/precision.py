@@ -0,0 +1,70 @@
+"""
+Opt-in reduced precision training on CPU. Network forward (and thereby
+backward) passes run under bfloat16 autocast, while weights, optimizer state
+and losses stay float32. bfloat16 has the exponent range of float32, so unlike
+float16 it needs no loss scaling.
+"""
+import copy
+import contextlib
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+DTYPES = {"fp32": None, "bf16": torch.bfloat16}
+
+
+class Precision:
+    def __init__(self, mode="fp32", device_type="cpu"):
+        if mode not in DTYPES:
+            raise ValueError(f"unknown precision {mode}, use one of {list(DTYPES)}")
+        self.mode = mode
+        self.dtype = DTYPES[mode]
+        self.device_type = device_type
+
+    def autocast(self):
+        """
+        Context for the network forward passes. Outputs have to be cast back
+        with .float() before computing losses or distributions.
+        """
+        if self.dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+
+def check_accuracy(model, inputs, targets, mode="bf16", steps=500, bsize=256, lr=1e-3):
+    """
+    Trains two identical copies of *model* on a fixed dataset, one in float32
+    and one in the given reduced precision, with the same batch order. Returns
+    the final test losses of both and their relative difference.
+    """
+    results = {}
+    for name in ("fp32", mode):
+        net = copy.deepcopy(model)
+        precision = Precision(name)
+        opt = torch.optim.Adam(net.parameters(), lr=lr)
+        generator = torch.Generator().manual_seed(0)
+        for _ in range(steps):
+            idx = torch.randint(len(inputs), (bsize,), generator=generator)
+            with precision.autocast():
+                pred = net(inputs[idx])
+            loss = F.mse_loss(pred.float(), targets[idx])
+            opt.zero_grad()
+            loss.backward()
+            opt.step()
+        with torch.no_grad():
+            results[name] = F.mse_loss(net(inputs), targets).item()
+    results["rel_diff"] = abs(results[mode] - results["fp32"]) / results["fp32"]
+    return results
+
+
+if __name__ == "__main__":
+    # fixed dataset of the inverse model's size: (state, next state) -> action
+    torch.manual_seed(0)
+    teacher = nn.Sequential(nn.Linear(14, 64), nn.Tanh(), nn.Linear(64, 7))
+    inputs = torch.randn(20000, 14)
+    with torch.no_grad():
+        targets = teacher(inputs)
+    model = nn.Sequential(
+        nn.Linear(14, 256), nn.ReLU(), nn.Linear(256, 256), nn.ReLU(), nn.Linear(256, 7)
+    )
+    print(check_accuracy(model, inputs, targets))
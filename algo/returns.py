@@ -0,0 +1,49 @@
+"""
+Discounted returns and generalized advantage estimation (GAE,
+https://arxiv.org/abs/1506.02438) over whole rollout tensors.
+All functions take tensors of shape [T] or [T, n_envs] with time first.
+A done flag at step t means that the episode ended after step t.
+"""
+import torch
+
+
+def discounted_cumsum(x, discounts):
+    """
+    Solves y_t = x_t + discounts_t * y_{t+1} with y_T = 0 along the time
+    dimension. Instead of a Python loop over time this runs a parallel
+    (Hillis-Steele) scan over the affine maps y -> discounts_t * y + x_t,
+    which takes ceil(log2 T) vectorized steps.
+    """
+    # flip time, so that the recurrence runs forward: y_s = b_s + a_s * y_{s-1}
+    b = x.flip(0)
+    a = discounts.flip(0)
+    offset = 1
+    while offset < b.shape[0]:
+        b = torch.cat([b[:offset], b[offset:] + a[offset:] * b[:-offset]])
+        a = torch.cat([a[:offset], a[offset:] * a[:-offset]])
+        offset *= 2
+    return b.flip(0)
+
+
+def discounted_returns(rewards, dones, gamma, bootstrap=0.0):
+    """
+    Computes R_t = r_t + gamma * (1 - done_t) * R_{t+1}, where the return
+    after the last step is given by *bootstrap* (scalar or one per env).
+    """
+    discounts = gamma * (1 - dones.to(rewards))
+    x = rewards.clone()
+    x[-1] = x[-1] + discounts[-1] * bootstrap
+    return discounted_cumsum(x, discounts)
+
+
+def gae(rewards, values, dones, gamma, lam, last_value=0.0):
+    """
+    Computes GAE(lambda) advantages and the corresponding value targets.
+    *last_value* is the value of the state following the last step.
+    """
+    not_done = 1 - dones.to(rewards)
+    last_value = torch.as_tensor(last_value).to(values).expand_as(values[-1:])
+    next_values = torch.cat([values[1:], last_value])
+    deltas = rewards + gamma * not_done * next_values - values
+    advantages = discounted_cumsum(deltas, gamma * lam * not_done)
+    return advantages, advantages + values
@@ -0,0 +1,41 @@
+"""
+Soft (Polyak) updates of target networks, target = (1 - tau) * target +
+tau * online, done in place with multi-tensor foreach ops instead of a
+Python loop with two temporaries per parameter.
+"""
+import torch
+
+
+class SoftUpdate:
+    """
+    Keeps the parameter lists of an online and a target network and lerps
+    all target parameters towards the online ones with a single foreach call.
+    """
+
+    def __init__(self, online, target, tau):
+        self.tau = tau
+        self.reset(online, target)
+
+    def reset(self, online, target):
+        """
+        Has to be called when the parameters of either network are replaced,
+        e.g. after loading a checkpoint with deepcopy.
+        """
+        self.online = [p.detach() for p in online.parameters()]
+        self.target = [p.detach() for p in target.parameters()]
+
+    @torch.no_grad()
+    def __call__(self):
+        soft_update(self.target, self.online, self.tau)
+
+
+@torch.no_grad()
+def soft_update(target, online, tau):
+    """
+    In place target = target + tau * (online - target) on lists of tensors.
+    """
+    if hasattr(torch, "_foreach_lerp_"):
+        torch._foreach_lerp_(target, online, tau)
+    else:
+        torch._foreach_mul_(target, 1 - tau)
+        torch._foreach_add_(target, online, alpha=tau)
@@ -1,7 +1,13 @@
 import copy
+import warnings
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from algo.inference import InferenceModule
+from algo.models import EnsembleLinear
+from algo.precision import Precision
+from algo.target import SoftUpdate
 
 
 # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -27,38 +33,86 @@ class Actor(nn.Module):
 
 
 class Critic(nn.Module):
-    def __init__(self, state_dim, action_dim):
-        super(Critic, self).__init__()
+    """
+    n_critics Q networks stored as stacked weights, so that all of them are
+    evaluated with one batched matmul per layer.
+    """
 
-        # Q1 architecture
-        self.l1 = nn.Linear(state_dim + action_dim, 256)
-        self.l2 = nn.Linear(256, 256)
-        self.l3 = nn.Linear(256, 1)
+    def __init__(self, state_dim, action_dim, n_critics=2):
+        super(Critic, self).__init__()
+        self.n_critics = n_critics
 
-        # Q2 architecture
-        self.l4 = nn.Linear(state_dim + action_dim, 256)
-        self.l5 = nn.Linear(256, 256)
-        self.l6 = nn.Linear(256, 1)
+        self.l1 = EnsembleLinear(n_critics, state_dim + action_dim, 256)
+        self.l2 = EnsembleLinear(n_critics, 256, 256)
+        self.l3 = EnsembleLinear(n_critics, 256, 1)
 
-    def forward(self, state, action):
+    def all_q(self, state, action):
+        """
+        Q values of all critics, [n_critics, batch, 1].
+        """
         sa = torch.cat([state, action], 1)
 
-        q1 = F.relu(self.l1(sa))
-        q1 = F.relu(self.l2(q1))
-        q1 = self.l3(q1)
+        q = F.relu(self.l1(sa))
+        q = F.relu(self.l2(q))
+        return self.l3(q)
 
-        q2 = F.relu(self.l4(sa))
-        q2 = F.relu(self.l5(q2))
-        q2 = self.l6(q2)
-        return q1, q2
+    def forward(self, state, action):
+        # one tensor per critic, i.e. q1, q2 for the twin critic
+        return tuple(self.all_q(state, action).unbind(0))
 
     def Q1(self, state, action):
-        sa = torch.cat([state, action], 1)
-
-        q1 = F.relu(self.l1(sa))
-        q1 = F.relu(self.l2(q1))
-        q1 = self.l3(q1)
-        return q1
+        return self.all_q(state, action)[0]
+
+    def reduce(self, state, action, reduction="min", subset=None):
+        """
+        Reduces the Q values of the critics with min or mean. With subset,
+        only a random subset of that many critics is used (REDQ,
+        https://arxiv.org/abs/2101.05982).
+        """
+        q = self.all_q(state, action)
+        if subset is not None:
+            q = q[torch.randperm(self.n_critics, device=q.device)[:subset]]
+        if reduction == "min":
+            return q.min(0).values
+        if reduction == "mean":
+            return q.mean(0)
+        raise ValueError(f"unknown reduction {reduction}, use min or mean")
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of the former twin critic with two stacks l1..l3, l4..l6
+        if prefix + "l4.weight" in state_dict:
+            for layer, twin in (("l1", "l4"), ("l2", "l5"), ("l3", "l6")):
+                weights, biases = [], []
+                for name in (layer, twin):
+                    weights.append(state_dict.pop(f"{prefix}{name}.weight").t())
+                    biases.append(state_dict.pop(f"{prefix}{name}.bias")[None])
+                state_dict[f"{prefix}{layer}.weight"] = torch.stack(weights)
+                state_dict[f"{prefix}{layer}.bias"] = torch.stack(biases)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @staticmethod
+    def convert_optimizer_state(state):
+        """
+        Converts the optimizer state of the former twin critic, whose params
+        were l1..l6 weight and bias, to the stacked layout of n_critics=2.
+        """
+        old_state = state["state"]
+        old_ids = state["param_groups"][0]["params"]
+        new_state = {}
+        for j in range(3):
+            for offset, stack in ((0, lambda t: t.t()), (1, lambda t: t[None])):
+                pair = [old_ids[2 * j + offset], old_ids[2 * j + offset + 6]]
+                if not all(i in old_state for i in pair):
+                    continue
+                first, second = (old_state[i] for i in pair)
+                new_state[2 * j + offset] = {
+                    key: torch.stack([stack(first[key]), stack(second[key])])
+                    if torch.is_tensor(first[key]) and first[key].dim()
+                    else first[key]
+                    for key in first
+                }
+        group = dict(state["param_groups"][0], params=list(range(6)))
+        return dict(state=new_state, param_groups=[group])
 
 
 class TD3(object):
@@ -72,13 +126,17 @@ class TD3(object):
         policy_noise=0.2,
         noise_clip=0.5,
         policy_freq=2,
+        precision="fp32",
+        n_critics=2,
+        target_reduction="min",
+        redq_subset=None,
     ):
 
         self.actor = Actor(state_dim, action_dim, max_action).to(device)
         self.actor_target = copy.deepcopy(self.actor)
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=1e-4)
 
-        self.critic = Critic(state_dim, action_dim).to(device)
+        self.critic = Critic(state_dim, action_dim, n_critics).to(device)
         self.critic_target = copy.deepcopy(self.critic)
         self.critic_optimizer = torch.optim.Adam(self.critic.parameters(), lr=1e-4)
 
@@ -88,19 +146,59 @@ class TD3(object):
         self.policy_noise = policy_noise
         self.noise_clip = noise_clip
         self.policy_freq = policy_freq
+        # how the target critics are combined, min over all twin critics in
+        # TD3, min over a random subset of redq_subset critics in REDQ
+        self.target_reduction = target_reduction
+        self.redq_subset = redq_subset
 
-        self.total_it = 0
+        self.critic_update = SoftUpdate(self.critic, self.critic_target, tau)
+        self.actor_update = SoftUpdate(self.actor, self.actor_target, tau)
 
-    def select_action(self, state):
-        state = torch.tensor(state.reshape(1, -1)).to(device).float()
-        return self.actor(state).cpu().detach().numpy().flatten()
+        self.total_it = 0
+        self.precision = Precision(precision, device.type)
 
-    def train(self, replay_buffer, batch_size=100):
-        self.total_it += 1
+        # compiled copy of the actor used for acting, see compile_inference
+        self.actor_infer = None
 
-        # Sample replay buffer
-        state, action, next_state, reward, not_done = replay_buffer.sample(batch_size)
+    def compile_inference(self, freeze=False):
+        """
+        Acts with a TorchScript compiled copy of the actor from now on. The
+        actor is updated every policy_freq iterations, so by default the
+        compiled copy shares its weights instead of being frozen.
+        """
+        example = torch.zeros(1, self.actor.l1.in_features, device=device)
+        self.actor_infer = InferenceModule(self.actor, example, freeze=freeze)
 
+    def select_action(self, state):
+        return self.select_actions(np.asarray(state).reshape(1, -1)).flatten()
+
+    def select_actions(self, states):
+        """
+        Deterministic actions [N, action_dim] for a batch of states [N, state_dim].
+        """
+        states = torch.as_tensor(states, dtype=torch.float32, device=device)
+        if self.actor_infer is not None:
+            return self.actor_infer(states).cpu().numpy()
+        with torch.no_grad():
+            return self.actor(states).cpu().numpy()
+
+    def train(self, replay_buffer, batch_size=100, n_updates=1):
+        """
+        Runs n_updates iterations on batches that are sampled from the replay
+        buffer all at once. The critic is updated every iteration, the actor
+        and the target networks every policy_freq iterations.
+        """
+        batches = replay_buffer.sample(batch_size, n_updates)
+        for state, action, next_state, reward, not_done in zip(*batches):
+            self.total_it += 1
+            self.train_critic(state, action, next_state, reward, not_done)
+
+            # Delayed policy updates
+            if self.total_it % self.policy_freq == 0:
+                self.train_actor(state)
+                self.update_targets()
+
+    def train_critic(self, state, action, next_state, reward, not_done):
         with torch.no_grad():
             # Select action according to policy and add clipped noise
             noise = (torch.randn_like(action) * self.policy_noise).clamp(
@@ -112,16 +210,20 @@ class TD3(object):
             )
 
             # Compute the target Q value
-            target_Q1, target_Q2 = self.critic_target(next_state, next_action)
-            target_Q = torch.min(target_Q1, target_Q2)
-            target_Q = reward + not_done * self.discount * target_Q
+            with self.precision.autocast():
+                target_Q = self.critic_target.reduce(
+                    next_state, next_action, self.target_reduction, self.redq_subset
+                )
+            target_Q = reward + not_done * self.discount * target_Q.float()
 
-        # Get current Q estimates
-        current_Q1, current_Q2 = self.critic(state, action)
+        # Get current Q estimates of all critics, [n_critics, batch, 1]
+        with self.precision.autocast():
+            current_Q = self.critic.all_q(state, action)
+        current_Q = current_Q.float()
 
-        # Compute critic loss
-        critic_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(
-            current_Q2, target_Q
+        # Compute critic loss, the sum of the critics' mse losses
+        critic_loss = self.critic.n_critics * F.mse_loss(
+            current_Q, target_Q.expand_as(current_Q)
         )
 
         # Optimize the critic
@@ -129,31 +231,26 @@ class TD3(object):
         critic_loss.backward()
         self.critic_optimizer.step()
 
-        # Delayed policy updates
-        if self.total_it % self.policy_freq == 0:
-
-            # Compute actor losse
-            actor_loss = -self.critic.Q1(state, self.actor(state)).mean()
-
-            # Optimize the actor
-            self.actor_optimizer.zero_grad()
-            actor_loss.backward()
-            self.actor_optimizer.step()
-
-            # Update the frozen target models
-            for param, target_param in zip(
-                self.critic.parameters(), self.critic_target.parameters()
-            ):
-                target_param.data.copy_(
-                    self.tau * param.data + (1 - self.tau) * target_param.data
-                )
-
-            for param, target_param in zip(
-                self.actor.parameters(), self.actor_target.parameters()
-            ):
-                target_param.data.copy_(
-                    self.tau * param.data + (1 - self.tau) * target_param.data
-                )
+    def train_actor(self, state):
+        # Compute actor losse, on the first critic in TD3 and on the mean of
+        # all critics in REDQ
+        with self.precision.autocast():
+            action = self.actor(state)
+            if self.redq_subset is None:
+                actor_Q = self.critic.Q1(state, action)
+            else:
+                actor_Q = self.critic.reduce(state, action, "mean")
+        actor_loss = -actor_Q.float().mean()
+
+        # Optimize the actor
+        self.actor_optimizer.zero_grad()
+        actor_loss.backward()
+        self.actor_optimizer.step()
+
+    def update_targets(self):
+        # Update the frozen target models
+        self.critic_update()
+        self.actor_update()
 
     def save(self, filename):
         torch.save(self.critic.state_dict(), filename + "_critic")
@@ -164,11 +261,25 @@ class TD3(object):
 
     def load(self, filename):
         self.critic.load_state_dict(torch.load(filename + "_critic"))
-        self.critic_optimizer.load_state_dict(
-            torch.load(filename + "_critic_optimizer")
-        )
+        optimizer_state = torch.load(filename + "_critic_optimizer")
+        n_saved = len(optimizer_state["param_groups"][0]["params"])
+        if n_saved == 12 and self.critic.n_critics == 2:
+            # checkpoint of the former twin critic
+            optimizer_state = Critic.convert_optimizer_state(optimizer_state)
+            n_saved = 6
+        if n_saved == len(list(self.critic.parameters())):
+            self.critic_optimizer.load_state_dict(optimizer_state)
+        else:
+            warnings.warn(
+                f"critic optimizer state of {filename} does not match the "
+                f"{self.critic.n_critics} critics, starting with a fresh optimizer"
+            )
         self.critic_target = copy.deepcopy(self.critic)
+        self.critic_update.reset(self.critic, self.critic_target)
 
         self.actor.load_state_dict(torch.load(filename + "_actor"))
         self.actor_optimizer.load_state_dict(torch.load(filename + "_actor_optimizer"))
         self.actor_target = copy.deepcopy(self.actor)
+        self.actor_update.reset(self.actor, self.actor_target)
+        if self.actor_infer is not None:
+            self.actor_infer.refresh()
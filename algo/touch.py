@@ -0,0 +1,62 @@
+"""
+Bit packed touch maps. A binary touch map of n sensors is stored as
+ceil(n / 32) uint32 words per step (a single word for the 28 skin sensors of
+the arm), 64x smaller than float64. It is only unpacked to floats at model
+input.
+"""
+import numpy as np
+import torch
+
+_SHIFTS = np.arange(32, dtype=np.uint32)
+
+
+def n_words(n_bits):
+    return (n_bits + 31) // 32
+
+
+def pack_bits(touch):
+    """
+    Packs binary maps [..., n_bits] (nonzero is a contact) into uint32 words
+    [..., n_words(n_bits)], sensor i is bit i % 32 of word i // 32.
+    """
+    bits = np.asarray(touch) != 0
+    n_bits = bits.shape[-1]
+    pad = n_words(n_bits) * 32 - n_bits
+    bits = np.pad(bits, [(0, 0)] * (bits.ndim - 1) + [(0, pad)])
+    bits = bits.reshape(*bits.shape[:-1], -1, 32).astype(np.uint32)
+    return np.bitwise_or.reduce(bits << _SHIFTS, axis=-1)
+
+
+def unpack_bits(packed, n_bits, dtype=torch.float32, device=None):
+    """
+    Unpacks uint32 words [..., n_words] (numpy array or tensor) to a tensor
+    [..., n_bits] of 0 / 1 values.
+    """
+    if isinstance(packed, np.ndarray):
+        packed = torch.from_numpy(packed.astype(np.int64))
+    packed = packed.to(device=device, dtype=torch.int64)
+    shifts = torch.arange(32, device=packed.device)
+    bits = (packed.unsqueeze(-1) >> shifts) & 1
+    return bits.flatten(-2)[..., :n_bits].to(dtype)
+
+
+def popcount(packed):
+    """
+    Number of contacts per step, [..., n_words] -> [...], with the usual
+    SWAR bit counting on the uint32 words.
+    """
+    v = np.asarray(packed, dtype=np.uint32)
+    v = v - ((v >> 1) & 0x55555555)
+    v = (v & 0x33333333) + ((v >> 2) & 0x33333333)
+    v = (((v + (v >> 4)) & 0x0F0F0F0F) * np.uint32(0x01010101)) >> 24
+    return v.sum(-1, dtype=np.int64)
+
+
+def bit_counts(packed, n_bits):
+    """
+    Number of steps in which each sensor was touched, [steps, n_words] ->
+    [n_bits].
+    """
+    packed = np.asarray(packed, dtype=np.uint32)
+    bits = (packed[..., None] >> _SHIFTS) & 1
+    return bits.reshape(len(packed), -1)[:, :n_bits].sum(0, dtype=np.int64)
@@ -0,0 +1,69 @@
+"""
+Compares a training step of StackedIVModel with training the same members
+one after another as IVModels, e.g.
+
+    python bench_stacked_iv.py --depths 2 2 2 2 --batch 1000 --threads 1
+"""
+import time
+import argparse
+import torch
+import numpy as np
+from utils import get_conf
+from inverse_model import IVModel, StackedIVModel
+
+
+def time_steps(steps, n_steps, sync=lambda: None):
+    """
+    Median milliseconds per call of every step function. The steps are run
+    alternately, so that load changes on the machine affect all of them.
+    """
+    for step in steps:
+        for _ in range(3):
+            step()
+    times = [[] for _ in steps]
+    for _ in range(n_steps):
+        for step, t in zip(steps, times):
+            start = time.perf_counter()
+            step()
+            sync()
+            t.append((time.perf_counter() - start) * 1000)
+    return [float(np.median(t)) for t in times]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--gpu", action="store_true")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    cnf = get_conf("conf/main.yaml")
+    cnf.main.gpu = args.gpu
+    device = torch.device("cuda" if args.gpu else "cpu")
+    states = torch.randn(args.batch, cnf.icm.embedding_size, device=device)
+    nstates = torch.randn(args.batch, cnf.icm.embedding_size, device=device)
+    actions = torch.randn(args.batch, cnf.env.action_dim, device=device)
+
+    stacked = StackedIVModel(cnf, args.depths)
+    singles = [IVModel(cnf, depth) for depth in args.depths]
+
+    def sequential():
+        for model in singles:
+            model.train(states, nstates, actions)
+
+    t_stacked, t_sequential = time_steps(
+        [lambda: stacked.train(states, nstates, actions), sequential],
+        args.steps,
+        sync=torch.cuda.synchronize if args.gpu else lambda: None,
+    )
+    print(f"depths {args.depths}, batch {args.batch}, {args.threads} threads")
+    print(f"stacked:    {t_stacked:.1f} ms/step")
+    print(f"sequential: {t_sequential:.1f} ms/step")
+    print(f"speedup:    {t_sequential / t_stacked:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,10 @@ from pyrep.robots.arms.panda import Panda
 from pyrep.robots.end_effectors.panda_gripper import PandaGripper
 from pyrep.objects.shape import Shape
 from pyrep.objects.joint import Joint
+from pyrep.objects.vision_sensor import VisionSensor
 from pyrep.backend import sim
 from observation import Observation
+from algo.touch import pack_bits
 
 import os
 import gym
@@ -15,6 +17,9 @@ import numpy as np
 
 
 class Env(gym.Env):
+    # settings that require launching a new simulator when they change
+    LAUNCH_KEYS = ("scene_path", "headless", "state", "vision_sensors", "vision_depth")
+
     def __init__(self, cnf):
         self.cnf = cnf.env
         self._launch()
@@ -26,6 +31,9 @@ class Env(gym.Env):
         self._setup_mobile()
         self._setup_skin_fs()
         self._setup_skin_contacts()
+        self.vision_shape = None
+        if "vision" in self.cnf.state:
+            self._setup_vision()
 
         self.OBS_SCALER = 10
 
@@ -40,6 +48,29 @@ class Env(gym.Env):
         self.gripper_speed = 0
         self.sound_played = False
 
+    def can_reuse(self, cnf):
+        """
+        Whether this simulator can run an experiment with config cnf.
+        """
+        return all(self.cnf[key] == cnf.env[key] for key in self.LAUNCH_KEYS)
+
+    def reconfigure(self, cnf):
+        """
+        Prepares the running simulator for a new experiment with config cnf
+        instead of launching a new one. Restarting the simulation restores
+        the scene, including the dynamic objects, to its initial state.
+        """
+        if not self.can_reuse(cnf):
+            raise ValueError("the simulator has to be relaunched for this config")
+        self.cnf = cnf.env
+        self.action_space = gym.spaces.Box(low=-1, high=1, shape=(self.cnf.action_dim,))
+        self._pr.stop()
+        self._pr.start()
+        self.gripper_speed = 0
+        self.sound_played = False
+        self._gripper_last_position = self.get_tip_position()
+        self._init_step()
+
     def _init_step(self):
         """
         This method is needed bevause some observational values are only
@@ -411,9 +442,41 @@ class Env(gym.Env):
     def _set_vels(self, action):
         self._arm.set_joint_target_velocities(action)
 
+    def _setup_vision(self):
+        """
+        Sets up the cameras of the scene. All sensors need the same resolution
+        because their images are captured as one batch.
+        """
+        self._vision_sensors = [VisionSensor(name) for name in self.cnf.vision_sensors]
+        width, height = self._vision_sensors[0].get_resolution()
+        channels = 4 if self.cnf.vision_depth else 3
+        # shape of get_vision_state, the image state of the conv ICM encoder
+        self.vision_shape = (height, width, channels * len(self._vision_sensors))
+
     def _get_vision(self):
-        # TODO: implement
-        pass
+        """
+        Captures all vision sensors and returns their images as one uint8
+        batch of shape [n_sensors, H, W, C], where C is 3 (RGB) or 4 (RGB and
+        depth, if vision_depth is set).
+        """
+        images = []
+        for sensor in self._vision_sensors:
+            image = sensor.capture_rgb()
+            if self.cnf.vision_depth:
+                depth = sensor.capture_depth()
+                image = np.concatenate([image, depth[..., None]], axis=-1)
+            images.append(image)
+        return (np.stack(images) * 255).astype(np.uint8)
+
+    def get_vision(self):
+        return self._get_vision()
+
+    def get_vision_state(self):
+        """
+        The images of all sensors concatenated along the channels,
+        [H, W, n_sensors * C].
+        """
+        return np.concatenate(list(self._get_vision()), axis=-1)
 
     def _get_reward(self):
         # TODO: implement
@@ -433,6 +496,12 @@ class Env(gym.Env):
         )
         return info
 
+    def get_touch_bits(self):
+        """
+        The skin touch map packed into uint32 words, see algo.touch.
+        """
+        return pack_bits(self.get_skin_touch_map())
+
     def get_touch_map(self):
         obs = []
         [obs.append(touch) for touch in self.get_skin_touch_map()]
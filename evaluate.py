@@ -3,52 +3,76 @@ import numpy as np
 
 
 class IVEvaluator:
+    """
+    Evaluates inverse models on trajectories tau (lists of (state, nstate,
+    action)) that were generated towards goals. The error at a step is the
+    squared distance between the normalized predicted action for
+    (state, goal) and the normalized action that was taken.
+
+    All trajectories are stacked into one padded batch, so every model is
+    called once per evaluation. evaluate accepts a single model or a list of
+    models, e.g. IVModels of different depth, which are evaluated on the same
+    batch.
+    """
+
     def __init__(self):
         pass
 
-    def evaluate(self, model: torch.nn.Module, tau: list, goals: list, reduce=False):
+    def evaluate(self, model, tau: list, goals: list, reduce=False):
+        """
+        Returns the errors [n_trajectories, T] for every step, or with reduce
+        one error per trajectory [n_trajectories], the sum of its step errors
+        divided by the number of trajectories. For a list of models the
+        results are stacked along a leading model dimension. Steps past the
+        end of shorter trajectories are nan.
+        """
+        models = model if isinstance(model, (list, tuple)) else [model]
+        errors, mask = self._compute_errors(models, tau, goals)
         if reduce:
-            return self._compute_mean_error(model, tau, goals)
-        else:
-            return self._compute_error_across_time(model, tau, goals)
-
-    def _compute_mean_error(self, model: torch.nn.Module, tau: list, goals: list):
-        all_errors = []
-        for t, goal in zip(tau, goals):
-            total_error = 0
-            for (state, nstate, action) in t:
-                predicted_action = (
-                    model(torch.tensor(state).float(), torch.tensor(goal).float())
-                    .detach()
-                    .numpy()
-                )
-                action = action / np.linalg.norm(action)
-                predicted_action = predicted_action / np.linalg.norm(predicted_action)
-                error = np.linalg.norm(predicted_action - action) ** 2
-                total_error += error
-            all_errors.append(total_error / len(tau))
-        return np.array(all_errors)
-
-    def _compute_error_across_time(
-        self, model: torch.nn.Module, tau: list, goals: list
-    ):
-        all_errors = []
-
-        for t, goal in zip(tau, goals):
-            errors_in_t = []
-            for (state, nstate, action) in t:
-                predicted_action = (
-                    model(
-                        torch.tensor(state).float().to(model.device),
-                        torch.tensor(goal).float().to(model.device),
-                    )
-                    .cpu()
-                    .detach()
-                    .numpy()
-                )
-                action = action / np.linalg.norm(action)
-                predicted_action = predicted_action / np.linalg.norm(predicted_action)
-                error = np.linalg.norm(predicted_action - action) ** 2
-                errors_in_t.append(error)
-            all_errors.append(errors_in_t)
-        return np.array(all_errors)
+            errors = np.where(mask, errors, 0).sum(-1) / len(tau)
+        return errors if isinstance(model, (list, tuple)) else errors[0]
+
+    @staticmethod
+    def _stack(tau: list, goals: list):
+        """
+        Pads the trajectories to the longest one, returns states and actions
+        [n, T, dim], goals [n, dim] and the mask of valid steps [n, T].
+        """
+        lengths = [len(t) for t in tau]
+        n, T = len(tau), max(lengths)
+        state_dim = len(tau[0][0][0])
+        action_dim = len(tau[0][0][2])
+        states = np.zeros((n, T, state_dim), dtype=np.float32)
+        actions = np.zeros((n, T, action_dim), dtype=np.float32)
+        mask = np.zeros((n, T), dtype=bool)
+        for i, t in enumerate(tau):
+            tau_states, _, tau_actions = zip(*t)
+            states[i, : len(t)] = np.stack(tau_states)
+            actions[i, : len(t)] = np.stack(tau_actions)
+            mask[i, : len(t)] = True
+        goals = np.stack(goals).astype(np.float32)
+        return (
+            torch.from_numpy(states),
+            torch.from_numpy(actions),
+            torch.from_numpy(goals),
+            torch.from_numpy(mask),
+        )
+
+    @staticmethod
+    def _normalize(x):
+        return x / x.norm(dim=-1, keepdim=True)
+
+    @torch.no_grad()
+    def _compute_errors(self, models: list, tau: list, goals: list):
+        states, actions, goals, mask = self._stack(tau, goals)
+        # the goal of every valid step
+        goals = goals.unsqueeze(1).expand(-1, mask.shape[1], -1)[mask]
+        states = states[mask]
+        actions = self._normalize(actions[mask])
+
+        errors = torch.full((len(models), *mask.shape), float("nan"))
+        for i, model in enumerate(models):
+            device = next(model.parameters()).device
+            predicted = model(states.to(device), goals.to(device)).float().cpu()
+            errors[i, mask] = ((self._normalize(predicted) - actions) ** 2).sum(-1)
+        return errors.numpy(), mask.numpy()
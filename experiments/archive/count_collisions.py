@@ -4,6 +4,8 @@ import plotly.graph_objects as go
 import numpy as np
 import wandb
 import torch
+from algo.normalizer import RunningMeanStd
+from algo.touch import bit_counts, popcount
 import time
 import os
 
@@ -20,6 +22,8 @@ class Experiment(BaseExperiment):
         self.reward_sum = 0
 
         self.touch_map = torch.zeros(28)
+        self.touch_bits = []
+        self.n_touches = 0
 
         # experiment parameters
         self.episode_len = 500
@@ -37,8 +41,7 @@ class Experiment(BaseExperiment):
         self.pointcloud_every = 250000
 
         # running mean and std of reward
-        self.running_mean = 0
-        self.running_std = 0
+        self.reward_stats = RunningMeanStd()
 
         # watch models
         # self.wandb.watch(self.agent.icm)
@@ -152,7 +155,21 @@ class Experiment(BaseExperiment):
         return ranges
 
     def update_touch_map(self):
-        self.touch_map += self.env.get_touch_map() / self.env.OBS_SCALER
+        # packed touch maps of the steps since the last fold_touch_map
+        self.touch_bits.append(self.env.get_touch_bits())
+
+    def fold_touch_map(self):
+        """
+        Adds the contacts of the collected packed touch maps to the per
+        sensor counts of touch_map.
+        """
+        if not self.touch_bits:
+            return
+        touch_bits = np.stack(self.touch_bits)
+        counts = bit_counts(touch_bits, len(self.touch_map))
+        self.touch_map += torch.from_numpy(counts)
+        self.n_touches += int(popcount(touch_bits).sum())
+        self.touch_bits = []
 
     def run(self, pre_run_results):
 
@@ -161,6 +178,7 @@ class Experiment(BaseExperiment):
         actions_norms = []
 
         state = self.env.reset()
+        obs = self.icm_observation(state)
         for i in range(self.cnf.main.n_steps):
             self_collisions_batch = 0
             ext_collisions_batch = 0
@@ -182,7 +200,8 @@ class Experiment(BaseExperiment):
 
             self.update_touch_map()
 
-            self.agent.append_icm_transition(state, next_state, action)
+            next_obs = self.icm_observation(next_state)
+            self.agent.append_icm_transition(obs, next_obs, action)
 
             if self.global_step % self.episode_len == 0:
                 if self.cnf.main.reset:
@@ -208,27 +227,27 @@ class Experiment(BaseExperiment):
 
             # train agent
             if self.ppo_timestep % self.cnf.main.train_each == 0:
-                # train and log resulting metrics
-                train_results = self.agent.train(
+                # train and log resulting metrics, with overlapped training
+                # these are the results of the previous rollout
+                train = (
+                    self.agent.train_async
+                    if self.cnf.main.overlap_training
+                    else self.agent.train
+                )
+                train_results = train(
                     train_ppo=self.cnf.main.train,
                     random_reward=True
                     if "random_reward" in self.cnf.env.state
                     else False,
                 )
 
-                batch_reward = train_results["imloss"].sum().item()
+                batch_reward = train_results["imloss"].sum()
+                # imloss is empty if the ICM was not trained on this rollout
+                if train_results["imloss"].numel():
+                    self.reward_stats.update(batch_reward)
+                batch_reward = batch_reward.item()
                 self.reward_sum += batch_reward
 
-                # compute running mean and std
-                prev_mean = self.running_mean
-                self.running_mean = (
-                    self.running_mean
-                    + (batch_reward - self.running_mean) / self.global_step
-                )
-                self.running_std = self.running_std + (
-                    batch_reward - self.running_mean
-                ) * (batch_reward - prev_mean)
-
                 # if we don't train we still want to log all the relevant data
                 if self.global_step % (self.cnf.main.train_each * 10) == 0:
                     ## general movements stuff
@@ -248,6 +267,7 @@ class Experiment(BaseExperiment):
                     # compute the mean norm of the actions
                     actions_norms = torch.tensor(actions_norms).mean()
 
+                    self.fold_touch_map()
                     touch_map_entropy = torch.distributions.categorical.Categorical(
                         logits=self.touch_map
                     ).entropy()
@@ -267,6 +287,7 @@ class Experiment(BaseExperiment):
                             # "n sounds": self.n_sounds,
                             "cum reward": self.reward_sum,
                             "batch reward": batch_reward,
+                            "n touches": self.n_touches,
                             # "policy loss": train_results["ploss"],
                             # "value loss": train_results["vloss"],
                             # "iteration time": time.time() - it_start,
@@ -291,6 +312,7 @@ class Experiment(BaseExperiment):
                     actions_norms = []
 
             state = next_state
+            obs = next_obs
 
             # save state
             if (
@@ -300,10 +322,13 @@ class Experiment(BaseExperiment):
             ):
                 self.save_state()
 
+        if self.cnf.main.overlap_training:
+            self.agent.wait()
+
         self.wandb.log(
             {
-                "running mean": self.running_mean,
-                "running std": np.sqrt(self.running_std / self.global_step),
+                "running mean": self.reward_stats.mean.item(),
+                "running std": self.reward_stats.std.item(),
             }
         )
         self.env.close()
@@ -319,6 +344,7 @@ class Experiment(BaseExperiment):
         state = {
             "global_step": self.global_step,
             "reward_sum": self.reward_sum,
+            "reward_stats": self.reward_stats.state_dict(),
         }
         torch.save(state, os.path.join(cp_path, "exp_state.p"))
         self.agent.save_state(cp_path)
@@ -328,4 +354,5 @@ class Experiment(BaseExperiment):
         exp_state = torch.load(os.path.join(path, "exp_state.p"))
         self.global_step = exp_state["global_step"]
         self.reward_sum = exp_state["reward_sum"]
+        self.reward_stats.load_state_dict(exp_state["reward_stats"])
         self.agent.load_state(path)
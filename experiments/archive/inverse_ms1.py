@@ -41,13 +41,11 @@ class Experiment(BaseExperiment):
 
             if i == self.alpha_off:
                 print("Changing alpha")
-                self.agent.ppo.policy.alpha = 0
-                self.agent.ppo.policy_old.alpha = 0
+                self.agent.set_alpha(0)
 
             if i == self.alpha_on:
                 print("Changing alpha")
-                self.agent.ppo.policy.alpha = 0.9
-                self.agent.ppo.policy_old.alpha = 0.9
+                self.agent.set_alpha(0.9)
 
             while not done:
                 ep_len += 1
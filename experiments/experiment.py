@@ -9,14 +9,19 @@ import numpy as np
 from observation import Observation
 from environment import Env
 from agent import Agent, TD3Agent
-from algo.ppo_cont import PPO, Memory
+from algo.ppo_cont import PPO, RolloutBuffer
 from algo.models import ICModule
 from collections import defaultdict
 from abc import abstractmethod
 
 
 class BaseExperiment:
-    def __init__(self, cnf, rank):
+    def __init__(self, cnf, rank, env=None):
+        """
+        env is a running Env to reuse, e.g. the simulator of a
+        mp_runner.WorkerPool worker. It is reconfigured for cnf, otherwise a
+        new Env is launched.
+        """
         self.cnf = cnf
         self.rank = rank
 
@@ -37,7 +42,11 @@ class BaseExperiment:
         torch.manual_seed(cnf.env.torch_seed)
 
         # setup env
-        self.env = Env(cnf)
+        if env is None:
+            self.env = Env(cnf)
+        else:
+            env.reconfigure(cnf)
+            self.env = env
 
         # pytorch device
         self.device = (
@@ -67,8 +76,18 @@ class BaseExperiment:
             self.cnf,
             self.device,
             is_goal_based=is_goal_based,
+            image_shape=self.env.vision_shape,
         )
 
+    def icm_observation(self, state):
+        """
+        What the ICM observes of the current state, the camera images with
+        the conv encoder and the state otherwise.
+        """
+        if self.cnf.icm.encoder == "conv":
+            return self.env.get_vision_state()
+        return state
+
     def init_td3agent(self, is_goal_based=False):
         self.agent = TD3Agent(
             self.action_dim,
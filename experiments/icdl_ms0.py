@@ -10,8 +10,8 @@ from .experiment import BaseExperiment
 
 
 class Experiment(BaseExperiment):
-    def __init__(self, cnf, rank):
-        super().__init__(cnf, rank)
+    def __init__(self, cnf, rank, env=None):
+        super().__init__(cnf, rank, env)
         self.cnf = cnf
         self.rank = rank
         self.burn_in = 1000
@@ -17,8 +17,8 @@ style.use("ggplot")
 
 
 class Experiment(BaseExperiment):
-    def __init__(self, cnf, rank):
-        super().__init__(cnf, rank)
+    def __init__(self, cnf, rank, env=None):
+        super().__init__(cnf, rank, env)
         self.iv_evaluator = IVEvaluator()
 
     def generate_transition_with_goal(self, action, length=30):
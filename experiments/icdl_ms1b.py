@@ -8,7 +8,8 @@ from .experiment import BaseExperiment
 from evaluate import IVEvaluator
 import seaborn as sns
 import matplotlib.style as style
-from inverse_model import IVModel
+from inverse_model import StackedIVModel
+from trainer import SupervisedTrainer, TransitionDataset
 import numpy as np
 from datetime import datetime
 
@@ -16,8 +17,8 @@ style.use("ggplot")
 
 
 class Experiment(BaseExperiment):
-    def __init__(self, cnf, rank):
-        super().__init__(cnf, rank)
+    def __init__(self, cnf, rank, env=None):
+        super().__init__(cnf, rank, env)
         self.iv_evaluator = IVEvaluator()
 
     def split_dataset(self, dataset):
@@ -27,39 +28,68 @@ class Experiment(BaseExperiment):
         train_set = dataset[: int(len(dataset) * split)]
 
         print("successfully loaded and splitted dataset of length", len(dataset))
-        return train_set, test_set
-
-    def train_inverse_model(self, model, train_set, test_set, nlayers=4):
-        print("rank", self.rank, "Training inverse model")
-        for i in range(self.cnf.main.n_steps):
-            idx = np.random.randint(len(train_set), size=self.cnf.main.bsize)
-            states, nstates, actions = zip(*train_set[idx])
-            loss = model.train(states, nstates, actions)
-
-            if i % 1000 == 0:
-                print("Rank", self.rank, "evaluating at global step", i)
-                states, nstates, actions = zip(*test_set)
-                loss = model.train(states, nstates, actions, eval=True)
-                # self.wandb.log({f"im: {self.cnf.main.with_im} eval loss": loss}, step=i)
-
-            if i % 50 == 0:
-                pass
-                # self.wandb.log(
-                #     {f"im: {self.cnf.main.with_im} training loss": loss}, step=i
-                # )
-        torch.save(
-            model.state_dict(),
-            f"checkpoints/ckpnt-{self.cnf.main.n_steps}-steps-{model.depth}-layers-noim-{datetime.now()}",
+        return (
+            TransitionDataset.from_transitions(train_set),
+            TransitionDataset.from_transitions(test_set),
         )
 
+    def train_inverse_models(self, train_set, test_set):
+        """
+        Trains one IVModel per entry of main.iv_depths as a single
+        StackedIVModel and returns the trained IVModels.
+        """
+        print("rank", self.rank, "Training inverse models")
+        main = self.cnf.main
+        model = StackedIVModel(self.cnf, main.iv_depths, main.iv_lrs, main.iv_seeds)
+        # runs with other members must not resume this checkpoint
+        name = "-".join(
+            f"d{depth}-lr{lr:g}-s{seed}"
+            for depth, lr, seed in zip(
+                model.depths,
+                model.lrs,
+                main.iv_seeds or [None] * model.n_members,
+            )
+        )
+        trainer = SupervisedTrainer(
+            model,
+            train_set,
+            test_set,
+            bsize=self.cnf.main.bsize,
+            n_steps=self.cnf.main.n_steps,
+            eval_every=self.cnf.main.iv_eval_every,
+            patience=self.cnf.main.iv_patience,
+            checkpoint_dir=f"checkpoints/iv-{name}-rank{self.rank}",
+            checkpoint_every=self.cnf.main.iv_checkpoint_every,
+            resume=self.cnf.main.iv_resume,
+            config=dict(
+                depths=model.depths,
+                lrs=model.lrs,
+                seeds=list(main.iv_seeds or []),
+                bsize=main.bsize,
+                embedding_size=self.cnf.icm.embedding_size,
+                precision=main.iv_precision,
+            ),
+            num_workers=self.cnf.main.iv_workers,
+            log=lambda result: print("Rank", self.rank, result),
+        )
+        trainer.fit()
+        models = [model.member(k) for k in range(model.n_members)]
+        for member in models:
+            torch.save(
+                member.state_dict(),
+                f"checkpoints/ckpnt-{self.cnf.main.n_steps}-steps-{member.depth}-layers-noim-{datetime.now()}",
+            )
+        return models
+
     def compute_reward(self, state, goal):
         print(state)
         print(goal)
         return -(np.linalg.norm(state - goal) ** 2) / 100
 
     def make_barplot(self, ax, results, name):
-        mean = results.mean(axis=0)
-        std = results.std(axis=0)
+        # steps past the end of shorter trajectories are nan
+        mean = np.nanmean(results, axis=0)
+        std = np.nanstd(results, axis=0)
 
         ax.bar(
             range(1, len(mean) + 1), mean, yerr=std, color="#B1483B",
@@ -99,48 +129,17 @@ class Experiment(BaseExperiment):
     def run(self, pre_run_results):
         ds = torch.load("out/ds/off-policy/dataset_without_im")
         train, test = self.split_dataset(ds)
-        # model_1layer = IVModel(self.cnf, 1)
-        model_2layer = IVModel(self.cnf, 2)
-        # model_3layer = IVModel(self.cnf, 3)
-        # model_4layer = IVModel(self.cnf, 4)
-
-        # taus, goals = torch.load("easy_goals.p")
-
-        # self.train_inverse_model(model_1layer, train, test)
-        # rew1 = self.eval_model(model_1layer, goals)
-
-        self.train_inverse_model(model_2layer, train, test)
-        # rew2 = self.eval_model(model_2layer, goals)
-
-        exit(1)
-
-        self.train_inverse_model(model_3layer, train, test)
-        rew3 = self.eval_model(model_3layer, goals)
-
-        self.train_inverse_model(model_4layer, train, test)
-        rew4 = self.eval_model(model_4layer, goals)
-
-        print("total reward 1 layer:", rew1)
-        print("total reward 2 layer:", rew2)
-        print("total reward 3 layer:", rew3)
-        print("total reward 4 layer:", rew4)
-
-        exit(1)
+        models = self.train_inverse_models(train, test)
 
-        results_1layer = self.iv_evaluator.evaluate(model_1layer, taus, goals)
-        # results_2layer = self.iv_evaluator.evaluate(model_2layer, taus, goals)
-        # results_3layer = self.iv_evaluator.evaluate(model_3layer, taus, goals)
-        # results_4layer = self.iv_evaluator.evaluate(model_4layer, taus, goals)
+        taus, goals = torch.load("easy_goals.p")
+        results = self.iv_evaluator.evaluate(models, taus, goals)
 
-        fig, axes = plt.subplots(ncols=1, nrows=1)
-        # axes = axes.flatten()
-        self.make_barplot(axes, results_1layer, "Linear")
-        # self.make_barplot(axes[1], results_2layer, "2 Layer")
-        # self.make_barplot(axes[2], results_3layer, "3 Layer")
-        # self.make_barplot(axes[3], results_4layer, "4 Layer")
+        fig, axes = plt.subplots(ncols=len(models), nrows=1, squeeze=False)
+        for ax, model, result in zip(axes[0], models, results):
+            self.make_barplot(ax, result, f"{model.depth} Layer")
 
         plt.tight_layout()
-        plt.savefig("results/icdl/linear_after_training.pdf")
-        plt.savefig("results/icdl/linear_after_training.png")
+        plt.savefig("results/icdl/iv_after_training.pdf")
+        plt.savefig("results/icdl/iv_after_training.png")
         plt.show()
 
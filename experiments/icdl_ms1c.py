@@ -16,8 +16,8 @@ style.use("ggplot")
 
 
 class Experiment(BaseExperiment):
-    def __init__(self, cnf, rank):
-        super().__init__(cnf, rank)
+    def __init__(self, cnf, rank, env=None):
+        super().__init__(cnf, rank, env)
 
     def compute_reward(self, state, goal):
         return -(np.linalg.norm(state - goal) ** 2) / 100
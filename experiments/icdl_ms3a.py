@@ -0,0 +1,115 @@
+"""
+Goal reaching by planning with the learned forward model instead of a
+policy. Evaluated on the easy and hard goal suites.
+"""
+import os
+import torch
+import numpy as np
+import pandas as pd
+from .experiment import BaseExperiment
+from inverse_model import FWModel
+from trainer import SupervisedTrainer, TransitionDataset
+from algo.planner import MPCPlanner
+from datetime import datetime
+
+
+class Experiment(BaseExperiment):
+    def __init__(self, cnf, rank, env=None):
+        super().__init__(cnf, rank, env)
+        self.model = FWModel(self.cnf)
+        self.planner = MPCPlanner(
+            self.model,
+            self.cnf.env.action_dim,
+            delta=self.model.delta,
+            device=self.model.device,
+            **self.cnf.planner,
+        )
+
+    def compute_reward(self, state, goal):
+        return -(np.linalg.norm(state - goal) ** 2) / 100
+
+    def train_forward_model(self):
+        ds = torch.load("out/ds/off-policy/dataset_without_im")
+        split = int(len(ds) * 0.99)
+        trainer = SupervisedTrainer(
+            self.model,
+            TransitionDataset.from_transitions(ds[:split]),
+            TransitionDataset.from_transitions(ds[split:]),
+            bsize=self.cnf.main.bsize,
+            n_steps=self.cnf.main.iv_train_steps,
+            eval_every=self.cnf.main.iv_eval_every,
+            patience=self.cnf.main.iv_patience,
+            num_workers=self.cnf.main.iv_workers,
+            log=lambda result: print("Rank", self.rank, result),
+        )
+        trainer.fit()
+        torch.save(self.model.state_dict(), self.cnf.main.fw_checkpoint)
+
+    def reach(self, goal):
+        """
+        Runs one episode of planner_steps steps towards goal, returns the
+        summed reward, the final reward and the mean planning time per step.
+        """
+        state = self.env.reset()
+        self.planner.reset()
+        total_reward = 0
+        plan_time = 0
+        for _ in range(self.cnf.main.planner_steps):
+            action = self.planner.plan(state, goal)
+            plan_time += self.planner.plan_time
+            state, *_ = self.env.step(action)
+            reward = self.compute_reward(state, goal)
+            total_reward += reward
+        return total_reward, reward, plan_time / self.cnf.main.planner_steps
+
+    def run(self, pre_run_results):
+        if os.path.exists(self.cnf.main.fw_checkpoint):
+            self.model.load_state_dict(torch.load(self.cnf.main.fw_checkpoint))
+        else:
+            self.train_forward_model()
+
+        results = []
+        for suite in ("easy", "hard"):
+            _, goals = torch.load(f"{suite}_goals.p")
+            for goal_idx, goal in enumerate(goals):
+                total_reward, final_reward, plan_time = self.reach(np.array(goal))
+                print(
+                    f"Rank {self.rank} {suite} goal {goal_idx}: total reward "
+                    f"{total_reward:.3f}, final reward {final_reward:.3f}, "
+                    f"{plan_time * 1000:.1f} ms per plan"
+                )
+                results.append(
+                    (
+                        self.rank,
+                        suite,
+                        goal_idx,
+                        self.cnf.planner.method,
+                        total_reward,
+                        final_reward,
+                        plan_time,
+                    )
+                )
+        return results
+
+    @staticmethod
+    def plot(results, cnf):
+        res = []
+        for key, value in results.items():
+            for val in value:
+                res.append(val)
+        df = pd.DataFrame(
+            res,
+            columns=[
+                "rank",
+                "suite",
+                "goal index",
+                "method",
+                "total reward",
+                "final reward",
+                "plan time",
+            ],
+        )
+        print(df.groupby(["suite", "method"]).mean(numeric_only=True))
+        df.to_csv(
+            f"results/icdl/{cnf.main.tag}-planner-{cnf.planner.method}-{datetime.now()}.csv"
+        )
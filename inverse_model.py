@@ -1,7 +1,20 @@
 import torch
+import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+from algo.precision import Precision
+from algo.models import EnsembleLinear
+
+
+def _to_tensor(x, device):
+    """
+    Float tensor on device. Tensors (e.g. batches of trainer.SupervisedTrainer)
+    are not copied if they already are.
+    """
+    if not isinstance(x, torch.Tensor):
+        x = np.array(x)
+    return torch.as_tensor(x, dtype=torch.float32, device=device)
 
 
 class FWModel(nn.Module):
@@ -9,6 +22,7 @@ class FWModel(nn.Module):
         super().__init__()
         self.delta = delta
         self.device = torch.device("cuda" if cnf.main.gpu else "cpu")
+        self.precision = Precision(cnf.main.iv_precision, self.device.type)
         self.hidden = 256
         self.linear = nn.Linear(14, self.hidden)
         self.linear2 = nn.Linear(self.hidden, self.hidden)
@@ -21,26 +35,24 @@ class FWModel(nn.Module):
         x: state
         y: action
         """
-        if x.dim() > 1:
-            x = torch.cat([x, y], dim=1)
-        else:
-            x = torch.cat([x, y], dim=0)
+        x = torch.cat([x, y], dim=-1)
         x = F.relu(self.linear(x))
         x = F.relu(self.linear2(x))
         return self.head(x)
 
     def train(self, states, nstates, actions, eval=False):
-        actions = torch.tensor(actions).float().to(self.device)
-        this_state = torch.tensor(states).float().to(self.device)
-        next_state = torch.tensor(nstates).float().to(self.device)
+        actions = _to_tensor(actions, self.device)
+        this_state = _to_tensor(states, self.device)
+        next_state = _to_tensor(nstates, self.device)
         if self.delta:
-            nstates = nstates - states
+            next_state = next_state - this_state
 
         self.opt.zero_grad()
-        predicted_nstates = self.forward(states, actions)
-        loss = F.mse_loss(predicted_nstates, nstates)
+        with self.precision.autocast():
+            predicted_nstates = self.forward(this_state, actions)
+        loss = F.mse_loss(predicted_nstates.float(), next_state)
         if not eval:
-            loss.backward
+            loss.backward()
             self.opt.step()
         return loss
 
@@ -53,6 +65,7 @@ class IVModel(nn.Module):
         self.hidden = 256
         self.act = act
         self.depth = depth
+        self.precision = Precision(cnf.main.iv_precision, self.device.type)
         self.linear = nn.Linear(cnf.icm.embedding_size * 2, self.hidden)
         self.linear2 = nn.Linear(self.hidden, self.hidden)
         self.linear3 = nn.Linear(self.hidden, self.hidden)
@@ -64,10 +77,7 @@ class IVModel(nn.Module):
     def forward(self, x, y):
         if self.delta:
             y = y - x
-        if x.dim() > 1:
-            x = torch.cat([x, y], dim=1)
-        else:
-            x = torch.cat([x, y], dim=0)
+        x = torch.cat([x, y], dim=-1)
 
         x = self.act(self.linear(x))
 
@@ -80,16 +90,205 @@ class IVModel(nn.Module):
         return self.head(x)
 
     def train(self, states, nstates, actions, eval=False):
+        actions = _to_tensor(actions, self.device)
+        this_state = _to_tensor(states, self.device)
+        next_state = _to_tensor(nstates, self.device)
         if self.delta:
-            nstates = nstates - states
-        actions = torch.tensor(actions).float().to(self.device)
-        this_state = torch.tensor(states).float().to(self.device)
-        next_state = torch.tensor(nstates).float().to(self.device)
+            next_state = next_state - this_state
 
         self.opt.zero_grad()
-        predicted_action = self.forward(this_state, next_state)
-        loss = F.mse_loss(predicted_action, actions)
+        with self.precision.autocast():
+            predicted_action = self.forward(this_state, next_state)
+        loss = F.mse_loss(predicted_action.float(), actions)
         if not eval:
             loss.backward()
             self.opt.step()
         return loss
+
+
+class StackedIVModel(nn.Module):
+    """
+    K independent IVModels trained as one model. Members are grouped by
+    depth and the weights of a group are stacked, so every layer of a group
+    is one batched matmul on the shared batch (the first layers one plain
+    matmul) and no member runs layers beyond its depth. Members differ in
+    depth, learning rate and initialization seed. Like IVModel, depth 4
+    applies linear3 a second time. member(k) exports member k as a regular
+    IVModel. bench_stacked_iv.py times a step against training the members
+    one after another.
+    """
+
+    def __init__(self, cnf, depths, lrs=None, seeds=None, act=F.relu, delta=False):
+        super().__init__()
+        self.cnf = cnf
+        self.delta = delta
+        self.device = torch.device("cuda" if cnf.main.gpu else "cpu")
+        self.hidden = 256
+        self.act = act
+        self.depths = list(depths)
+        self.n_members = len(self.depths)
+        self.precision = Precision(cnf.main.iv_precision, self.device.type)
+        n = self.n_members
+        self.linear = EnsembleLinear(n, cnf.icm.embedding_size * 2, self.hidden)
+        self.linear2 = EnsembleLinear(n, self.hidden, self.hidden)
+        self.linear3 = EnsembleLinear(n, self.hidden, self.hidden)
+        self.head = EnsembleLinear(n, self.hidden, cnf.env.action_dim)
+
+        # slot j of the stacked weights holds member slots[j], sorted by depth
+        self.slots = sorted(range(n), key=self.depths.__getitem__)
+        slot_depths = [self.depths[k] for k in self.slots]
+        # (depth, number of members) in slot order
+        self.groups = [(d, slot_depths.count(d)) for d in sorted(set(slot_depths))]
+        self.unsort = None
+        if self.slots != list(range(n)):
+            self.unsort = torch.tensor(self.slots).argsort().to(self.device)
+
+        if seeds is not None:
+            self._reset_members(seeds)
+        # learning rate of every member, in member order
+        self.lrs = [0.001] * n if lrs is None else list(lrs)
+        self.to(self.device)
+        self.opt = StackedAdam(
+            self.parameters(), torch.tensor([self.lrs[k] for k in self.slots])
+        )
+
+    def _reset_members(self, seeds):
+        for slot, k in enumerate(self.slots):
+            generator = torch.Generator().manual_seed(seeds[k])
+            for layer in self._layers():
+                bound = 1 / np.sqrt(layer.in_features)
+                with torch.no_grad():
+                    for p in (layer.weight, layer.bias):
+                        init = torch.empty(p.shape[1:]).uniform_(
+                            -bound, bound, generator=generator
+                        )
+                        p[slot].copy_(init)
+
+    def _layers(self):
+        return self.linear, self.linear2, self.linear3, self.head
+
+    def _act(self, x):
+        # relu in place, the matmuls don't keep their outputs for backward and
+        # fresh allocations of the large stacked activations are expensive
+        return x.relu_() if self.act is F.relu else self.act(x)
+
+    def _run(self, layer, x, start, stop):
+        """
+        layer applied to x with the weights of slots start:stop.
+        """
+        if start == 0 and stop == self.n_members:
+            return layer(x)
+        return torch.baddbmm(layer.bias[start:stop], x, layer.weight[start:stop])
+
+    def forward(self, x, y):
+        """
+        Returns the predictions of all members, [n_members, batch, action_dim].
+        """
+        if self.delta:
+            y = y - x
+        x = torch.cat([x, y], dim=-1)
+
+        batch = x.shape[0]
+        hidden_layers = (self.linear2, self.linear3, self.linear3)
+        outputs, start = [], 0
+        for depth, size in self.groups:
+            stop = start + size
+            # the input is shared, the first layers of a group are one
+            # [in, size * hidden] matmul
+            weight = self.linear.weight[start:stop].transpose(0, 1)
+            h = torch.addmm(
+                self.linear.bias[start:stop].reshape(-1),
+                x,
+                weight.reshape(-1, size * self.hidden),
+            )
+            h = self.act(h.view(batch, size, self.hidden).transpose(0, 1))
+            for layer in hidden_layers[: depth - 1]:
+                h = self._act(self._run(layer, h, start, stop))
+            outputs.append(self._run(self.head, h, start, stop))
+            start = stop
+
+        outputs = torch.cat(outputs) if len(outputs) > 1 else outputs[0]
+        return outputs if self.unsort is None else outputs[self.unsort]
+
+    def train(self, states, nstates, actions, eval=False):
+        """
+        Same as IVModel.train, returns the loss of every member.
+        """
+        actions = _to_tensor(actions, self.device)
+        this_state = _to_tensor(states, self.device)
+        next_state = _to_tensor(nstates, self.device)
+        if self.delta:
+            next_state = next_state - this_state
+
+        self.opt.zero_grad()
+        with self.precision.autocast():
+            predicted_action = self.forward(this_state, next_state)
+        loss = ((predicted_action.float() - actions) ** 2).mean(dim=(1, 2))
+        if not eval:
+            # members are independent, the sum gives each its own gradient
+            loss.sum().backward()
+            self.opt.step()
+        return loss.detach()
+
+    def member(self, k):
+        """
+        Member k as an IVModel with copied weights.
+        """
+        model = IVModel(self.cnf, self.depths[k], act=self.act, delta=self.delta)
+        layers = [
+            (model.linear, self.linear),
+            (model.linear2, self.linear2),
+            (model.linear3, self.linear3),
+            (model.head, self.head),
+        ]
+        slot = self.slots.index(k)
+        with torch.no_grad():
+            for target, stacked in layers:
+                target.weight.copy_(stacked.weight[slot].t())
+                target.bias.copy_(stacked.bias[slot, 0])
+        return model
+
+
+class StackedAdam:
+    """
+    Adam for stacked parameters [n_members, ...] with one learning rate per
+    member. Adam works elementwise, so the members stay independent.
+    """
+
+    def __init__(self, params, lrs, betas=(0.9, 0.999), eps=1e-8):
+        self.params = list(params)
+        self.lrs = lrs
+        self.betas = betas
+        self.eps = eps
+        self.t = 0
+        self.exp_avg = [torch.zeros_like(p) for p in self.params]
+        self.exp_avg_sq = [torch.zeros_like(p) for p in self.params]
+
+    def zero_grad(self):
+        for p in self.params:
+            p.grad = None
+
+    @torch.no_grad()
+    def step(self):
+        self.t += 1
+        beta1, beta2 = self.betas
+        bias1 = 1 - beta1**self.t
+        bias2 = 1 - beta2**self.t
+        for p, m, v in zip(self.params, self.exp_avg, self.exp_avg_sq):
+            if p.grad is None:
+                continue
+            m.lerp_(p.grad, 1 - beta1)
+            v.mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
+            lr = self.lrs.to(p.device).view(-1, *[1] * (p.dim() - 1))
+            denom = (v / bias2).sqrt_().add_(self.eps)
+            p.sub_(lr / bias1 * m / denom)
+
+    def state_dict(self):
+        return dict(t=self.t, exp_avg=self.exp_avg, exp_avg_sq=self.exp_avg_sq)
+
+    def load_state_dict(self, state):
+        # the learning rates are those of the current run, not of the saved one
+        self.t = state["t"]
+        saved = state["exp_avg"] + state["exp_avg_sq"]
+        for dst, src in zip(self.exp_avg + self.exp_avg_sq, saved):
+            dst.copy_(src)
@@ -1,5 +1,20 @@
+import os
+import importlib
+import traceback
+import torch
 import multiprocessing as mp
 from multiprocessing import Array
+from actor_learner import run_learner, connect_actor
+
+
+def load_experiment(path):
+    """
+    The Experiment class of an experiment module given as path or name,
+    e.g. experiments/icdl_ms1b.py.
+    """
+    experiment = path.split("/")[-1].split(".")[0]
+    module = importlib.import_module("." + experiment, package="experiments")
+    return getattr(module, "Experiment")
 
 
 class Runner:
@@ -14,19 +29,157 @@ class Runner:
         d = manager.dict()
         print("executing pre run hook")
         pre_run_results = self.exp.pre_run_hook(self.cnf)
+
+        queues = None
+        if self.cnf.main.policy == "td3" and self.cnf.td3.actor_learner:
+            print("starting learner")
+            queues = (mp.Queue(), mp.Queue())
+            finished = torch.zeros(self.cnf.mp.n_procs, dtype=torch.bool)
+            finished.share_memory_()
+            learner = mp.Process(
+                target=run_learner, args=(self.cnf, *queues, finished)
+            )
+            learner.start()
+
         for rank in range(self.cnf.mp.n_procs):
-            p = mp.Process(target=self._start_env, args=(rank, d, pre_run_results))
+            p = mp.Process(
+                target=self._start_env, args=(rank, d, pre_run_results, queues)
+            )
             p.start()
             processes.append(p)
 
-        for p in processes:
+        for rank, p in enumerate(processes):
             p.join()
+            if queues is not None:
+                # the learner must not wait for an actor that crashed
+                finished[rank] = True
+        if queues is not None:
+            learner.join()
 
         self.exp.plot(d, self.cnf)
 
-    def _start_env(self, rank, d, pre_run_results):
+    def _start_env(self, rank, d, pre_run_results, queues=None):
         self.cnf.env.torch_seed += rank
         self.cnf.env.np_seed += rank
         exp = self.exp(self.cnf, rank)
-        results = exp.run(pre_run_results)
-        d[rank] = results
+        if queues is None:
+            d[rank] = exp.run(pre_run_results)
+            return
+        connect_actor(exp.agent, rank, *queues)
+        try:
+            d[rank] = exp.run(pre_run_results)
+        finally:
+            exp.agent.disconnect()
+
+
+class WorkerPool:
+    """
+    Simulator processes that are kept alive across experiments. Each worker
+    launches CoppeliaSim once and runs the jobs it receives over a queue on
+    the same simulator, which is reseeded and reset between jobs (see
+    BaseExperiment and Env.reconfigure). PyRep can only launch one simulator
+    per process, so a worker whose job fails or needs a different scene or
+    sensors (Env.can_reuse) closes its simulator and exits, and the pool
+    starts a new worker in its place.
+
+    submit queues one job per rank (mp.n_procs) of an experiment, wait
+    collects the results and calls the plot hook of every finished
+    experiment with the results of its successful ranks, like Runner.run
+    does. wait returns the failed jobs.
+    """
+
+    def __init__(self, n_workers):
+        self.jobs = mp.Queue()
+        self.results = mp.Queue()
+        self.pending = {}
+        self.n_submitted = 0
+        self.workers = [self._start_worker(i) for i in range(n_workers)]
+
+    def _start_worker(self, index):
+        p = mp.Process(target=_worker, args=(index, self.jobs, self.results))
+        p.start()
+        return p
+
+    def submit(self, experiment, cnf):
+        if cnf.main.policy == "td3" and cnf.td3.actor_learner:
+            raise ValueError("the actor learner setup is not supported by the pool")
+        pre_run_results = load_experiment(experiment).pre_run_hook(cnf)
+        job = self.n_submitted
+        self.n_submitted += 1
+        self.pending[job] = (experiment, cnf, {})
+        for rank in range(cnf.mp.n_procs):
+            self.jobs.put((job, experiment, cnf, rank, pre_run_results))
+        return job
+
+    def wait(self):
+        """
+        Waits for all submitted jobs. Returns (job, experiment, failed ranks)
+        of every experiment with failed ranks.
+        """
+        failed = []
+        while self.pending:
+            job, rank, results = self.results.get()
+            if job is None:
+                # worker `rank` gave up its simulator and exited
+                self.workers[rank].join()
+                self.workers[rank] = self._start_worker(rank)
+                continue
+            experiment, cnf, d = self.pending[job]
+            d[rank] = results
+            if len(d) < cnf.mp.n_procs:
+                continue
+            del self.pending[job]
+            failed_ranks = sorted(r for r, result in d.items() if result is None)
+            if failed_ranks:
+                print(f"job {job} {experiment}: ranks {failed_ranks} failed")
+                failed.append((job, experiment, failed_ranks))
+            d = {r: result for r, result in d.items() if result is not None}
+            if d:
+                load_experiment(experiment).plot(d, cnf)
+        return failed
+
+    def close(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for p in self.workers:
+            p.join()
+
+
+def _worker(index, jobs, results):
+    import wandb
+    from environment import Env
+
+    env = None
+    try:
+        for job in iter(jobs.get, None):
+            job_id, experiment, cnf, rank, pre_run_results = job
+            if env is not None and not env.can_reuse(cnf):
+                # needs a new simulator, which only a new process can launch
+                jobs.put(job)
+                break
+            cnf.env.torch_seed += rank
+            cnf.env.np_seed += rank
+            if not cnf.wandb.name:
+                os.environ["WANDB_MODE"] = "dryrun"
+                os.environ["WANDB_DISABLE_CODE"] = "true"
+            else:
+                os.environ.pop("WANDB_MODE", None)
+                os.environ.pop("WANDB_DISABLE_CODE", None)
+            try:
+                if env is None:
+                    env = Env(cnf)
+                exp = load_experiment(experiment)(cnf, rank, env=env)
+                results.put((job_id, rank, exp.run(pre_run_results)))
+            except Exception:
+                traceback.print_exc()
+                results.put((job_id, rank, None))
+                # the simulator may be in any state, start over in a new process
+                break
+            finally:
+                wandb.join()
+        else:
+            return
+    finally:
+        if env is not None:
+            env.close()
+    results.put((None, index, None))
@@ -1,14 +1,20 @@
 import os
 import sys
-import importlib
 import multiprocessing as mp
 from omegaconf import OmegaConf
-from mp_runner import Runner
+from mp_runner import Runner, load_experiment
 
 
-def get_conf(path):
+def get_conf(path, overrides=None):
+    """
+    Loads the config and merges the command line, or the given list of
+    key=value overrides.
+    """
     cnf = OmegaConf.load(path)
-    cnf.merge_with_cli()
+    if overrides is None:
+        cnf.merge_with_cli()
+    else:
+        cnf.merge_with(OmegaConf.from_dotlist(overrides))
     OmegaConf.set_struct(cnf, True)
     return cnf
 
@@ -18,9 +24,7 @@ if __name__ == "__main__":
     mp.set_start_method("spawn")
 
     # dynamicall import the experiment
-    experiment = sys.argv[1].split("/")[-1].split(".")[0]
-    module = importlib.import_module("." + experiment, package="experiments")
-    exp = getattr(module, "Experiment")
+    exp = load_experiment(sys.argv[1])
 
     cnf = get_conf("conf/main.yaml")
     if not cnf.wandb.name:
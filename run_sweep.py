@@ -0,0 +1,35 @@
+"""
+Runs a sweep on a pool of persistent simulator workers instead of one
+run.py invocation per configuration.
+
+    python run_sweep.py sweep.txt [n_workers]
+
+Every non-empty line of sweep.txt holds the arguments of one run.py call,
+e.g. "experiments/icdl_ms2a.py main.with_im=False td3.alpha=0.1". By default
+there is one worker per rank of the largest experiment.
+"""
+import sys
+import multiprocessing as mp
+from mp_runner import WorkerPool
+from run import get_conf
+
+
+if __name__ == "__main__":
+
+    mp.set_start_method("spawn")
+
+    with open(sys.argv[1]) as f:
+        jobs = [line.split() for line in f if line.strip()]
+    cnfs = [get_conf("conf/main.yaml", overrides) for _, *overrides in jobs]
+    if len(sys.argv) > 2:
+        n_workers = int(sys.argv[2])
+    else:
+        n_workers = max(cnf.mp.n_procs for cnf in cnfs)
+
+    pool = WorkerPool(n_workers)
+    for (experiment, *_), cnf in zip(jobs, cnfs):
+        pool.submit(experiment, cnf)
+    failed = pool.wait()
+    pool.close()
+    if failed:
+        sys.exit(1)
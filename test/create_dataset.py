@@ -1,11 +1,10 @@
 from env.environment import Env
-from algo.ppo_cont import PPO, Memory
+from algo.ppo_cont import PPO, RolloutBuffer
 from utils import get_conf, prepare_wandb
 from algo.models import ICModule, MultiModalModule, MMAE
 import numpy as np
 import torch
-from utils import MMBuffer
-import pickle
+from utils import MultiModalBuffer
 from collections import namedtuple
 from torch.utils.tensorboard import SummaryWriter
 
@@ -15,7 +14,7 @@ action_dim = env.action_space.shape[0]
 action_dim = cnf.main.action_dim
 state_dim = env.observation_space.shape[0]
 agent = PPO(action_dim, state_dim, **cnf.ppo)
-memory = Memory()
+memory = RolloutBuffer(state_dim, action_dim)
 
 device = torch.device("cuda") if torch.cuda.is_available() else torch.device(
     "cpu")
@@ -28,34 +27,23 @@ trans = namedtuple(
     ('prop', 'tac', 'audio', 'prop_next', 'tac_next', 'audio_next', 'action'))
 
 
-def save_dataset(ds, name):
-    with open(f"data/mm-dataset-{name}.p", "wb") as f:
-        pickle.dump(ds, f)
-
-
-def load_dataset(name):
-    with open(f"data/mm-dataset-{name}.p", "rb") as f:
-        ds = pickle.load(f)
-    return ds
-
-
 # MMModule = MMAE(action_dim, **cnf.MMModel).to(device)
 # n_epochs = 5000
 # bsize = 10000
 # timestep = 0
 set_size = 100000
 test_set_proportion = 0.2
-train_set = MMBuffer(cnf.MMModel.tac_dim, cnf.MMModel.prop_dim,
-                     cnf.MMModel.audio_dim, action_dim,
-                     int((1 - test_set_proportion) * set_size))
-test_set = MMBuffer(cnf.MMModel.tac_dim, cnf.MMModel.prop_dim,
-                    cnf.MMModel.audio_dim, action_dim,
-                    int(test_set_proportion * set_size))
+train_set = MultiModalBuffer(cnf.MMModel.prop_dim, cnf.MMModel.tac_dim,
+                             cnf.MMModel.audio_dim, action_dim,
+                             int((1 - test_set_proportion) * set_size))
+test_set = MultiModalBuffer(cnf.MMModel.prop_dim, cnf.MMModel.tac_dim,
+                            cnf.MMModel.audio_dim, action_dim,
+                            int(test_set_proportion * set_size))
 state = env.reset()
 for i in range(set_size):
     if i % 50000 == 0:
         print("Currently at iteration:", i)
-    action, action_mean = agent.policy_old.act(state.get(), memory)
+    action, action_mean, _ = agent.policy.act(state.get(), memory)
     next_state, *_ = env.step(action.numpy())
     transition = trans(state.get_prop(), state.get_tac(), state.get_audio(),
                        next_state.get_prop(), next_state.get_tac(),
@@ -66,8 +54,10 @@ for i in range(set_size):
         train_set.push(transition)
     state = next_state
 
-print("Train set len:", train_set.cap)
-print("Test set len:", test_set.cap)
+print("Train set len:", len(train_set))
+print("Test set len:", len(test_set))
+train_set.save("data/mm-dataset-train")
+test_set.save("data/mm-dataset-test")
 # print(train_set.sample(1))
 # for i in range(n_epochs):
 #     for j in range(len(train_set.memory) // bsize):
@@ -82,7 +72,7 @@ print("Test set len:", test_set.cap)
 # for i in range(ds_size):
 #     if i % 10000 == 0:
 #         print("Iteration", i)
-#     action = agent.policy_old.act(state.get(), memory)
+#     action = agent.policy.act(state.get(), memory)
 #     next_state, *_ = env.step(action)
 #     # action_batch = torch.tensor(action).unsqueeze(0)
 #     # loss = MMModule.compute(state.as_tensor_list(),
@@ -94,6 +84,3 @@ print("Test set len:", test_set.cap)
 #         train_set.push(*state.as_tensor_list(), *next_state.as_tensor_list(),
 #                        action)
 #     state = next_state
-print("saving datasets")
-save_dataset(train_set, "train")
-save_dataset(test_set, "test")
@@ -10,7 +10,7 @@ from observation import Observation
 from env.environment import Env
 from agent import Agent
 from utils import RewardQueue, ValueQueue
-from algo.ppo_cont import PPO, Memory
+from algo.ppo_cont import PPO, RolloutBuffer
 from algo.models import ICModule
 from torch.utils.tensorboard import SummaryWriter
 from collections import defaultdict
@@ -1,5 +1,5 @@
 from env.environment import Env
-from algo.ppo_cont import PPO, Memory
+from algo.ppo_cont import PPO, RolloutBuffer
 from algo.models import ICModule
 from torch.utils.tensorboard import SummaryWriter
 from logger import Logger
@@ -53,7 +53,7 @@ action_dim = env.action_space.shape[0]
 action_dim = cnf.env.action_dim
 state_dim = env.observation_space.shape[0]
 agent = PPO(action_dim, state_dim, **cnf.ppo)
-memory = Memory()
+memory = RolloutBuffer(state_dim, action_dim)
 icmodule = ICModule(action_dim, state_dim, **cnf.icm)
 graph_win = GraphWindow(["app. ret"], 1, 1, lookback=10000)
 # win = GraphWindow(["reward", "reward raw", "return std", "value_fn"], 1, 4,
@@ -75,7 +75,7 @@ while True:
     j += 1
     value = 0
     timestep += 1
-    action, *_ = agent.policy_old.act(state.get(), memory)
+    action, *_ = agent.policy.act(state.get(), memory)
     next_state, reward, done, _ = env.step(action.numpy())
 
     if j == 1:
@@ -88,8 +88,8 @@ while True:
     # compute im reward
     im_loss = icmodule.train_forward(state.get(), next_state.get(), action)
     # im_loss_processed = icmodule._process_loss(im_loss)
-    memory.is_terminals.append(done)
-    memory.rewards.append(im_loss)
+    memory.append("is_terminals", float(done))
+    memory.append("rewards", im_loss)
 
     ret_Q.push(im_loss)
     val_Q.push(agent.get_value(next_state.get()))
@@ -101,7 +101,7 @@ while True:
         )
 
     if timestep % cnf.main.train_each == 0:
-        value = agent.policy_old.critic(memory.states[-1])
+        value = agent.policy.critic(memory.states[-1])
         ploss, vloss = agent.update(memory)
         memory.clear_memory()
         timestep = 0
@@ -1,6 +1,6 @@
 from utils import get_conf
 from env.environment import Env
-from algo.ppo_cont import PPO, Memory
+from algo.ppo_cont import PPO, RolloutBuffer
 from algo.models import ICModule
 from utils import GraphWindow, Plotter3D
 from pyrep.objects.shape import Shape
@@ -21,7 +21,7 @@ action_dim = env.action_space.shape[0]
 action_dim = cnf.main.action_dim
 state_dim = env.observation_space.shape[0]
 agent = PPO(action_dim, state_dim, **cnf.ppo)
-memory = Memory()
+memory = RolloutBuffer(state_dim, action_dim)
 icmodule = ICModule(action_dim, state_dim, **cnf.icm)
 
 state = env.reset()
@@ -35,7 +35,7 @@ sound_sphere = None
 # setup arm
 for i in range(50000):
     timestep += 1
-    action = agent.policy_old.act(state.get(), memory)
+    action, *_ = agent.policy.act(state.get(), memory)
     # print(action)
     # next_state, *_, info = env.step(
     #     [*action, *[0 for _ in range(7 - cnf.main.action_dim)]])
@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+from omegaconf import OmegaConf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def cnf():
+    cnf = OmegaConf.load(os.path.join(os.path.dirname(__file__), "..", "conf", "main.yaml"))
+    OmegaConf.set_struct(cnf, True)
+    return cnf
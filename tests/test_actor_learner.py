@@ -0,0 +1,27 @@
+import multiprocessing as mp
+import time
+
+import torch
+import torch.nn as nn
+
+from actor_learner import SharedPolicy, run_learner
+
+
+def test_learner_stops_if_actors_exit_before_connecting(cnf):
+    cnf.mp.n_procs = 2
+    finished = torch.ones(2, dtype=torch.bool)
+    start = time.time()
+    run_learner(cnf, mp.Queue(), mp.Queue(), finished)
+    assert time.time() - start < 10
+
+
+def test_publish_and_pull():
+    actor = nn.Linear(3, 2)
+    policy = SharedPolicy(actor, torch.zeros(1, dtype=torch.bool))
+    trained = nn.Linear(3, 2)
+    policy.publish(trained)
+    local = nn.Linear(3, 2)
+    assert policy.pull(local) == 2
+    for a, b in zip(local.parameters(), trained.parameters()):
+        torch.testing.assert_close(a, b)
+    assert not policy.all_finished()
@@ -0,0 +1,120 @@
+import numpy as np
+import torch
+
+from agent import Agent, TD3Agent
+from inverse_model import IVModel
+
+
+def fill_rollout(agent, n_steps):
+    for _ in range(n_steps):
+        states = np.random.randn(agent.n_envs, agent.state_dim).astype(np.float32)
+        agent.get_actions(states)
+        agent.set_reward(np.random.randn(agent.n_envs))
+        agent.set_is_done(np.zeros(agent.n_envs, dtype=bool))
+
+
+def test_random_reward_with_several_envs(cnf):
+    cnf.main.train_each = 8
+    agent = Agent(7, 7, cnf, "cpu", n_envs=3)
+    fill_rollout(agent, 8)
+    results = agent.train(train_fw=False, random_reward=True)
+    assert torch.isfinite(torch.as_tensor(results["ploss"]).detach())
+
+
+def test_inverse_reward_trains_both_heads(cnf):
+    torch.manual_seed(0)
+    cnf.main.train_each = 8
+    agent = Agent(7, 7, cnf, "cpu", n_envs=2)
+    fill_rollout(agent, 8)
+    for _ in range(8):
+        states = torch.randn(2, 7)
+        agent.append_icm_transition(states, states + 0.1, torch.randn(2, 7))
+    forward = [p.detach().clone() for p in agent.icm._forward.parameters()]
+    inverse = [p.detach().clone() for p in agent.icm._inverse.parameters()]
+
+    results = agent.train_with_inverse_reward()
+    assert results["imloss"].shape == results["fwloss"].shape == (16,)
+    for before, module in [
+        (forward, agent.icm._forward),
+        (inverse, agent.icm._inverse),
+    ]:
+        assert any(not torch.equal(a, b) for a, b in zip(before, module.parameters()))
+    assert len(agent.ppo_mem) == 0
+
+
+def test_overlapped_training_swaps_buffers_and_syncs_policy(cnf):
+    torch.manual_seed(0)
+    cnf.main.train_each = 8
+    cnf.main.overlap_training = True
+    agent = Agent(7, 7, cnf, "cpu", n_envs=2)
+    initial = [p.detach().clone() for p in agent.behaviour_policy.parameters()]
+
+    collected = []
+    for _ in range(2):
+        fill_rollout(agent, 8)
+        for _ in range(8):
+            states = torch.randn(2, 7)
+            agent.append_icm_transition(states, states + 0.1, torch.randn(2, 7))
+        collected.append(agent.ppo_mem)
+        collected.append(agent.train_async())
+        # the next rollout goes into the other, empty buffer
+        assert agent.ppo_mem is not collected[-2]
+        assert len(agent.ppo_mem) == 0
+
+    first, second = collected[1], collected[3]
+    assert first["imloss"].numel() == 0
+    assert second["imloss"].shape == (16,)
+    assert agent.wait()["imloss"].shape == (16,)
+    assert agent.behaviour_policy is not agent.ppo.policy
+    for acting, trained in zip(
+        agent.behaviour_policy.parameters(), agent.ppo.policy.parameters()
+    ):
+        torch.testing.assert_close(acting, trained)
+    assert any(
+        not torch.equal(p, b)
+        for p, b in zip(agent.behaviour_policy.parameters(), initial)
+    )
+
+
+def test_setters_take_one_value_per_env(cnf):
+    agent = Agent(7, 7, cnf, "cpu", n_envs=3)
+    agent.set_reward(np.array([1.0, 2.0, 3.0]))
+    agent.set_is_done(np.array([False, True, False]))
+    torch.testing.assert_close(
+        agent.ppo_mem.get("rewards"), torch.tensor([[1.0, 2.0, 3.0]])
+    )
+    torch.testing.assert_close(
+        agent.ppo_mem.get("is_terminals"), torch.tensor([[0.0, 1.0, 0.0]])
+    )
+
+
+def test_setters_take_scalars_with_one_env(cnf):
+    agent = Agent(7, 7, cnf, "cpu")
+    agent.set_reward(0.5)
+    agent.set_is_done(True)
+    assert agent.ppo_mem.get("rewards").flatten().tolist() == [0.5]
+    assert agent.ppo_mem.get("is_terminals").flatten().tolist() == [1.0]
+
+
+def test_td3_goal_actions_on_cpu(cnf):
+    dim = cnf.icm.embedding_size
+    agent = TD3Agent(cnf.env.action_dim, dim, cnf, "cpu", inverse_model=IVModel(cnf, 2))
+    states, goals = np.random.randn(3, dim), np.random.randn(3, dim)
+    actions = agent.get_actions(states, goals)
+    assert actions.shape == (3, cnf.env.action_dim)
+    assert np.abs(actions).max() <= 1
+
+
+def test_td3_carries_fractional_updates(cnf, monkeypatch):
+    cnf.td3.utd_ratio = 0.25
+    cnf.td3.train_every = 2
+    agent = TD3Agent(7, 7, cnf, "cpu")
+    updates = []
+    monkeypatch.setattr(
+        agent.policy,
+        "train",
+        lambda buffer, bsize, n_updates: updates.append(n_updates),
+    )
+    for _ in range(16):
+        agent.train()
+    assert updates == [1, 1, 1, 1]
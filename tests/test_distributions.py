@@ -0,0 +1,31 @@
+import pytest
+import torch
+from torch.distributions import MultivariateNormal
+
+from algo.distributions import DiagGaussianHead
+
+
+def test_matches_multivariate_normal():
+    torch.manual_seed(0)
+    loc, actions = torch.randn(2, 64, 7)
+    head = DiagGaussianHead(7, 0.7)
+    mvn = MultivariateNormal(loc, torch.diag(torch.full((7,), 0.7**2)))
+    dist = head(loc)
+    torch.testing.assert_close(dist.log_prob(actions), mvn.log_prob(actions))
+    torch.testing.assert_close(dist.entropy(), mvn.entropy())
+
+    samples = head(torch.zeros(100000, 7)).sample()
+    torch.testing.assert_close(samples.std(0), torch.full((7,), 0.7), atol=0.01, rtol=0)
+
+
+@pytest.mark.parametrize("learn_std", [False, True])
+def test_std_is_learned_only_on_request(learn_std):
+    head = DiagGaussianHead(7, 0.5, learn_std)
+    assert ("log_std" in head.state_dict()) == learn_std
+    assert len(list(head.parameters())) == int(learn_std)
+
+    loc = torch.zeros(16, 7, requires_grad=True)
+    head(loc).log_prob(torch.ones(16, 7)).sum().backward()
+    assert loc.grad is not None
+    if learn_std:
+        assert head.log_std.grad.abs().min() > 0
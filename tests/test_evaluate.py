@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import torch
+
+from evaluate import IVEvaluator
+from inverse_model import IVModel
+
+
+def loop_errors(model, tau, goals):
+    """
+    The per step loop IVEvaluator used before it was vectorized.
+    """
+    all_errors = []
+    for t, goal in zip(tau, goals):
+        errors_in_t = []
+        for state, nstate, action in t:
+            predicted_action = (
+                model(torch.tensor(state).float(), torch.tensor(goal).float())
+                .detach()
+                .numpy()
+            )
+            action = action / np.linalg.norm(action)
+            predicted_action = predicted_action / np.linalg.norm(predicted_action)
+            errors_in_t.append(np.linalg.norm(predicted_action - action) ** 2)
+        all_errors.append(errors_in_t)
+    return all_errors
+
+
+@pytest.fixture
+def trajectories(cnf):
+    rng = np.random.default_rng(0)
+    dim, action_dim = cnf.icm.embedding_size, cnf.env.action_dim
+    tau = [
+        [
+            (rng.normal(size=dim), rng.normal(size=dim), rng.normal(size=action_dim))
+            for _ in range(length)
+        ]
+        for length in (3, 5, 1)
+    ]
+    goals = [rng.normal(size=dim) for _ in tau]
+    return tau, goals
+
+
+def test_step_errors_match_loop(cnf, trajectories):
+    torch.manual_seed(0)
+    model = IVModel(cnf, 2)
+    tau, goals = trajectories
+    errors = IVEvaluator().evaluate(model, tau, goals)
+    for row, expected in zip(errors, loop_errors(model, tau, goals)):
+        np.testing.assert_allclose(row[: len(expected)], expected, rtol=1e-5)
+        assert np.isnan(row[len(expected) :]).all()
+
+
+def test_reduced_errors_match_loop(cnf, trajectories):
+    torch.manual_seed(0)
+    models = [IVModel(cnf, 1), IVModel(cnf, 3)]
+    tau, goals = trajectories
+    errors = IVEvaluator().evaluate(models, tau, goals, reduce=True)
+    for model, reduced in zip(models, errors):
+        expected = [sum(e) / len(tau) for e in loop_errors(model, tau, goals)]
+        np.testing.assert_allclose(reduced, expected, rtol=1e-5)
@@ -0,0 +1,38 @@
+import torch
+import torch.nn as nn
+
+from algo.inference import InferenceModule
+
+
+def make_module():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Linear(4, 8), nn.ReLU(), nn.Linear(8, 2))
+
+
+def test_frozen_graph_is_rebuilt_lazily():
+    module = make_module()
+    infer = InferenceModule(module, (torch.zeros(1, 4),), freeze=True)
+    x = torch.randn(3, 4)
+    torch.testing.assert_close(infer(x), module(x).detach())
+
+    with torch.no_grad():
+        module[0].weight.add_(1)
+    # the frozen graph keeps the old weights until it is refreshed
+    assert not torch.allclose(infer(x), module(x))
+    infer.refresh()
+    infer.refresh()
+    assert infer.compiled is None
+    torch.testing.assert_close(infer(x), module(x).detach())
+
+
+def test_shared_graph_follows_weights():
+    module = make_module()
+    infer = InferenceModule(module, (torch.zeros(1, 4),), freeze=False)
+    x = torch.randn(3, 4)
+    infer(x)
+    compiled = infer.compiled
+    with torch.no_grad():
+        module[0].weight.add_(1)
+    infer.refresh()
+    assert infer.compiled is compiled
+    torch.testing.assert_close(infer(x), module(x).detach())
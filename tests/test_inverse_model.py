@@ -0,0 +1,71 @@
+import pytest
+import torch
+
+from inverse_model import StackedIVModel
+
+
+@pytest.mark.parametrize("delta", [False, True])
+@pytest.mark.parametrize("depths", [[1, 2, 3, 4], [3, 1, 4, 2, 3], [2, 2, 2]])
+def test_member_export_matches_stacked(cnf, delta, depths):
+    torch.manual_seed(0)
+    seeds = list(range(len(depths)))
+    model = StackedIVModel(cnf, depths=depths, seeds=seeds, delta=delta)
+    x = torch.randn(16, cnf.icm.embedding_size)
+    y = torch.randn(16, cnf.icm.embedding_size)
+    with torch.no_grad():
+        stacked = model(x, y)
+        for k in range(model.n_members):
+            torch.testing.assert_close(model.member(k)(x, y), stacked[k])
+
+
+def test_members_train_independently(cnf):
+    torch.manual_seed(0)
+    x = torch.randn(32, cnf.icm.embedding_size)
+    y = torch.randn(32, cnf.icm.embedding_size)
+    a = torch.randn(32, cnf.env.action_dim)
+    pair = StackedIVModel(cnf, depths=[2, 3], lrs=[1e-3, 1e-2], seeds=[0, 1])
+    single = StackedIVModel(cnf, depths=[3], lrs=[1e-2], seeds=[1])
+    for _ in range(3):
+        pair_loss = pair.train(x, y, a)
+        single_loss = single.train(x, y, a)
+        torch.testing.assert_close(pair_loss[1:], single_loss)
+    with torch.no_grad():
+        torch.testing.assert_close(pair(x, y)[1], single(x, y)[0])
+
+
+def test_unsorted_members_keep_their_lr_and_seed(cnf):
+    torch.manual_seed(0)
+    x = torch.randn(32, cnf.icm.embedding_size)
+    y = torch.randn(32, cnf.icm.embedding_size)
+    a = torch.randn(32, cnf.env.action_dim)
+    stacked = StackedIVModel(
+        cnf, depths=[4, 1, 2], lrs=[1e-2, 1e-3, 3e-3], seeds=[5, 6, 7]
+    )
+    singles = [
+        StackedIVModel(cnf, depths=[depth], lrs=[lr], seeds=[seed])
+        for depth, lr, seed in zip([4, 1, 2], [1e-2, 1e-3, 3e-3], [5, 6, 7])
+    ]
+    for _ in range(3):
+        losses = stacked.train(x, y, a)
+        for k, single in enumerate(singles):
+            torch.testing.assert_close(losses[k : k + 1], single.train(x, y, a))
+
+
+def test_optimizer_state_follows_model(cnf):
+    model = StackedIVModel(cnf, depths=[1, 2])
+    for p, m in zip(model.opt.params, model.opt.exp_avg):
+        assert m.device == p.device
+
+
+def test_optimizer_keeps_current_lrs(cnf):
+    model = StackedIVModel(cnf, depths=[1, 2], lrs=[0.1, 0.2])
+    state = model.opt.state_dict()
+    other = StackedIVModel(cnf, depths=[1, 2], lrs=[0.3, 0.4])
+    other.opt.load_state_dict(state)
+    torch.testing.assert_close(other.opt.lrs, torch.tensor([0.3, 0.4]))
+
+
+def test_lrs_are_kept_in_member_order(cnf):
+    model = StackedIVModel(cnf, depths=[3, 1], lrs=[0.1, 0.2])
+    assert model.lrs == [0.1, 0.2]
+    torch.testing.assert_close(model.opt.lrs, torch.tensor([0.2, 0.1]))
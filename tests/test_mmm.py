@@ -0,0 +1,96 @@
+import pytest
+import torch
+
+from algo.mmm import MMAE, GroupedCoder, ModalityCoder, MultiModalModule, pack
+
+
+def coder_of_group(grouped, g):
+    """
+    A ModalityCoder with the weights of group g of a GroupedCoder.
+    """
+    layers = (grouped.fc1, grouped.fc2)
+    n_in, n_out = grouped.fc1.in_dims[g], grouped.fc1.out_dims[g]
+    coder = ModalityCoder(n_in, n_out)
+    with torch.no_grad():
+        for layer, grouped_layer in zip((coder.fc1, coder.fc2), layers):
+            rows = layer.in_features
+            layer.weight.copy_(grouped_layer.weight[g, :rows, :n_out].t())
+            layer.bias.copy_(grouped_layer.bias[g, 0, :n_out])
+    return coder
+
+
+def test_grouped_coder_matches_coder_per_modality():
+    torch.manual_seed(0)
+    dims, out_dims = [5, 3, 8], [4, 6, 2]
+    grouped = GroupedCoder(dims, out_dims)
+    xs = [torch.randn(10, d) for d in dims]
+    packed, _ = pack(xs, max(dims))
+    out = grouped(packed)
+    for g, (x, n_out) in enumerate(zip(xs, out_dims)):
+        torch.testing.assert_close(out[g, :, :n_out], coder_of_group(grouped, g)(x))
+        assert not out[g, :, n_out:].any()
+
+
+def make_model(**dims):
+    dims = {"prop_dim": 5, "tac_dim": 3, "audio_dim": 8, **dims}
+    return MultiModalModule(
+        7, latent_dim=16, lstm_hidden_size=12, lstm_layers=1, **dims
+    )
+
+
+def random_inputs(model, batch, steps=None):
+    lead = (batch,) if steps is None else (batch, steps)
+    states = [torch.randn(*lead, d) for d in model.dims]
+    return states, torch.randn(*lead, 7)
+
+
+def test_training_keeps_padding_zero_and_skips_empty_modalities():
+    torch.manual_seed(0)
+    model = make_model(tac_dim=0)
+    assert model.modalities == ["prop", "audio"]
+    states, action = random_inputs(model, 16)
+    next_states, _ = random_inputs(model, 16)
+    for _ in range(3):
+        model.compute(states, next_states, action)
+    # prop has fewer inputs than audio, its padded weights get no gradient
+    assert not model.encoder.fc1.weight[0, 5:].any()
+    assert not model.decoder.fc2.weight[0, :, 5:].any()
+
+
+def test_masked_modality_does_not_change_predictions():
+    torch.manual_seed(0)
+    model = make_model()
+    states, action = random_inputs(model, 4)
+    mask = torch.ones(4, 3)
+    mask[:, 1] = 0
+    before = model(states, action, mask)
+    states[1] = torch.randn_like(states[1])
+    for a, b in zip(before, model(states, action, mask)):
+        torch.testing.assert_close(a, b)
+
+
+def test_sequence_windows_keep_samples_apart():
+    torch.manual_seed(0)
+    model = make_model()
+    states, action = random_inputs(model, 4, steps=3)
+    before = model(states, action)
+    assert [x.shape for x in before] == [(4, d) for d in model.dims]
+    states[0][0] += 1
+    after = model(states, action)
+    for a, b in zip(before, after):
+        torch.testing.assert_close(a[1:], b[1:])
+        assert not torch.allclose(a[0], b[0])
+
+
+def test_mmae_trains_with_missing_modalities():
+    torch.manual_seed(0)
+    model = MMAE(7, 5, 3, 8, latent_dim=16, lstm_hidden_size=12, lstm_layers=1)
+    trans = type("Transition", (), {})()
+    for name, dim in zip(model.modalities, model.dims):
+        setattr(trans, name, torch.randn(16, dim))
+        setattr(trans, name + "_next", torch.randn(16, dim))
+    trans.action = torch.randn(16, 7)
+    mask = torch.ones(16, 3)
+    mask[:8, 2] = 0
+    losses = [model.compute(trans, mask).item() for _ in range(20)]
+    assert losses[-1] < losses[0]
@@ -0,0 +1,135 @@
+import pytest
+import torch
+
+from agent import Agent
+from algo.models import ConvModule, ICModule
+
+
+def test_conv_module_keeps_batch_dimension():
+    images = torch.randint(0, 256, (16, 64, 64, 3), dtype=torch.uint8)
+    encoder = ConvModule(3, 64, 7, channels_last=True)
+    assert encoder(images).shape == (16, 7)
+    assert encoder(images[0]).shape == (1, 7)
+
+
+def make_conv_icm(image_shape=(32, 32, 6)):
+    return ICModule(
+        7,
+        image_shape,
+        "cpu",
+        embedding_size=7,
+        alpha=0.001,
+        n_layers=2,
+        lr=0.001,
+        standardize_loss=False,
+        encoder="conv",
+    )
+
+
+def test_conv_icm_trains_encoder():
+    torch.manual_seed(0)
+    icm = make_conv_icm()
+    assert all(any(p is q for q in icm.parameters()) for p in icm.base.parameters())
+
+    images = torch.randint(0, 256, (8, 32, 32, 6), dtype=torch.uint8)
+    next_images = torch.randint(0, 256, (8, 32, 32, 6), dtype=torch.uint8)
+    actions = torch.randn(8, 7)
+    before = [p.clone() for p in icm.base.parameters()]
+    reward, iv_loss = icm.train_joint(images, next_images, actions)
+    assert reward.shape == iv_loss.shape == (8,)
+    assert any(not torch.equal(a, b) for a, b in zip(before, icm.base.parameters()))
+    assert icm.get_action(images, next_images).shape == (8, 7)
+
+
+def test_conv_icm_rejects_vector_state_dim():
+    with pytest.raises(TypeError):
+        make_conv_icm(image_shape=7)
+
+
+def test_agent_routes_image_shape(cnf):
+    cnf.icm.encoder = "conv"
+    cnf.main.train_each = 4
+    agent = Agent(7, 7, cnf, "cpu", image_shape=(32, 32, 6))
+    image = torch.zeros(32, 32, 6, dtype=torch.uint8)
+    agent.append_icm_transition(image, image, torch.zeros(7))
+    assert agent.ppo_mem.observations.shape == (1, 1, 32, 32, 6)
+    assert agent.ppo_mem.observations.dtype == torch.uint8
+
+    with pytest.raises(ValueError):
+        Agent(7, 7, cnf, "cpu")
+
+
+def snapshot(module):
+    return [p.detach().clone() for p in module.parameters()]
+
+
+def changed(before, module):
+    return any(not torch.equal(a, b) for a, b in zip(before, module.parameters()))
+
+
+@pytest.mark.parametrize(
+    "beta, forward_changes, inverse_changes",
+    [(0.0, False, True), (1.0, True, False), (0.2, True, True)],
+)
+def test_joint_update_weights_both_heads(beta, forward_changes, inverse_changes):
+    torch.manual_seed(0)
+    icm = ICModule(
+        7,
+        7,
+        "cpu",
+        embedding_size=7,
+        alpha=0.001,
+        n_layers=2,
+        lr=0.001,
+        standardize_loss=False,
+        beta=beta,
+    )
+    state, next_state, action = torch.randn(3, 16, 7)
+    forward, inverse = snapshot(icm._forward), snapshot(icm._inverse)
+    # same dropout masks as in the update
+    torch.manual_seed(1)
+    with torch.no_grad():
+        expected = ((icm._inverse(state, next_state) - action) ** 2).mean(dim=1)
+
+    torch.manual_seed(1)
+    reward, iv_loss = icm.train_joint(state, next_state, action)
+    assert reward.shape == (16,)
+    torch.testing.assert_close(iv_loss, expected)
+    assert changed(forward, icm._forward) == forward_changes
+    assert changed(inverse, icm._inverse) == inverse_changes
+
+
+def make_ensemble_icm(ensemble_size):
+    return ICModule(
+        7,
+        7,
+        "cpu",
+        embedding_size=7,
+        alpha=0.001,
+        n_layers=2,
+        lr=0.001,
+        standardize_loss=False,
+        ensemble_size=ensemble_size,
+    )
+
+
+def test_ensemble_loss_matches_bootstrap_resampling():
+    torch.manual_seed(0)
+    icm = make_ensemble_icm(4)
+    state, next_state, action = (
+        torch.randn(16, 7),
+        torch.randn(16, 7),
+        torch.randn(16, 7),
+    )
+
+    torch.manual_seed(1)
+    loss, reward = icm._train_ensemble(state, next_state, action)
+    torch.manual_seed(1)
+    idx = torch.randint(16, (4, 16))
+    with torch.no_grad():
+        resampled = icm._forward.predict(state[idx], action[idx])
+        prediction = icm._forward.predict(state, action)
+    expected = ((resampled - next_state[idx]) ** 2).mean(dim=(1, 2))
+    torch.testing.assert_close(loss.mean(dim=(1, 2)), expected)
+    torch.testing.assert_close(reward, prediction.var(dim=0))
+    assert reward.shape == (16, 7)
@@ -0,0 +1,112 @@
+import os
+import sys
+import types
+
+import pytest
+from omegaconf import OmegaConf
+
+import mp_runner
+
+
+class FakeEnv:
+    """
+    Stands in for the simulator, launches and closes are logged to a file
+    since they happen in the worker processes.
+    """
+
+    log = None
+
+    def __init__(self, cnf):
+        self.scene = cnf.env.scene
+        self._write("launch")
+
+    def _write(self, event):
+        with open(FakeEnv.log, "a") as f:
+            f.write(f"{event} {os.getpid()}\n")
+
+    def can_reuse(self, cnf):
+        return cnf.env.scene == self.scene
+
+    def close(self):
+        self._write("close")
+
+
+class FakeExperiment:
+    plotted = []
+
+    def __init__(self, cnf, rank, env=None):
+        if rank in cnf.fail_ranks:
+            raise RuntimeError("broken job")
+        self.env = env
+
+    @staticmethod
+    def pre_run_hook(cnf):
+        return None
+
+    def run(self, pre_run_results):
+        return os.getpid()
+
+    @staticmethod
+    def plot(results, cnf):
+        FakeExperiment.plotted.append(results)
+
+
+def make_cnf(scene="table", fail_ranks=()):
+    return OmegaConf.create(
+        dict(
+            main=dict(policy="ppo"),
+            td3=dict(actor_learner=False),
+            mp=dict(n_procs=2),
+            env=dict(torch_seed=0, np_seed=0, scene=scene),
+            wandb=dict(name=""),
+            fail_ranks=list(fail_ranks),
+        )
+    )
+
+
+@pytest.fixture
+def fakes(monkeypatch, tmp_path):
+    # the workers are forked and inherit the fake modules
+    FakeEnv.log = str(tmp_path / "env.log")
+    FakeExperiment.plotted = []
+    monkeypatch.setitem(sys.modules, "environment", types.SimpleNamespace(Env=FakeEnv))
+    monkeypatch.setitem(sys.modules, "wandb", types.SimpleNamespace(join=lambda: None))
+    monkeypatch.setitem(
+        sys.modules,
+        "experiments.fake",
+        types.SimpleNamespace(Experiment=FakeExperiment),
+    )
+    monkeypatch.setattr(
+        mp_runner.mp, "Process", mp_runner.mp.get_context("fork").Process
+    )
+    monkeypatch.setattr(mp_runner.mp, "Queue", mp_runner.mp.get_context("fork").Queue)
+
+
+def read_log():
+    with open(FakeEnv.log) as f:
+        return [line.split() for line in f]
+
+
+def test_failed_jobs_are_reported_and_workers_recycled(fakes):
+    pool = mp_runner.WorkerPool(1)
+    pool.submit("fake", make_cnf(fail_ranks=[1]))
+    pool.submit("fake", make_cnf())
+    pool.submit("fake", make_cnf(scene="shelf"))
+    failed = pool.wait()
+    pool.close()
+
+    assert failed == [(0, "fake", [1])]
+    assert [sorted(results) for results in FakeExperiment.plotted] == [
+        [0],
+        [0, 1],
+        [0, 1],
+    ]
+    first, second, third = [results[0] for results in FakeExperiment.plotted]
+    # the failed job and the scene change each moved on to a new process
+    assert len({first, second, third}) == 3
+
+    log = read_log()
+    assert [event for event, _ in log] == ["launch", "close"] * 3
+    # every simulator is closed by the process that launched it
+    for (_, launched), (_, closed) in zip(log[::2], log[1::2]):
+        assert launched == closed
@@ -0,0 +1,32 @@
+import torch
+
+from algo.normalizer import RewardNormalizer
+
+
+def reference_returns(rewards, gamma):
+    ret, returns = 0.0, []
+    for r in rewards:
+        ret = r + gamma * ret
+        returns.append(ret)
+    return returns
+
+
+def test_return_mode_accumulates_per_env():
+    torch.manual_seed(0)
+    n_envs, gamma = 3, 0.9
+    normalizer = RewardNormalizer("return", gamma=gamma, momentum=None, n_envs=n_envs)
+    # two rollouts of [T, n_envs] flattened like Agent.icm_batch
+    rollouts = [torch.rand(5, n_envs), torch.rand(4, n_envs)]
+    for rewards in rollouts:
+        normalizer.update(rewards.flatten(0, 1).unsqueeze(1))
+
+    rewards = torch.cat(rollouts)
+    expected = torch.tensor(
+        [reference_returns(rewards[:, env].tolist(), gamma) for env in range(n_envs)]
+    ).T
+    torch.testing.assert_close(normalizer.ret, expected[-1])
+
+    stats = RewardNormalizer("scalar", momentum=None).stats
+    stats.update(expected)
+    torch.testing.assert_close(normalizer.stats.mean, stats.mean)
+    torch.testing.assert_close(normalizer.stats.var, stats.var)
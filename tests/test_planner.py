@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import torch
+
+from algo.planner import MPCPlanner, goal_reward
+
+
+def step(states, actions):
+    # the action moves the state directly
+    return actions
+
+
+def test_unknown_method_raises():
+    with pytest.raises(ValueError):
+        MPCPlanner(step, 3, method="random")
+
+
+def test_rollout_matches_loop_over_sequences():
+    torch.manual_seed(0)
+    weight = torch.randn(5, 3)
+
+    def dynamics(states, actions):
+        return torch.tanh(states @ weight[:3] + actions @ weight[3:])
+
+    planner = MPCPlanner(dynamics, 2, horizon=4, delta=True)
+    state, goal = torch.randn(1, 3), torch.randn(1, 3)
+    actions = torch.randn(6, 4, 2)
+
+    expected = []
+    for sequence in actions:
+        s, ret = state, 0
+        for a in sequence:
+            s = s + dynamics(s, a[None])
+            ret += goal_reward(s, goal)
+        expected.append(ret)
+    torch.testing.assert_close(
+        planner.rollout(state, goal, actions), torch.cat(expected)
+    )
+
+
+@pytest.mark.parametrize("method", ["cem", "mppi"])
+def test_plan_heads_for_goal_and_warm_starts(cnf, method):
+    torch.manual_seed(0)
+    cnf.planner.method = method
+    cnf.planner.n_samples = 300
+    cnf.planner.n_elites = 30
+    planner = MPCPlanner(step, 3, delta=True, **cnf.planner)
+    goal = np.array([5.0, -5.0, 0.0])
+
+    action = planner.plan(np.zeros(3), goal)
+    assert np.abs(action).max() <= 1
+    cosine = action @ goal / (np.linalg.norm(action) * np.linalg.norm(goal))
+    assert cosine > 0.9
+    assert planner.mean.shape == (cnf.planner.horizon, 3)
+    assert not planner.mean[-1].any()
+
+    planner.reset()
+    assert not planner.mean.any()
@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+from algo.ppo_cont import PPO, RolloutBuffer
+
+
+def test_intrinsic_rewards_replace_extrinsic_rewards():
+    memory = RolloutBuffer(3, 2, capacity=2, n_envs=2)
+    for t in range(3):
+        memory.append("states", torch.zeros(2, 3))
+        memory.append("rewards", torch.full((2,), float(t)))
+    torch.testing.assert_close(memory.total_rewards(), memory.rewards)
+
+    intrinsic = torch.arange(6.0)
+    memory.set("intrinsic_rewards", intrinsic)
+    torch.testing.assert_close(memory.total_rewards(), intrinsic.reshape(3, 2))
+
+    memory.clear_memory()
+    assert len(memory.total_rewards()) == 0
+
+
+def make_rollout(ppo, n_steps, n_envs=1):
+    memory = RolloutBuffer(4, 2, capacity=n_steps, n_envs=n_envs)
+    for _ in range(n_steps):
+        ppo.policy.act(torch.randn(n_envs, 4), memory)
+        memory.append("rewards", torch.randn(n_envs))
+        memory.append("is_terminals", torch.zeros(n_envs))
+    return memory
+
+
+def count_steps(ppo):
+    steps = []
+    step = ppo.optimizer.step
+    ppo.optimizer.step = lambda: steps.append(None) or step()
+    return steps
+
+
+@pytest.mark.filterwarnings("error")
+@pytest.mark.parametrize("minibatch_size, n_minibatches", [(4, 2), (3, 3), (None, 1)])
+def test_minibatches_without_remainder(cnf, minibatch_size, n_minibatches):
+    torch.manual_seed(0)
+    ppo = PPO(2, 4, "cpu", **{**cnf.ppo, "minibatch_size": minibatch_size})
+    steps = count_steps(ppo)
+    memory = make_rollout(ppo, 10)
+    ppo.update(memory)
+    assert len(steps) == cnf.ppo.K_epochs * n_minibatches
+
+
+def test_kl_early_stopping(cnf):
+    torch.manual_seed(0)
+    ppo = PPO(
+        2, 4, "cpu", **{**cnf.ppo, "lr": 0.1, "minibatch_size": 5, "target_kl": 1e-6}
+    )
+    steps = count_steps(ppo)
+    memory = make_rollout(ppo, 10)
+    ppo.update(memory)
+    # the first epoch moves the policy far beyond the target, no second one
+    assert len(steps) == 2
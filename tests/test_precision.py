@@ -0,0 +1,38 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from algo.precision import Precision, check_accuracy
+from inverse_model import FWModel
+
+
+def test_unknown_precision_raises():
+    with pytest.raises(ValueError):
+        Precision("fp16")
+
+
+def test_bf16_keeps_float32_weights_and_loss(cnf):
+    torch.manual_seed(0)
+    cnf.main.iv_precision = "bf16"
+    model = FWModel(cnf)
+    states, actions, nstates = torch.randn(3, 64, 7)
+
+    with model.precision.autocast():
+        assert model(states, actions).dtype == torch.bfloat16
+    losses = [model.train(states, nstates, actions).item() for _ in range(20)]
+    loss = model.train(states, nstates, actions, eval=True)
+
+    assert loss.dtype == torch.float32
+    assert losses[-1] < losses[0]
+    for param in model.parameters():
+        assert param.dtype == torch.float32
+        assert all(v.dtype == torch.float32 for v in model.opt.state[param].values())
+
+
+def test_bf16_training_tracks_fp32():
+    torch.manual_seed(0)
+    inputs = torch.randn(2000, 14)
+    targets = torch.tanh(inputs[:, :7] - inputs[:, 7:])
+    model = nn.Sequential(nn.Linear(14, 64), nn.ReLU(), nn.Linear(64, 7))
+    results = check_accuracy(model, inputs, targets, steps=200, bsize=64)
+    assert results["rel_diff"] < 0.1
@@ -0,0 +1,61 @@
+import pytest
+import torch
+
+from algo.returns import discounted_returns, gae
+
+
+def loop_returns(rewards, dones, gamma, bootstrap):
+    ret, returns = bootstrap, []
+    for r, d in zip(reversed(rewards), reversed(dones)):
+        ret = r + gamma * (1 - d) * ret
+        returns.insert(0, ret)
+    return returns
+
+
+def loop_gae(rewards, values, dones, gamma, lam, last_value):
+    adv, advantages = 0.0, []
+    next_value = last_value
+    for r, v, d in zip(reversed(rewards), reversed(values), reversed(dones)):
+        delta = r + gamma * (1 - d) * next_value - v
+        adv = delta + gamma * lam * (1 - d) * adv
+        advantages.insert(0, adv)
+        next_value = v
+    return advantages
+
+
+@pytest.mark.parametrize("length", [1, 2, 7, 16, 33])
+def test_discounted_returns_match_loop(length):
+    torch.manual_seed(length)
+    rewards = torch.randn(length, 3, dtype=torch.float64)
+    dones = torch.rand(length, 3) < 0.2
+    bootstrap = torch.randn(3, dtype=torch.float64)
+
+    returns = discounted_returns(rewards, dones, 0.95, bootstrap)
+
+    for env in range(3):
+        expected = loop_returns(
+            rewards[:, env].tolist(),
+            dones[:, env].float().tolist(),
+            0.95,
+            bootstrap[env].item(),
+        )
+        torch.testing.assert_close(
+            returns[:, env], torch.tensor(expected, dtype=torch.float64)
+        )
+
+
+@pytest.mark.parametrize("length", [1, 5, 16, 33])
+def test_gae_matches_loop(length):
+    torch.manual_seed(length)
+    rewards = torch.randn(length, dtype=torch.float64)
+    values = torch.randn(length, dtype=torch.float64)
+    dones = torch.rand(length) < 0.2
+
+    advantages, targets = gae(rewards, values, dones, 0.99, 0.95, last_value=0.5)
+
+    expected = loop_gae(
+        rewards.tolist(), values.tolist(), dones.float().tolist(), 0.99, 0.95, 0.5
+    )
+    expected = torch.tensor(expected, dtype=torch.float64)
+    torch.testing.assert_close(advantages, expected)
+    torch.testing.assert_close(targets, expected + values)
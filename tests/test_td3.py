@@ -0,0 +1,149 @@
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from algo.target import soft_update
+from algo.td3 import TD3
+
+
+class TwinCritic(nn.Module):
+    """
+    The critic layout of checkpoints written before the stacked critic.
+    """
+
+    def __init__(self, state_dim, action_dim):
+        super().__init__()
+        self.l1 = nn.Linear(state_dim + action_dim, 256)
+        self.l2 = nn.Linear(256, 256)
+        self.l3 = nn.Linear(256, 1)
+        self.l4 = nn.Linear(state_dim + action_dim, 256)
+        self.l5 = nn.Linear(256, 256)
+        self.l6 = nn.Linear(256, 1)
+
+    def forward(self, state, action):
+        sa = torch.cat([state, action], 1)
+        q1 = self.l3(F.relu(self.l2(F.relu(self.l1(sa)))))
+        q2 = self.l6(F.relu(self.l5(F.relu(self.l4(sa)))))
+        return q1, q2
+
+
+def write_twin_checkpoint(path, state_dim, action_dim):
+    torch.manual_seed(0)
+    critic = TwinCritic(state_dim, action_dim)
+    optimizer = torch.optim.Adam(critic.parameters(), lr=1e-4)
+    state, action = torch.randn(8, state_dim), torch.randn(8, action_dim)
+    for _ in range(2):
+        optimizer.zero_grad()
+        sum(q.sum() for q in critic(state, action)).backward()
+        optimizer.step()
+
+    td3 = TD3(state_dim, action_dim, 1)
+    td3.save(path)
+    torch.save(critic.state_dict(), path + "_critic")
+    torch.save(optimizer.state_dict(), path + "_critic_optimizer")
+    return critic, optimizer
+
+
+def test_load_twin_critic_checkpoint(tmp_path):
+    state_dim, action_dim = 5, 3
+    path = str(tmp_path / "td3")
+    critic, optimizer = write_twin_checkpoint(path, state_dim, action_dim)
+
+    td3 = TD3(state_dim, action_dim, 1)
+    td3.load(path)
+
+    state, action = torch.randn(4, state_dim), torch.randn(4, action_dim)
+    with torch.no_grad():
+        for new, old in zip(td3.critic(state, action), critic(state, action)):
+            torch.testing.assert_close(new, old)
+        torch.testing.assert_close(
+            td3.critic.Q1(state, action), critic(state, action)[0]
+        )
+
+    old_state = optimizer.state_dict()["state"]
+    new_state = td3.critic_optimizer.state_dict()["state"]
+    torch.testing.assert_close(
+        new_state[0]["exp_avg"],
+        torch.stack([old_state[0]["exp_avg"].t(), old_state[6]["exp_avg"].t()]),
+    )
+    torch.testing.assert_close(
+        new_state[5]["exp_avg_sq"],
+        torch.stack(
+            [old_state[5]["exp_avg_sq"][None], old_state[11]["exp_avg_sq"][None]]
+        ),
+    )
+
+
+def test_load_keeps_training(tmp_path):
+    state_dim, action_dim = 5, 3
+    path = str(tmp_path / "td3")
+    write_twin_checkpoint(path, state_dim, action_dim)
+    td3 = TD3(state_dim, action_dim, 1)
+    td3.load(path)
+    q1, q2 = td3.critic(torch.randn(4, state_dim), torch.randn(4, action_dim))
+    td3.critic_optimizer.zero_grad()
+    (q1.sum() + q2.sum()).backward()
+    td3.critic_optimizer.step()
+
+
+@pytest.mark.parametrize("redq_subset, actor_moves", [(None, False), (2, True)])
+def test_actor_objective_uses_all_critics_with_redq(redq_subset, actor_moves):
+    torch.manual_seed(0)
+    td3 = TD3(5, 3, 1, n_critics=4, redq_subset=redq_subset)
+    with torch.no_grad():
+        # only the last critic depends on the action
+        td3.critic.l3.weight[:3].zero_()
+    before = [p.clone() for p in td3.actor.parameters()]
+    td3.train_actor(torch.randn(8, 5))
+    moved = any(not torch.equal(p, b) for p, b in zip(td3.actor.parameters(), before))
+    assert moved == actor_moves
+
+
+def polyak(online, target, tau):
+    return [tau * p + (1 - tau) * t for p, t in zip(online, target)]
+
+
+def test_update_targets_matches_polyak_loop():
+    torch.manual_seed(0)
+    td3 = TD3(5, 3, 1, tau=0.1)
+    for net in (td3.critic, td3.actor):
+        with torch.no_grad():
+            for p in net.parameters():
+                p.add_(torch.randn_like(p))
+    expected = [
+        polyak(online.parameters(), target.parameters(), 0.1)
+        for online, target in [
+            (td3.critic, td3.critic_target),
+            (td3.actor, td3.actor_target),
+        ]
+    ]
+    td3.update_targets()
+    for target, params in zip([td3.critic_target, td3.actor_target], expected):
+        for p, e in zip(target.parameters(), params):
+            torch.testing.assert_close(p, e)
+
+
+def test_soft_update_without_foreach_lerp(monkeypatch):
+    torch.manual_seed(0)
+    online, target = [torch.randn(4, 3), torch.randn(2)], [
+        torch.randn(4, 3),
+        torch.randn(2),
+    ]
+    expected = polyak(online, target, 0.3)
+    monkeypatch.delattr(torch, "_foreach_lerp_")
+    soft_update(target, online, 0.3)
+    for t, e in zip(target, expected):
+        torch.testing.assert_close(t, e)
+
+
+def test_targets_follow_loaded_networks(tmp_path):
+    path = str(tmp_path / "td3")
+    write_twin_checkpoint(path, 5, 3)
+    td3 = TD3(5, 3, 1, tau=1.0)
+    td3.load(path)
+    with torch.no_grad():
+        for p in td3.actor.parameters():
+            p.zero_()
+    td3.update_targets()
+    assert all(not p.any() for p in td3.actor_target.parameters())
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import torch
+
+from algo.touch import bit_counts, n_words, pack_bits, popcount, unpack_bits
+from utils import MultiModalBuffer, mm_transition
+
+
+@pytest.mark.parametrize("n_bits", [1, 28, 32, 33, 70])
+def test_pack_unpack_roundtrip(n_bits):
+    rng = np.random.default_rng(n_bits)
+    touch = rng.integers(0, 2, size=(5, 3, n_bits))
+    packed = pack_bits(touch)
+    assert packed.dtype == np.uint32
+    assert packed.shape == (5, 3, n_words(n_bits))
+    unpacked = unpack_bits(packed, n_bits)
+    np.testing.assert_array_equal(unpacked.numpy(), touch)
+
+
+def test_bit_layout():
+    touch = np.zeros(40)
+    touch[[0, 5, 31, 32]] = 10
+    np.testing.assert_array_equal(pack_bits(touch), [1 | 1 << 5 | 1 << 31, 1])
+
+
+def test_popcount_and_bit_counts():
+    rng = np.random.default_rng(0)
+    touch = rng.integers(0, 2, size=(100, 70))
+    packed = pack_bits(touch)
+    np.testing.assert_array_equal(popcount(packed), touch.sum(-1))
+    np.testing.assert_array_equal(bit_counts(packed, 70), touch.sum(0))
+    assert popcount(np.array([0xFFFFFFFF], dtype=np.uint32)) == 32
+
+
+def make_transition(rng, tac):
+    return mm_transition(
+        prop=rng.normal(size=7),
+        tac=tac,
+        audio=rng.normal(size=2),
+        prop_next=rng.normal(size=7),
+        tac_next=tac,
+        audio_next=rng.normal(size=2),
+        action=rng.normal(size=7),
+    )
+
+
+@pytest.mark.parametrize("tac_format", ["bits", "uint8"])
+def test_buffer_decodes_touches_to_observation_scale(tac_format):
+    rng = np.random.default_rng(0)
+    buffer = MultiModalBuffer(7, 28, 2, 7, 4, tac_format=tac_format)
+    tac = rng.integers(0, 2, size=28) * 10.0
+    buffer.push(make_transition(rng, tac))
+    batch = buffer.get(np.array([0]))
+    np.testing.assert_array_equal(batch.tac[0].numpy(), tac)
+
+
+@pytest.mark.parametrize("tac_format", ["bits", "uint8"])
+def test_buffer_save_load(tmp_path, tac_format):
+    rng = np.random.default_rng(0)
+    buffers = []
+    for rank in range(2):
+        buffer = MultiModalBuffer(7, 28, 2, 7, 5, tac_format=tac_format)
+        for _ in range(5):
+            buffer.push(make_transition(rng, rng.integers(0, 2, size=28) * 10.0))
+        buffer.save(str(tmp_path / str(rank)), chunk_size=2)
+        buffers.append(buffer)
+
+    merged = MultiModalBuffer.load([str(tmp_path / "0"), str(tmp_path / "1")])
+    assert len(merged) == 10
+    for key, column in merged.columns.items():
+        expected = np.concatenate([b.columns[key] for b in buffers])
+        np.testing.assert_array_equal(column, expected)
+    torch.testing.assert_close(
+        merged.get(np.arange(5)).tac, buffers[0].get(np.arange(5)).tac
+    )
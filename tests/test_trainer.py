@@ -0,0 +1,87 @@
+import pytest
+import torch
+
+from inverse_model import IVModel
+from trainer import SupervisedTrainer, TransitionDataset
+
+
+def make_dataset(cnf, n=64):
+    g = torch.Generator().manual_seed(0)
+    dim = cnf.icm.embedding_size
+    return TransitionDataset(
+        torch.randn(n, dim, generator=g),
+        torch.randn(n, dim, generator=g),
+        torch.randn(n, cnf.env.action_dim, generator=g),
+    )
+
+
+def make_trainer(cnf, tmp_path, n_steps, **kwargs):
+    torch.manual_seed(0)
+    data = make_dataset(cnf)
+    kwargs = {
+        **dict(
+            bsize=16,
+            n_steps=n_steps,
+            eval_every=2,
+            patience=100,
+            checkpoint_dir=str(tmp_path),
+            checkpoint_every=2,
+            log=lambda result: None,
+        ),
+        **kwargs,
+    }
+    return SupervisedTrainer(IVModel(cnf, 2), data, data, **kwargs)
+
+
+def test_resume_continues_from_checkpoint(cnf, tmp_path):
+    first = make_trainer(cnf, tmp_path, 4, config=dict(lr=1))
+    first.fit()
+    assert isinstance(first.best_loss, float)
+
+    resumed = make_trainer(cnf, tmp_path, 6, resume=True, config=dict(lr=1))
+    resumed.fit()
+    assert resumed.step == 6
+    assert [r["step"] for r in resumed.history] == [2, 4, 6]
+
+
+def test_resume_of_finished_run_returns_early(cnf, tmp_path):
+    make_trainer(cnf, tmp_path, 4).fit()
+    trainer = make_trainer(cnf, tmp_path, 4, resume=True)
+    history = trainer.fit()
+    assert trainer.step == 4
+    assert len(history) == 2
+
+
+def test_resume_rejects_other_config(cnf, tmp_path):
+    make_trainer(cnf, tmp_path, 2, config=dict(lr=1)).fit()
+    with pytest.raises(ValueError):
+        make_trainer(cnf, tmp_path, 4, resume=True, config=dict(lr=2)).fit()
+
+
+def test_checkpoint_is_not_resumed_by_default(cnf, tmp_path):
+    make_trainer(cnf, tmp_path, 4).fit()
+    trainer = make_trainer(cnf, tmp_path, 2)
+    trainer.fit()
+    assert trainer.step == 2
+
+
+def test_checkpoint_loads_with_weights_only(cnf, tmp_path):
+    make_trainer(cnf, tmp_path, 4).fit()
+    torch.load(tmp_path / "trainer.pt", weights_only=True)
+
+
+def test_in_memory_epochs_visit_every_transition_once(cnf, tmp_path):
+    trainer = make_trainer(cnf, tmp_path, None, n_epochs=2)
+    data = trainer.train_set
+    batches = list(trainer._batches())
+    assert len(batches) == 2 * len(data) // 16
+    assert trainer.epoch == 2
+    first_epoch = torch.cat([states for states, _, _ in batches[:4]])
+    assert torch.equal(first_epoch.sort(dim=0).values, data.states.sort(dim=0).values)
+
+
+@pytest.mark.parametrize("num_workers", [0, 1])
+def test_fit_runs_all_steps(cnf, tmp_path, num_workers):
+    trainer = make_trainer(cnf, tmp_path, None, n_epochs=2, num_workers=num_workers)
+    trainer.fit()
+    assert trainer.step == 2 * 64 // 16
@@ -0,0 +1,251 @@
+"""
+Supervised training of the models that learn from (state, next state,
+action) transitions, IVModel and FWModel. Any model with the
+train(states, nstates, actions, eval=False) -> loss method of these works.
+Models that train several members at once (StackedIVModel) return one loss
+per member, which are logged as lists.
+"""
+import os
+import copy
+import time
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler
+
+
+class TransitionDataset(Dataset):
+    """
+    Transitions stored as three contiguous float32 tensors in shared memory,
+    so that loader workers get them without copying. Indexing with a list of
+    indices returns a whole batch, which saves the per sample collation.
+    """
+
+    def __init__(self, states, nstates, actions):
+        self.states = torch.as_tensor(states, dtype=torch.float32).share_memory_()
+        self.nstates = torch.as_tensor(nstates, dtype=torch.float32).share_memory_()
+        self.actions = torch.as_tensor(actions, dtype=torch.float32).share_memory_()
+
+    @classmethod
+    def from_transitions(cls, transitions):
+        """
+        Builds the dataset from a sequence of (state, nstate, action) tuples,
+        the format of our datasets on disk.
+        """
+        states, nstates, actions = zip(*transitions)
+        return cls(np.stack(states), np.stack(nstates), np.stack(actions))
+
+    def __len__(self):
+        return len(self.states)
+
+    def __getitem__(self, idx):
+        return self.states[idx], self.nstates[idx], self.actions[idx]
+
+
+def _loss_value(loss):
+    return loss.item() if loss.numel() == 1 else loss.tolist()
+
+
+class SupervisedTrainer:
+    """
+    Trains a model for n_steps batches sampled with replacement, or for
+    n_epochs passes over shuffled batches. By default batches are indexed
+    from the in-memory dataset in the main process. num_workers > 0 prefetches
+    them in persistent loader processes instead, which only pays off for
+    datasets that are expensive to index. Every eval_every steps the model is
+    evaluated on the test set, which is moved to the device once. With
+    patience, training stops after that many evaluations without
+    improvement and the best weights are restored (for several members,
+    improvement of their mean loss). With checkpoint_dir, the
+    model, its optimizer and the trainer state are saved every
+    checkpoint_every steps. With resume, training continues from an existing
+    checkpoint, which must have been written with the same config (any
+    picklable description of the run, e.g. a dict of hyperparameters).
+    """
+
+    def __init__(
+        self,
+        model,
+        train_set,
+        test_set=None,
+        bsize=1000,
+        n_steps=None,
+        n_epochs=None,
+        eval_every=1000,
+        patience=None,
+        checkpoint_dir=None,
+        checkpoint_every=5000,
+        resume=False,
+        config=None,
+        num_workers=0,
+        log=print,
+    ):
+        if (n_steps is None) == (n_epochs is None):
+            raise ValueError("set exactly one of n_steps and n_epochs")
+        self.model = model
+        self.train_set = train_set
+        self.bsize = bsize
+        self.n_steps = n_steps
+        self.n_epochs = n_epochs
+        self.eval_every = eval_every
+        self.patience = patience
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.resume = resume
+        self.config = config
+        self.num_workers = num_workers
+        self.log = log
+
+        self.device = model.device
+        self.test_tensors = None
+        if test_set is not None:
+            self.test_tensors = [
+                t.to(self.device) for t in test_set[torch.arange(len(test_set))]
+            ]
+
+        self.step = 0
+        self.epoch = 0
+        self.best_loss = float("inf")
+        self.best_state = None
+        self.bad_evals = 0
+        self.history = []
+
+    def _loader(self, n_batches=None):
+        if n_batches is None:
+            sampler = RandomSampler(self.train_set)
+        else:
+            sampler = RandomSampler(
+                self.train_set, replacement=True, num_samples=n_batches * self.bsize
+            )
+        return DataLoader(
+            self.train_set,
+            sampler=BatchSampler(sampler, self.bsize, drop_last=True),
+            batch_size=None,
+            num_workers=self.num_workers,
+            pin_memory=self.device.type == "cuda",
+            prefetch_factor=4,
+            persistent_workers=True,
+        )
+
+    def _index_batches(self, n_batches=None):
+        n = len(self.train_set)
+        if n_batches is None:
+            order = torch.randperm(n)
+            for i in range(n // self.bsize):
+                yield self.train_set[order[i * self.bsize : (i + 1) * self.bsize]]
+        else:
+            for _ in range(n_batches):
+                yield self.train_set[torch.randint(n, (self.bsize,))]
+
+    def _batches(self):
+        n_batches = None if self.n_steps is None else self.n_steps - self.step
+        if self.num_workers:
+            # the workers are kept alive as long as the loader is reused
+            loader = self._loader(n_batches)
+            epoch = lambda: iter(loader)
+        else:
+            epoch = lambda: self._index_batches(n_batches)
+        if self.n_steps is not None:
+            yield from epoch()
+            return
+        while self.epoch < self.n_epochs:
+            yield from epoch()
+            self.epoch += 1
+
+    def evaluate(self):
+        with torch.no_grad():
+            return _loss_value(self.model.train(*self.test_tensors, eval=True))
+
+    def done(self):
+        if self.n_steps is not None:
+            return self.step >= self.n_steps
+        return self.epoch >= self.n_epochs
+
+    def fit(self):
+        if self.resume:
+            self.load_checkpoint()
+        if self.done():
+            self.log(f"training already finished at step {self.step}")
+            return self.history
+        start = time.time()
+        samples = 0
+        for states, nstates, actions in self._batches():
+            states = states.to(self.device, non_blocking=True)
+            nstates = nstates.to(self.device, non_blocking=True)
+            actions = actions.to(self.device, non_blocking=True)
+            loss = self.model.train(states, nstates, actions)
+            self.step += 1
+            samples += len(states)
+
+            if self.step % self.eval_every == 0:
+                elapsed = time.time() - start
+                result = dict(
+                    step=self.step,
+                    train_loss=_loss_value(loss),
+                    samples_per_s=samples / elapsed,
+                )
+                if self.test_tensors is not None:
+                    result["eval_loss"] = self.evaluate()
+                self.history.append(result)
+                self.log(result)
+                start, samples = time.time(), 0
+                if self._early_stop(result.get("eval_loss")):
+                    self.log(f"early stopping at step {self.step}")
+                    break
+
+            if self.checkpoint_dir and self.step % self.checkpoint_every == 0:
+                self.save_checkpoint()
+
+        if self.best_state is not None:
+            self.model.load_state_dict(self.best_state)
+        if self.checkpoint_dir:
+            self.save_checkpoint()
+        return self.history
+
+    def _early_stop(self, eval_loss):
+        if self.patience is None or eval_loss is None:
+            return False
+        eval_loss = float(np.mean(eval_loss))
+        if eval_loss < self.best_loss:
+            self.best_loss = eval_loss
+            self.best_state = copy.deepcopy(self.model.state_dict())
+            self.bad_evals = 0
+            return False
+        self.bad_evals += 1
+        return self.bad_evals >= self.patience
+
+    def _checkpoint_path(self):
+        return os.path.join(self.checkpoint_dir, "trainer.pt")
+
+    def save_checkpoint(self):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        state = dict(
+            model=self.model.state_dict(),
+            opt=self.model.opt.state_dict(),
+            step=self.step,
+            epoch=self.epoch,
+            best_loss=self.best_loss,
+            best_state=self.best_state,
+            bad_evals=self.bad_evals,
+            history=self.history,
+            config=self.config,
+        )
+        torch.save(state, self._checkpoint_path())
+
+    def load_checkpoint(self):
+        if not self.checkpoint_dir or not os.path.exists(self._checkpoint_path()):
+            return
+        state = torch.load(self._checkpoint_path(), map_location=self.device)
+        if state.get("config") != self.config:
+            raise ValueError(
+                f"checkpoint {self._checkpoint_path()} was written with config "
+                f"{state.get('config')}, not {self.config}"
+            )
+        self.model.load_state_dict(state["model"])
+        self.model.opt.load_state_dict(state["opt"])
+        self.step = state["step"]
+        self.epoch = state["epoch"]
+        self.best_loss = state["best_loss"]
+        self.best_state = state["best_state"]
+        self.bad_evals = state["bad_evals"]
+        self.history = state["history"]
+        self.log(f"resuming training at step {self.step}")
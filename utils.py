@@ -1,6 +1,10 @@
+import os
+import json
 import numpy as np
 import torch
+from collections import namedtuple
 from omegaconf import OmegaConf
+from algo.touch import n_words, pack_bits, unpack_bits
 
 
 def get_conf(path):
@@ -17,11 +21,12 @@ class ReplayBuffer(object):
         self.ptr = 0
         self.size = 0
 
-        self.state = np.zeros((max_size, state_dim))
-        self.action = np.zeros((max_size, action_dim))
-        self.next_state = np.zeros((max_size, state_dim))
-        self.reward = np.zeros((max_size, 1))
-        self.not_done = np.zeros((max_size, 1))
+        # float32, the dtype of the networks, so sampling needs no conversion
+        self.state = np.zeros((max_size, state_dim), dtype=np.float32)
+        self.action = np.zeros((max_size, action_dim), dtype=np.float32)
+        self.next_state = np.zeros((max_size, state_dim), dtype=np.float32)
+        self.reward = np.zeros((max_size, 1), dtype=np.float32)
+        self.not_done = np.zeros((max_size, 1), dtype=np.float32)
 
         # self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.device = torch.device("cpu")
@@ -36,13 +41,201 @@ class ReplayBuffer(object):
         self.ptr = (self.ptr + 1) % self.max_size
         self.size = min(self.size + 1, self.max_size)
 
+    def sample(self, batch_size, n_batches=None):
+        """
+        Samples a batch of transitions, or with n_batches that many batches at
+        once, stacked to tensors of shape [n_batches, batch_size, ...].
+        """
+        shape = (batch_size,) if n_batches is None else (n_batches, batch_size)
+        ind = np.random.randint(0, self.size, size=shape)
+
+        return (
+            torch.from_numpy(self.state[ind]).to(self.device),
+            torch.from_numpy(self.action[ind]).to(self.device),
+            torch.from_numpy(self.next_state[ind]).to(self.device),
+            torch.from_numpy(self.reward[ind]).to(self.device),
+            torch.from_numpy(self.not_done[ind]).to(self.device),
+        )
+
+
+class ImageBuffer(object):
+    """
+    Replay buffer for image observations as returned by Env.get_vision. Images
+    are stored as uint8 and only converted to float inside the conv encoder,
+    which takes 4x less memory than float32 storage.
+    """
+
+    def __init__(self, image_shape, action_dim, max_size=int(1e5)):
+        self.max_size = max_size
+        self.ptr = 0
+        self.size = 0
+
+        self.image = np.zeros((max_size, *image_shape), dtype=np.uint8)
+        self.action = np.zeros((max_size, action_dim), dtype=np.float32)
+        self.next_image = np.zeros((max_size, *image_shape), dtype=np.uint8)
+
+        self.device = torch.device("cpu")
+
+    def add(self, image, action, next_image):
+        self.image[self.ptr] = image
+        self.action[self.ptr] = action
+        self.next_image[self.ptr] = next_image
+
+        self.ptr = (self.ptr + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+
     def sample(self, batch_size):
         ind = np.random.randint(0, self.size, size=batch_size)
 
         return (
-            torch.FloatTensor(self.state[ind]).to(self.device),
-            torch.FloatTensor(self.action[ind]).to(self.device),
-            torch.FloatTensor(self.next_state[ind]).to(self.device),
-            torch.FloatTensor(self.reward[ind]).to(self.device),
-            torch.FloatTensor(self.not_done[ind]).to(self.device),
+            torch.from_numpy(self.image[ind]).to(self.device),
+            torch.from_numpy(self.action[ind]).to(self.device),
+            torch.from_numpy(self.next_image[ind]).to(self.device),
+        )
+
+
+mm_transition = namedtuple(
+    "mm_transition",
+    ("prop", "tac", "audio", "prop_next", "tac_next", "audio_next", "action"),
+)
+
+
+class MultiModalBuffer(object):
+    """
+    Buffer for multi-modal transitions (mm_transition). Every field is a
+    preallocated column with a dtype that fits its modality: prop and actions
+    as float32, audio as float16 and the mostly binary touch map either as
+    bits (tac_format="bits", packed into uint32 words with algo.touch, 32x
+    smaller than float32) or as uint8 levels of tac_scale
+    (tac_format="uint8"). tac_scale is the value of a touch in the pushed
+    observations, Env.OBS_SCALER. Both formats decode touches to that value.
+    Samples are converted back to float32 tensors.
+
+    save / load use a chunked format, a directory with a .npy file per
+    column and chunk of chunk_size transitions, so that buffers of several
+    processes can be merged without loading everything at once.
+    """
+
+    def __init__(
+        self,
+        prop_dim,
+        tac_dim,
+        audio_dim,
+        action_dim,
+        capacity,
+        tac_format="bits",
+        tac_scale=10,
+        device=torch.device("cpu"),
+    ):
+        if tac_format not in ("bits", "uint8"):
+            raise ValueError(f"unknown tac_format {tac_format}, use bits or uint8")
+        self.dims = dict(prop=prop_dim, tac=tac_dim, audio=audio_dim, action=action_dim)
+        self.tac_format = tac_format
+        self.tac_scale = tac_scale
+        self.capacity = capacity
+        self.ptr = 0
+        self.size = 0
+        self.device = device
+
+        tac_column = (
+            ((n_words(tac_dim),), np.uint32)
+            if tac_format == "bits"
+            else ((tac_dim,), np.uint8)
+        )
+        columns = dict(
+            prop=((prop_dim,), np.float32),
+            tac=tac_column,
+            audio=((audio_dim,), np.float16),
+        )
+        self.columns = {}
+        for name, (shape, dtype) in columns.items():
+            self.columns[name] = np.zeros((capacity, *shape), dtype=dtype)
+            self.columns[name + "_next"] = np.zeros((capacity, *shape), dtype=dtype)
+        self.columns["action"] = np.zeros((capacity, action_dim), dtype=np.float32)
+
+    def __len__(self):
+        return self.size
+
+    def _encode_tac(self, tac):
+        tac = np.asarray(tac)
+        if self.tac_format == "bits":
+            return pack_bits(tac)
+        return np.clip(np.rint(tac / self.tac_scale), 0, 255)
+
+    def _decode_tac(self, tac):
+        if self.tac_format == "bits":
+            return unpack_bits(tac, self.dims["tac"]) * self.tac_scale
+        return torch.from_numpy(tac.astype(np.float32)) * self.tac_scale
+
+    def push(self, trans):
+        pos = self.ptr
+        for name in mm_transition._fields:
+            value = getattr(trans, name)
+            if name.startswith("tac"):
+                value = self._encode_tac(value)
+            elif isinstance(value, torch.Tensor):
+                value = value.detach().cpu().numpy()
+            self.columns[name][pos] = value
+        self.ptr = (pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, bsize):
+        idx = np.random.randint(0, self.size, size=bsize)
+        return self.get(idx)
+
+    def get(self, idx):
+        batch = {}
+        for name, column in self.columns.items():
+            if name.startswith("tac"):
+                batch[name] = self._decode_tac(column[idx])
+            else:
+                batch[name] = torch.from_numpy(column[idx].astype(np.float32))
+        return mm_transition(**{k: v.to(self.device) for k, v in batch.items()})
+
+    def save(self, path, chunk_size=100000):
+        os.makedirs(path, exist_ok=True)
+        starts = range(0, self.size, chunk_size)
+        meta = dict(
+            dims=self.dims,
+            tac_format=self.tac_format,
+            tac_scale=self.tac_scale,
+            size=self.size,
+            n_chunks=len(starts),
+        )
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        for i, start in enumerate(starts):
+            for name, column in self.columns.items():
+                chunk = column[start : start + chunk_size]
+                np.save(os.path.join(path, f"chunk_{i:05d}_{name}.npy"), chunk)
+
+    @classmethod
+    def load(cls, paths, capacity=None):
+        """
+        Loads one or more saved buffers (e.g. of all ranks) into a single
+        buffer, chunk by chunk.
+        """
+        paths = [paths] if isinstance(paths, str) else paths
+        metas = []
+        for path in paths:
+            with open(os.path.join(path, "meta.json")) as f:
+                metas.append(json.load(f))
+        size = sum(meta["size"] for meta in metas)
+        buffer = cls(
+            **{f"{k}_dim": v for k, v in metas[0]["dims"].items()},
+            capacity=capacity or size,
+            tac_format=metas[0]["tac_format"],
+            tac_scale=metas[0]["tac_scale"],
         )
+        for path, meta in zip(paths, metas):
+            for i in range(meta["n_chunks"]):
+                chunk = {
+                    key: np.load(os.path.join(path, f"chunk_{i:05d}_{key}.npy"))
+                    for key in buffer.columns
+                }
+                n = min(len(chunk["action"]), buffer.capacity - buffer.size)
+                for key, values in chunk.items():
+                    buffer.columns[key][buffer.size : buffer.size + n] = values[:n]
+                buffer.size += n
+        buffer.ptr = buffer.size % buffer.capacity
+        return buffer